@@ -0,0 +1,538 @@
+import os
+import sys
+import json
+import time
+import socket
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+
+import requests
+
+# Load generator for the upload and live event paths. Starts the app in a
+# subprocess on the local backends (blobs in a directory, tables in sqlite,
+# emails recorded in memory, optionally moderation against the stand-in),
+# then has N phones upload image1.jpg/image2.jpg to M walls while K screens
+# hold /events open. Prints a summary and writes the numbers as json, so two
+# commits can be compared with --compare. --startup measures a cold start
+# instead: the time to import server and the time until the first 200.
+# --models times hydrating, serializing and listing users and walls, in
+# process against the sqlite table store.
+#
+#   python bench.py --phones 20 --walls 4 --screens 200 --uploads 10
+#   python bench.py --startup --runs 10
+#   python bench.py --models --entities 100000
+#   python bench.py --compare bench-results/old.json bench-results/new.json
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMAGES = [os.path.join(HERE, 'image1.jpg'), os.path.join(HERE, 'image2.jpg')]
+
+IMPORT_SERVER = """
+import time
+started = time.perf_counter()
+import server
+print(time.perf_counter() - started)
+"""
+
+
+def percentile(values, p):
+    # nearest rank
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+def summarize(values, scale = 1000.0):
+    # seconds in, milliseconds out
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) * scale if values else None,
+        'min': min(values) * scale if values else None,
+        'p50': percentile(values, 50) * scale if values else None,
+        'p95': percentile(values, 95) * scale if values else None,
+        'p99': percentile(values, 99) * scale if values else None,
+        'max': max(values) * scale if values else None,
+    }
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+class ProcessSampler:
+    # peak and final rss plus cpu time of a process, from /proc (linux only)
+    def __init__(self, pid, interval = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.rss_peak = 0
+        self.rss_last = 0
+        self.available = os.path.exists(f'/proc/{pid}/status')
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+    def start(self):
+        self.cpu_start = self.cpu_seconds()
+        self.wall_start = time.monotonic()
+        if self.available:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self.cpu_end = self.cpu_seconds()
+        self.wall_end = time.monotonic()
+        self._stopped.set()
+
+    def rss(self):
+        try:
+            with open(f'/proc/{self.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    def cpu_seconds(self):
+        try:
+            with open(f'/proc/{self.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / self._ticks
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.rss_last = self.rss() or self.rss_last
+            self.rss_peak = max(self.rss_peak, self.rss_last)
+            self._stopped.wait(self.interval)
+
+    def result(self):
+        if not self.available:
+            return None
+        cpu = None
+        if self.cpu_start is not None and self.cpu_end is not None:
+            cpu = (self.cpu_end - self.cpu_start) / (self.wall_end - self.wall_start) * 100
+        return {
+            'rss_peak_mb': round(self.rss_peak / 2**20, 1),
+            'rss_end_mb': round(self.rss_last / 2**20, 1),
+            'cpu_percent': round(cpu, 1) if cpu is not None else None,
+        }
+
+
+class Screen(threading.Thread):
+    # one wall display holding /events open, records when each image arrives
+    def __init__(self, base_url, wall_id, ready):
+        super().__init__(daemon=True)
+        self.url = f'{base_url}/events?w={wall_id}'
+        self.wall_id = wall_id
+        self.ready = ready
+        self.received = {} # image id -> monotonic time
+        self.error = None
+        self.response = None
+
+    def run(self):
+        try:
+            self.response = requests.get(self.url, stream=True, timeout=(10, None))
+            self.ready.release()
+            for line in self.response.iter_lines(decode_unicode=True):
+                if line and line.startswith('data: '):
+                    event = json.loads(line[6:])
+                    if event.get('type') == 'add':
+                        self.received.setdefault(event['id'], time.monotonic())
+        except Exception as ex:
+            self.error = ex
+            self.ready.release()
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+
+
+class Phone(threading.Thread):
+    def __init__(self, base_url, wall_id, uploads, images, unique, think_time):
+        super().__init__(daemon=True)
+        self.url = f'{base_url}/w/{wall_id}'
+        self.wall_id = wall_id
+        self.uploads = uploads
+        self.images = images
+        self.unique = unique
+        self.think_time = think_time
+        self.session = requests.Session()
+        self.results = [] # (image id or None, started, seconds, status)
+
+    def run(self):
+        for i in range(self.uploads):
+            data = random.choice(self.images)
+            if self.unique:
+                # bytes after the jpeg end marker are ignored by decoders, but change the hash
+                data = data + os.urandom(16)
+            started = time.monotonic()
+            try:
+                response = self.session.post(self.url, data=data, headers={'Content-Type': 'image/jpeg'}, timeout=60)
+                image_id = response.json()['location'].rsplit('/', 1)[1] if response.status_code == 202 else None
+                self.results.append((image_id, started, time.monotonic() - started, response.status_code))
+            except Exception as ex:
+                self.results.append((None, started, time.monotonic() - started, repr(ex)))
+            if self.think_time:
+                time.sleep(random.uniform(0, 2 * self.think_time))
+
+
+def start_server(port, data_dir, moderation_endpoint = None, extra_env = None):
+    env = dict(os.environ)
+    env.update({
+        'STORAGE_BACKEND': 'local',
+        'LOCAL_STORAGE_DIR': data_dir,
+        'IMAGE_CACHE_DIR': os.path.join(data_dir, 'cache'),
+        'EMAIL_TRANSPORT': 'local',
+        'EMAIL_QUEUE': 'local',
+        'UPLOAD_QUEUE': 'local',
+        'EVENT_BUS': 'local',
+        'EVENT_STREAM': 'wsgi',
+        'MODERATION': 'on' if moderation_endpoint else 'off',
+        'PYTHONUNBUFFERED': '1',
+        # the production entry point, not the debug reloader
+        'PWD': '/app',
+        'PORT': str(port),
+    })
+    if moderation_endpoint:
+        env['CONTENT_SAFETY_ENDPOINT'] = moderation_endpoint
+        env['CONTENT_SAFETY_KEY'] = 'bench'
+    env.update(extra_env or {})
+    log = open(os.path.join(data_dir, 'server.log'), 'w')
+    process = subprocess.Popen([sys.executable, 'server.py'], cwd=HERE, env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+    return process, log
+
+def wait_until_up(base_url, process, timeout = 60, interval = 0.1):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited, see server.log')
+        try:
+            if requests.get(base_url + '/', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(interval)
+    raise RuntimeError('server did not come up')
+
+def stop_server(process, log):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    log.close()
+
+
+def run(args):
+    data_dir = tempfile.mkdtemp(prefix='livewall-bench-')
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    standin = None
+    if args.moderation:
+        from standins import ContentSafetyStandIn
+        standin = ContentSafetyStandIn(latency=args.moderation_latency).start()
+    process, log = start_server(port, data_dir, standin.endpoint if standin else None)
+    try:
+        wait_until_up(base_url, process)
+        sampler = ProcessSampler(process.pid).start()
+
+        wall_ids = []
+        for _ in range(args.walls):
+            response = requests.post(base_url + '/', json={}, timeout=30)
+            wall_ids.append(response.json()['url'].split('/w/')[1].split('?')[0])
+
+        ready = threading.Semaphore(0)
+        screens = [Screen(base_url, wall_ids[i % args.walls], ready) for i in range(args.screens)]
+        for screen in screens:
+            screen.start()
+        for _ in screens:
+            ready.acquire()
+        failed_screens = sum(1 for screen in screens if screen.error is not None)
+
+        images = [open(path, 'rb').read() for path in IMAGES]
+        phones = [Phone(base_url, wall_ids[i % args.walls], args.uploads, images, args.unique, args.think_time)
+                  for i in range(args.phones)]
+        started = time.monotonic()
+        for phone in phones:
+            phone.start()
+        for phone in phones:
+            phone.join()
+        upload_seconds = time.monotonic() - started
+
+        # give the pipeline and the event fan-out time to catch up
+        uploads = [(phone.wall_id, r) for phone in phones for r in phone.results]
+        accepted = [(wall_id, r) for wall_id, r in uploads if r[0] is not None]
+        expected = sum(1 for wall_id, r in accepted for screen in screens
+                       if screen.wall_id == wall_id and screen.error is None)
+        deadline = time.monotonic() + args.drain
+        while time.monotonic() < deadline:
+            delivered = sum(1 for wall_id, r in accepted for screen in screens
+                            if screen.wall_id == wall_id and r[0] in screen.received)
+            if delivered >= expected:
+                break
+            time.sleep(0.1)
+        total_seconds = time.monotonic() - started
+        sampler.stop()
+
+        delivery = []
+        for wall_id, (image_id, upload_started, _, _) in accepted:
+            for screen in screens:
+                if screen.wall_id == wall_id and image_id in screen.received:
+                    delivery.append(screen.received[image_id] - upload_started)
+
+        result = {
+            'kind': 'load',
+            'commit': git_commit(),
+            'timestamp': datetime.now(tz=timezone.utc).isoformat(),
+            'config': {
+                'phones': args.phones,
+                'walls': args.walls,
+                'screens': args.screens,
+                'uploads_per_phone': args.uploads,
+                'unique': args.unique,
+                'think_time': args.think_time,
+                'moderation': args.moderation,
+            },
+            'upload_ms': summarize([r[2] for _, r in accepted]),
+            'upload_errors': len(uploads) - len(accepted),
+            'delivery_ms': summarize(delivery),
+            'delivery': {'expected': expected, 'delivered': len(delivery), 'failed_screens': failed_screens},
+            'throughput': {
+                'uploads_per_s': round(len(accepted) / upload_seconds, 2) if upload_seconds else None,
+                'events_per_s': round(len(delivery) / total_seconds, 2) if total_seconds else None,
+            },
+            'server': sampler.result(),
+        }
+        for screen in screens:
+            screen.close()
+        return result
+    finally:
+        stop_server(process, log)
+        if standin is not None:
+            standin.stop()
+
+
+def slowest_imports(env, count = 15):
+    # modules with the most cumulative import time, from python -X importtime
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import server'], cwd=HERE, env=env,
+                            capture_output=True, text=True).stderr
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if cumulative.strip().isdigit() and name.startswith('   ') and not name.startswith('    '):
+            # direct imports of server only
+            imports.append((name.strip(), int(cumulative) / 1000))
+    return sorted(imports, key=lambda item: -item[1])[:count]
+
+def run_startup(args):
+    data_dir = tempfile.mkdtemp(prefix='livewall-startup-')
+    env = dict(os.environ, STORAGE_BACKEND='local', LOCAL_STORAGE_DIR=data_dir, EMAIL_TRANSPORT='local',
+               IMAGE_CACHE_DIR=os.path.join(data_dir, 'cache'), PWD='/app')
+    import_seconds = []
+    first_200_seconds = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SERVER], cwd=HERE, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        import_seconds.append(float(output.strip().splitlines()[-1]))
+
+        port = free_port()
+        started = time.monotonic()
+        process, log = start_server(port, data_dir)
+        try:
+            wait_until_up(f'http://127.0.0.1:{port}', process, interval=0.005)
+            first_200_seconds.append(time.monotonic() - started)
+        finally:
+            stop_server(process, log)
+    return {
+        'kind': 'startup',
+        'commit': git_commit(),
+        'timestamp': datetime.now(tz=timezone.utc).isoformat(),
+        'config': {'runs': args.runs, 'python': sys.version.split()[0]},
+        'import_ms': summarize(import_seconds),
+        'first_200_ms': summarize(first_200_seconds),
+        'slowest_imports_ms': slowest_imports(env),
+    }
+
+def run_models(args):
+    data_dir = tempfile.mkdtemp(prefix='livewall-models-')
+    # before config is imported
+    os.environ.update({'STORAGE_BACKEND': 'local', 'LOCAL_STORAGE_DIR': data_dir})
+    import gc
+    import tracemalloc
+    from models import User, Wall, Image
+    from datalayers import UserDataLayer, WallDataLayer, MAX_BATCH_SIZE
+
+    now = datetime.now(tz=timezone.utc).isoformat()
+    n = args.entities
+    entities = {
+        'users': (User, [{'PartitionKey': 'id', 'RowKey': f'u{i:08d}', 'id': f'u{i:08d}', 'email': f'user{i}@example.com',
+                          'validation_code': '123456', 'validated': False, 'created': now, 'modified': now}
+                         for i in range(n)]),
+        'walls': (Wall, [{'PartitionKey': 'wall', 'RowKey': f'w{i:08d}', 'id': f'w{i:08d}', 'owner_key': 'k' * 22,
+                          'owner_email': None, 'status': 'new', 'created': now, 'modified': now}
+                         for i in range(n)]),
+        'images': (Image, [{'PartitionKey': 'wall', 'RowKey': f'i{i:08d}', 'id': f'i{i:08d}', 'wall_id': 'w',
+                            'blob_url': None, 'content_type': 'image/jpeg', 'size': 1000, 'hidden': False,
+                            'blob_name': 'b' * 64, 'owner_key': 'k' * 22, 'timestamp': 0.0,
+                            'created': now, 'modified': now}
+                           for i in range(n)]),
+    }
+    result = {
+        'kind': 'models',
+        'commit': git_commit(),
+        'timestamp': datetime.now(tz=timezone.utc).isoformat(),
+        'config': {'entities': n, 'python': sys.version.split()[0]},
+    }
+    for name, (cls, rows) in entities.items():
+        gc.collect()
+        tracemalloc.start()
+        objects = [cls.create_from_entity(row) for row in rows]
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del objects
+        # timed separately, tracing slows every allocation down
+        gc.collect()
+        started = time.perf_counter()
+        objects = [cls.create_from_entity(row) for row in rows]
+        hydrate = time.perf_counter() - started
+        started = time.perf_counter()
+        for obj in objects:
+            obj.to_dict()
+        to_dict = time.perf_counter() - started
+        started = time.perf_counter()
+        for obj in objects:
+            obj.created
+        read_created = time.perf_counter() - started
+        result[name] = {
+            'hydrate_ms': round(hydrate * 1000, 1),
+            'to_dict_ms': round(to_dict * 1000, 1),
+            'read_created_ms': round(read_created * 1000, 1),
+            'bytes_per_entity': allocated // n,
+        }
+        del objects
+
+    # the admin listings, a page at a time through the data layer
+    for name, layer, iterate in (('users', UserDataLayer(), 'iter_users'), ('walls', WallDataLayer(), 'iter_walls')):
+        rows = entities[name][1]
+        for i in range(0, n, MAX_BATCH_SIZE):
+            layer.table_client.submit_transaction([('upsert', row) for row in rows[i:i + MAX_BATCH_SIZE]])
+        started = time.perf_counter()
+        count = sum(1 for _ in getattr(layer, iterate)(page_size=1000))
+        result[name]['list_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        assert count == n, (name, count)
+    return result
+
+def print_models_result(result):
+    print(f"models, {result['config']['entities']} entities ({result['commit']})")
+    for name in ('users', 'walls', 'images'):
+        r = result[name]
+        listed = f" list {r['list_ms']}ms" if 'list_ms' in r else ''
+        print(f"  {name:<7} hydrate {r['hydrate_ms']}ms, to_dict {r['to_dict_ms']}ms, read created {r['read_created_ms']}ms,"
+              f" {r['bytes_per_entity']} bytes each{listed}")
+
+def print_startup_result(result):
+    print(f"startup, {result['config']['runs']} runs ({result['commit']})")
+    for name in ('import_ms', 'first_200_ms'):
+        s = result[name]
+        print(f"  {name[:-3]:<9} p50={s['p50']:.1f}ms min={s['min']:.1f}ms max={s['max']:.1f}ms")
+    print("  slowest imports")
+    for module, ms in result['slowest_imports_ms']:
+        print(f"    {module:<28} {ms:.1f}ms")
+
+def print_result(result):
+    if result.get('kind') == 'startup':
+        print_startup_result(result)
+        return
+    if result.get('kind') == 'models':
+        print_models_result(result)
+        return
+    config = result['config']
+    print(f"{config['phones']} phones x {config['uploads_per_phone']} uploads, {config['walls']} walls, {config['screens']} screens ({result['commit']})")
+    for name in ('upload_ms', 'delivery_ms'):
+        s = result[name]
+        if s['count']:
+            print(f"  {name[:-3]:<9} n={s['count']:<6} p50={s['p50']:.1f}ms p95={s['p95']:.1f}ms p99={s['p99']:.1f}ms max={s['max']:.1f}ms")
+    print(f"  errors    uploads={result['upload_errors']} undelivered={result['delivery']['expected'] - result['delivery']['delivered']}"
+          f" screens={result['delivery']['failed_screens']}")
+    print(f"  rate      {result['throughput']['uploads_per_s']} uploads/s, {result['throughput']['events_per_s']} events/s")
+    if result.get('server'):
+        server = result['server']
+        print(f"  server    rss peak {server['rss_peak_mb']}MB, end {server['rss_end_mb']}MB, cpu {server['cpu_percent']}%")
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old['commit']} -> {new['commit']}")
+    rows = [('upload_ms', k) for k in ('p50', 'p95', 'p99')] + [('delivery_ms', k) for k in ('p50', 'p95', 'p99')]
+    rows += [('throughput', 'uploads_per_s'), ('throughput', 'events_per_s')]
+    rows += [('server', 'rss_peak_mb'), ('server', 'cpu_percent')]
+    rows += [('import_ms', 'p50'), ('first_200_ms', 'p50')]
+    for section in ('users', 'walls', 'images'):
+        rows += [(section, key) for key in ('hydrate_ms', 'to_dict_ms', 'read_created_ms', 'bytes_per_entity', 'list_ms')]
+    for section, key in rows:
+        a = (old.get(section) or {}).get(key)
+        b = (new.get(section) or {}).get(key)
+        if a is None or b is None:
+            continue
+        change = f'{(b - a) / a * 100:+.1f}%' if a else ''
+        print(f"  {section + '.' + key:<28} {a:>10.1f} {b:>10.1f} {change}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Upload and live event benchmark on the local backends')
+    parser.add_argument('--phones', type=int, default=10)
+    parser.add_argument('--walls', type=int, default=2)
+    parser.add_argument('--screens', type=int, default=20)
+    parser.add_argument('--uploads', type=int, default=5, help='uploads per phone')
+    parser.add_argument('--think-time', type=float, default=0.0, help='mean seconds between uploads of one phone')
+    parser.add_argument('--unique', action='store_true', help='make every upload unique instead of repeating the two images')
+    parser.add_argument('--moderation', action='store_true', help='moderate uploads against the local content safety stand-in')
+    parser.add_argument('--moderation-latency', type=float, default=0.05)
+    parser.add_argument('--drain', type=float, default=30.0, help='seconds to wait for events after the last upload')
+    parser.add_argument('--output', help='json file, defaults to bench-results/<commit>-<time>.json')
+    parser.add_argument('--startup', action='store_true', help='measure import time and time to the first 200 instead')
+    parser.add_argument('--runs', type=int, default=5, help='cold starts for --startup')
+    parser.add_argument('--models', action='store_true', help='time model hydration and listings instead')
+    parser.add_argument('--entities', type=int, default=100000, help='entities per kind for --models')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.models:
+        result = run_models(args)
+    elif args.startup:
+        result = run_startup(args)
+    else:
+        result = run(args)
+    print_result(result)
+    output = args.output
+    if output is None:
+        stamp = datetime.now(tz=timezone.utc).strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(HERE, 'bench-results', f"{result['commit']}-{stamp}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print("Results", output)
+
+
+if __name__ == '__main__':
+    main()
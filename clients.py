@@ -0,0 +1,143 @@
+import os
+import threading
+
+from config import AZURE_STORAGE_CS, AZURE_COMMS_CS, AZURE_POOL_CONNECTIONS, AZURE_POOL_MAXSIZE
+from config import STORAGE_BACKEND, LOCAL_STORAGE_DIR, LOCAL_BLOB_URL
+
+# Process wide registry of azure clients. Clients are created once per
+# connection string and shared by every request; the SDK clients are thread
+# safe and each one keeps a pool of keep-alive connections, so the hot paths
+# skip connection string parsing and TLS handshakes. With STORAGE_BACKEND=local
+# the blob and table clients are the drop-in local stores instead.
+
+_lock = threading.RLock() # factories may fetch the client they are built from
+_clients = {}
+
+_connections_lock = threading.Lock()
+_connections_opened = 0
+
+def _count_connection():
+    global _connections_opened
+    with _connections_lock:
+        _connections_opened += 1
+
+def connections_opened():
+    # total number of new TCP connections made by the shared clients
+    return _connections_opened
+
+
+_adapter_class = None
+
+def _pooled_adapter_class():
+    # requests is imported with the first http client, local runs may never need it
+    global _adapter_class
+    if _adapter_class is None:
+        from requests.adapters import HTTPAdapter
+        from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+        class CountingHTTPConnectionPool(HTTPConnectionPool):
+            def _new_conn(self):
+                _count_connection()
+                return super()._new_conn()
+
+        class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+            def _new_conn(self):
+                _count_connection()
+                return super()._new_conn()
+
+        class PooledAdapter(HTTPAdapter):
+            def init_poolmanager(self, *args, **kwargs):
+                super().init_poolmanager(*args, **kwargs)
+                self.poolmanager.pool_classes_by_scheme = {
+                    'http': CountingHTTPConnectionPool,
+                    'https': CountingHTTPSConnectionPool,
+                }
+
+        _adapter_class = PooledAdapter
+    return _adapter_class
+
+
+def _session():
+    import requests
+    session = requests.Session()
+    adapter = _pooled_adapter_class()(pool_connections=AZURE_POOL_CONNECTIONS, pool_maxsize=AZURE_POOL_MAXSIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def _transport():
+    from azure.core.pipeline.transport import RequestsTransport
+    return RequestsTransport(session=_session(), session_owner=False)
+
+def _get(key, factory):
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = factory()
+    return client
+
+
+def get_blob_service_client(connection_string = AZURE_STORAGE_CS):
+    if STORAGE_BACKEND == 'local':
+        def create_local():
+            from localblobs import FileBlobServiceClient
+            return FileBlobServiceClient(os.path.join(LOCAL_STORAGE_DIR, 'blobs'), LOCAL_BLOB_URL)
+        return _get(('blob', 'local'), create_local)
+    def create():
+        from azure.storage.blob import BlobServiceClient
+        return BlobServiceClient.from_connection_string(connection_string, transport=_transport())
+    return _get(('blob', connection_string), create)
+
+def get_table_service_client(connection_string = AZURE_STORAGE_CS):
+    if STORAGE_BACKEND == 'local':
+        def create_local():
+            from localtables import SqliteTableServiceClient
+            return SqliteTableServiceClient(os.path.join(LOCAL_STORAGE_DIR, 'tables.db'))
+        return _get(('table', 'local'), create_local)
+    def create():
+        from azure.data.tables import TableServiceClient
+        return TableServiceClient.from_connection_string(conn_str=connection_string, transport=_transport())
+    return _get(('table', connection_string), create)
+
+def get_table_client(table_name, connection_string = AZURE_STORAGE_CS):
+    # table clients share the transport of their service client
+    key = 'local' if STORAGE_BACKEND == 'local' else connection_string
+    return _get(('table', key, table_name),
+                lambda: get_table_service_client(connection_string).get_table_client(table_name=table_name))
+
+def get_queue_service_client(connection_string = AZURE_STORAGE_CS):
+    def create():
+        from azure.storage.queue import QueueServiceClient
+        return QueueServiceClient.from_connection_string(conn_str=connection_string, transport=_transport())
+    return _get(('queue', connection_string), create)
+
+def get_http_session():
+    # for plain http apis, e.g. content safety
+    return _get(('http',), _session)
+
+def get_email_client(connection_string = AZURE_COMMS_CS):
+    def create():
+        from azure.communication.email import EmailClient
+        return EmailClient.from_connection_string(connection_string, transport=_transport())
+    return _get(('email', connection_string), create)
+
+
+def warmup(table_names = ('users', 'walls', 'images')):
+    # create the clients and open a first connection to each endpoint, so the
+    # first real request doesn't pay for the handshakes
+    try:
+        get_blob_service_client().get_account_information()
+    except Exception as ex:
+        print("Blob warmup failed", ex)
+    for table_name in table_names:
+        try:
+            next(iter(get_table_client(table_name).query_entities("PartitionKey eq ''", results_per_page=1)), None)
+        except Exception as ex:
+            print("Table warmup failed", table_name, ex)
+    if AZURE_COMMS_CS:
+        try:
+            get_email_client()
+        except Exception as ex:
+            print("Email warmup failed", ex)
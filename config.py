@@ -1,11 +1,22 @@
 import os
 
-from dotenv import load_dotenv
-load_dotenv(override=True)
+# a .env file is for local runs, containers get their settings from the environment
+if os.path.exists('.env') or os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')):
+    from dotenv import load_dotenv
+    load_dotenv(override=True)
 
 AZURE_COMMS_CS = os.getenv("AZURE_COMMS_CS")
 AZURE_STORAGE_CS = os.getenv("AZURE_STORAGE_CS")
+# azure, or local for blobs in a directory and tables in sqlite under LOCAL_STORAGE_DIR
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "azure")
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", "data")
+LOCAL_BLOB_URL = os.getenv("LOCAL_BLOB_URL", "/blobs") # where the app serves local blobs
 EMAIL_SENDER_ADDRESS = os.getenv("EMAIL_SENDER_ADDRESS")
+EMAIL_TRANSPORT = os.getenv("EMAIL_TRANSPORT", "azure") # azure, or local to only record and print
+EMAIL_QUEUE = os.getenv("EMAIL_QUEUE", "local") # local or azure
+EMAIL_QUEUE_NAME = os.getenv("EMAIL_QUEUE_NAME", "emails")
+EMAIL_WORKERS = int(os.getenv("EMAIL_WORKERS", 2)) # sends in flight
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", 5))
 
 STRIPE_SIGNING_SECRET = os.getenv("STRIPE_SIGNING_SECRET")
 STRIPE_API_KEY = os.getenv("STRIPE_API_KEY")
@@ -13,4 +24,67 @@ STRIPE_PUBLIC_KEY = os.getenv("STRIPE_PUBLIC_KEY")
 STRIPE_PRICE_ID = os.getenv("STRIPE_PRICE_ID")
 
 CONTENT_SAFETY_ENDPOINT = os.getenv("CONTENT_SAFETY_ENDPOINT")
-CONTENT_SAFETY_KEY = os.getenv("CONTENT_SAFETY_KEY")
\ No newline at end of file
+CONTENT_SAFETY_KEY = os.getenv("CONTENT_SAFETY_KEY")
+
+# moderation hides every new image until the endpoint answers, so it is only on when asked for
+MODERATION = os.getenv("MODERATION", "off") == "on"
+MODERATION_QUEUE = os.getenv("MODERATION_QUEUE", "local") # local or azure
+MODERATION_QUEUE_NAME = os.getenv("MODERATION_QUEUE_NAME", "moderation")
+MODERATION_WORKERS = int(os.getenv("MODERATION_WORKERS", 4)) # calls to the endpoint in flight
+MODERATION_MAX_ATTEMPTS = int(os.getenv("MODERATION_MAX_ATTEMPTS", 5))
+MODERATION_MAX_EDGE = int(os.getenv("MODERATION_MAX_EDGE", 512)) # pixels, longest edge sent for analysis
+MODERATION_THRESHOLD = int(os.getenv("MODERATION_THRESHOLD", 3)) # lowest severity that hides an image
+MODERATION_CACHE_ITEMS = int(os.getenv("MODERATION_CACHE_ITEMS", 10000))
+
+# live events
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", 64))
+EVENT_REPLAY_SIZE = int(os.getenv("EVENT_REPLAY_SIZE", 50))
+EVENT_HISTORY_WALLS = int(os.getenv("EVENT_HISTORY_WALLS", 10000)) # walls whose recent events are kept for replay
+EVENT_HEARTBEAT_INTERVAL = float(os.getenv("EVENT_HEARTBEAT_INTERVAL", 15))
+EVENT_BUS = os.getenv("EVENT_BUS", "local") # local or redis
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+EVENT_STREAM = os.getenv("EVENT_STREAM", "wsgi") # wsgi or async
+EVENTS_HOST = os.getenv("EVENTS_HOST", "0.0.0.0")
+EVENTS_PORT = int(os.getenv("EVENTS_PORT", 3001))
+EVENTS_URL = os.getenv("EVENTS_URL") # where wall screens connect, defaults to /events or EVENTS_PORT with async
+
+# image cache
+IMAGE_CACHE_MEMORY_MB = int(os.getenv("IMAGE_CACHE_MEMORY_MB", 64))
+IMAGE_CACHE_DISK_MB = int(os.getenv("IMAGE_CACHE_DISK_MB", 1024)) # 0 disables the disk tier
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR") # each process caches in its own subdirectory, defaults to the temp dir
+IMAGE_CACHE_METADATA_ITEMS = int(os.getenv("IMAGE_CACHE_METADATA_ITEMS", 10000))
+
+# proxy streams image bytes through the app, redirect sends browsers to a sas url
+IMAGE_DELIVERY = os.getenv("IMAGE_DELIVERY", "proxy")
+SAS_CACHE_ITEMS = int(os.getenv("SAS_CACHE_ITEMS", 10000)) # sas urls kept for reuse
+RENDITION_CACHE_ITEMS = int(os.getenv("RENDITION_CACHE_ITEMS", 50000)) # renditions remembered as existing
+
+# shared azure clients
+AZURE_POOL_CONNECTIONS = int(os.getenv("AZURE_POOL_CONNECTIONS", 10)) # hosts kept in the pool
+AZURE_POOL_MAXSIZE = int(os.getenv("AZURE_POOL_MAXSIZE", 32)) # keep-alive connections per host
+
+# uploads
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 25 * 1024 * 1024))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", 4 * 1024 * 1024))
+UPLOAD_PARALLELISM = int(os.getenv("UPLOAD_PARALLELISM", 4)) # blocks in flight per upload
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", 8 * 1024 * 1024)) # bigger uploads are hashed via a temp file
+UPLOAD_QUEUE = os.getenv("UPLOAD_QUEUE", "local") # local or azure
+UPLOAD_QUEUE_NAME = os.getenv("UPLOAD_QUEUE_NAME", "uploads")
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", 4))
+UPLOAD_MAX_ATTEMPTS = int(os.getenv("UPLOAD_MAX_ATTEMPTS", 5))
+
+# wall metadata cache
+WALL_CACHE_TTL = float(os.getenv("WALL_CACHE_TTL", 60))
+WALL_CACHE_ITEMS = int(os.getenv("WALL_CACHE_ITEMS", 10000))
+WALL_PAGE_SIZE = int(os.getenv("WALL_PAGE_SIZE", 100)) # images per wall page
+
+# cleanup
+PURGE_WORKERS = int(os.getenv("PURGE_WORKERS", 8))
+TEMPORARY_WALL_TTL_HOURS = float(os.getenv("TEMPORARY_WALL_TTL_HOURS", 24))
+SWEEP_LOOKBACK_DAYS = int(os.getenv("SWEEP_LOOKBACK_DAYS", 14)) # buckets older than this are not checked
+
+# qr codes
+QR_CACHE_ITEMS = int(os.getenv("QR_CACHE_ITEMS", 1000))
+
+# metrics
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") # bearer token for /metrics, which is off without one
@@ -1,13 +1,218 @@
 import os
-
-from datetime import datetime
-from azure.data.tables import TableServiceClient
-from azure.storage.blob import BlobServiceClient
-from azure.storage.queue import QueueServiceClient
-from azure.core.exceptions import ResourceNotFoundError
-
-from config import AZURE_STORAGE_CS
-from models import User, Image, Wall, WallStatus
+import json
+import time
+import base64
+import threading
+import contextvars
+
+from collections import OrderedDict
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError, HttpResponseError
+from azure.data.tables import TableTransactionError, UpdateMode
+
+from config import AZURE_STORAGE_CS, WALL_CACHE_TTL, WALL_CACHE_ITEMS, PURGE_WORKERS, STORAGE_BACKEND
+from clients import get_table_service_client, get_table_client, get_queue_service_client, get_blob_service_client
+from models import User, Image, Wall, WallStatus, WallStats
+from metrics import timed
+
+
+# table writes made in the current context, so a request or job can check its write budget
+_write_counter = contextvars.ContextVar('table_write_counter', default=None)
+
+class WriteCounter:
+    def __init__(self):
+        self.requests = 0 # round trips to the table service
+        self.entities = 0 # entities written or deleted
+        self._lock = threading.Lock()
+
+    def add(self, entities):
+        with self._lock:
+            self.requests += 1
+            self.entities += entities
+
+def start_counting_writes():
+    counter = WriteCounter()
+    _write_counter.set(counter)
+    return counter
+
+def _count_write(entities = 1):
+    counter = _write_counter.get()
+    if counter is not None:
+        counter.add(entities)
+
+class TimedPages:
+    # page iterator of a table query, each page is one round trip
+    def __init__(self, pages, operation):
+        self._pages = pages
+        self._operation = operation
+
+    def __getattr__(self, name):
+        return getattr(self._pages, name)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with timed('table', self._operation):
+            return next(self._pages)
+
+class TimedQuery:
+    def __init__(self, paged, operation):
+        self._paged = paged
+        self._operation = operation
+
+    def __getattr__(self, name):
+        return getattr(self._paged, name)
+
+    def by_page(self, *args, **kwargs):
+        return TimedPages(self._paged.by_page(*args, **kwargs), self._operation)
+
+    def __iter__(self):
+        for page in self.by_page():
+            yield from page
+
+class CountingTableClient:
+    # wraps a shared table client, counts its writes and times every call
+    def __init__(self, table_client):
+        self._table_client = table_client
+
+    def __getattr__(self, name):
+        return getattr(self._table_client, name)
+
+    def get_entity(self, *args, **kwargs):
+        with timed('table', 'get'):
+            return self._table_client.get_entity(*args, **kwargs)
+
+    def query_entities(self, *args, **kwargs):
+        return TimedQuery(self._table_client.query_entities(*args, **kwargs), 'query')
+
+    def list_entities(self, *args, **kwargs):
+        return TimedQuery(self._table_client.list_entities(*args, **kwargs), 'query')
+
+    def create_entity(self, *args, **kwargs):
+        _count_write()
+        with timed('table', 'write'):
+            return self._table_client.create_entity(*args, **kwargs)
+
+    def upsert_entity(self, *args, **kwargs):
+        _count_write()
+        with timed('table', 'write'):
+            return self._table_client.upsert_entity(*args, **kwargs)
+
+    def update_entity(self, *args, **kwargs):
+        _count_write()
+        with timed('table', 'write'):
+            return self._table_client.update_entity(*args, **kwargs)
+
+    def delete_entity(self, *args, **kwargs):
+        _count_write()
+        with timed('table', 'delete'):
+            return self._table_client.delete_entity(*args, **kwargs)
+
+    def submit_transaction(self, operations, **kwargs):
+        operations = list(operations)
+        _count_write(len(operations))
+        with timed('table', 'transaction'):
+            return self._table_client.submit_transaction(operations, **kwargs)
+
+# independent table calls to different partitions run side by side
+_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='table-io')
+
+def _submit_write(fn, *args, **kwargs):
+    # carry the write counter into the worker thread
+    return _executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def fetch_concurrently(fn, items):
+    # fn(item) for every item on the shared executor, results in order
+    futures = [_executor.submit(contextvars.copy_context().run, fn, item) for item in items]
+    return [future.result() for future in futures]
+
+# table queries allow at most 15 comparisons in one filter
+MAX_FILTER_COMPARISONS = 15
+
+ADMIN_PAGE_SIZE = 50
+
+# entity group transactions take at most 100 operations, all in one partition
+MAX_BATCH_SIZE = 100
+
+def _delete_batch(table_client, rows):
+    try:
+        table_client.submit_transaction([('delete', row) for row in rows])
+    except TableTransactionError:
+        # the batch fails as a whole if one row is already gone, do the rest one by one
+        for row in rows:
+            try:
+                table_client.delete_entity(partition_key=row['PartitionKey'], row_key=row['RowKey'])
+            except ResourceNotFoundError:
+                pass
+    return len(rows)
+
+def delete_entities_batched(table_client, entities, executor = None, max_in_flight = PURGE_WORKERS * 2, max_buffered = 2000):
+    # deletes entities streamed from any iterable, grouped into per partition
+    # batches that run on the executor. returns the number of entities deleted
+    executor = executor if executor is not None else _executor
+    buffers = {} # partition key -> rows waiting for a batch
+    buffered = 0
+    in_flight = []
+    deleted = 0
+
+    def submit(rows):
+        nonlocal deleted
+        while len(in_flight) >= max_in_flight:
+            deleted += in_flight.pop(0).result()
+        in_flight.append(executor.submit(contextvars.copy_context().run, _delete_batch, table_client, rows))
+
+    for entity in entities:
+        rows = buffers.setdefault(entity['PartitionKey'], [])
+        rows.append({'PartitionKey': entity['PartitionKey'], 'RowKey': entity['RowKey']})
+        buffered += 1
+        if len(rows) == MAX_BATCH_SIZE:
+            submit(buffers.pop(entity['PartitionKey']))
+            buffered -= MAX_BATCH_SIZE
+        elif buffered >= max_buffered:
+            # lots of small partitions, send what we have
+            for rows in buffers.values():
+                submit(rows)
+            buffers = {}
+            buffered = 0
+    for rows in buffers.values():
+        submit(rows)
+    for future in in_flight:
+        deleted += future.result()
+    return deleted
+
+def _encode_continuation(token):
+    # table continuation tokens are small dicts, make them url safe and opaque
+    if token is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(token).encode('utf-8')).decode('ascii')
+
+def _decode_continuation(token):
+    if not token:
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    except (ValueError, UnicodeError):
+        raise ValueError('invalid continuation token')
+
+def _query_page(table_client, query, page_size, continuation_token = None):
+    # one page of a query plus the token for the next one, None when done
+    pages = table_client.query_entities(query, results_per_page=page_size).by_page(
+        continuation_token=_decode_continuation(continuation_token))
+    entities = list(next(pages, []))
+    return entities, _encode_continuation(pages.continuation_token)
+
+def _iter_query(table_client, query, page_size):
+    # streams every entity a page at a time
+    token = None
+    while True:
+        entities, token = _query_page(table_client, query, page_size, token)
+        yield from entities
+        if token is None:
+            return
 
 
 
@@ -15,8 +220,8 @@ class UserDataLayer:
     def __init__(self, connection_string = AZURE_STORAGE_CS, table_name = 'users'):
         self.connection_string = connection_string
         self.table_name = table_name
-        self.table_service_client = TableServiceClient.from_connection_string(conn_str=connection_string)
-        self.table_client = self.table_service_client.get_table_client(table_name=table_name)
+        self.table_service_client = get_table_service_client(connection_string)
+        self.table_client = CountingTableClient(get_table_client(table_name, connection_string))
 
     def create(self, user):
         entity = user.to_dict()
@@ -31,18 +236,14 @@ class UserDataLayer:
     def get_by_id(self, id):
         try:
             entity = self.table_client.get_entity(partition_key='id', row_key=id)
-            usr = User(None)
-            usr.from_dict(entity)
-            return usr
+            return User.create_from_entity(entity)
         except ResourceNotFoundError:
             return None
         
     def get_by_email(self, email):
         try:
             entity = self.table_client.get_entity(partition_key='email', row_key=email)
-            usr = User(None)
-            usr.from_dict(entity)
-            return usr
+            return User.create_from_entity(entity)
         except ResourceNotFoundError:
             return None
         
@@ -61,18 +262,86 @@ class UserDataLayer:
         self.table_client.delete_entity(partition_key='email', row_key=user.email)
 
     def list_users(self):
-        query = "PartitionKey eq 'id'"
-        entities = self.table_client.query_entities(query)
-        return [User.create_from_entity(entity) for entity in entities]
+        return list(self.iter_users())
+
+    def iter_users(self, page_size = ADMIN_PAGE_SIZE):
+        for entity in _iter_query(self.table_client, "PartitionKey eq 'id'", page_size):
+            yield User.create_from_entity(entity)
+
+    def list_users_page(self, page_size = ADMIN_PAGE_SIZE, continuation_token = None):
+        entities, token = _query_page(self.table_client, "PartitionKey eq 'id'", page_size, continuation_token)
+        return [User.create_from_entity(entity) for entity in entities], token
+
+
+
+class EntityCache:
+    # read-through cache of raw entities with a ttl. writers invalidate, and a
+    # read that raced with an invalidation is not allowed to store its result
+    def __init__(self, ttl = WALL_CACHE_TTL, max_items = WALL_CACHE_ITEMS):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (expires, entity)
+        self._generation = 0
+        self._invalidated = {} # key -> generation of its last invalidation
+        self._floor = 0 # reads older than this may have missed an invalidation
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def token(self):
+        with self._lock:
+            return self._generation
+
+    def put(self, key, entity, token = None):
+        with self._lock:
+            if token is not None and (token < self._floor or self._invalidated.get(key, -1) > token):
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, entity)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+            self._invalidated[key] = self._generation
+            if len(self._invalidated) > self.max_items:
+                # forget the history, and with it every read in flight
+                self._invalidated.clear()
+                self._floor = self._generation
 
+wall_cache = EntityCache()
+
+# called with (kind, key) after a local write, so other processes can drop their copy
+_invalidation_publisher = None
+
+def set_invalidation_publisher(publisher):
+    global _invalidation_publisher
+    _invalidation_publisher = publisher
+
+def invalidate_wall(wall_id, publish = True):
+    wall_cache.invalidate(wall_id)
+    if publish and _invalidation_publisher is not None:
+        _invalidation_publisher('wall', wall_id)
 
 
 class WallDataLayer:
     def __init__(self, connection_string = AZURE_STORAGE_CS, table_name = 'walls'):
         self.connection_string = connection_string
         self.table_name = table_name
-        self.table_service_client = TableServiceClient.from_connection_string(conn_str=connection_string)
-        self.table_client = self.table_service_client.get_table_client(table_name=table_name)
+        self.table_service_client = get_table_service_client(connection_string)
+        self.table_client = CountingTableClient(get_table_client(table_name, connection_string))
 
     def create(self, wall):
         entity = wall.to_dict()
@@ -80,15 +349,51 @@ class WallDataLayer:
         entity['RowKey'] = wall.id
         del entity['image_ids']
         self.table_client.create_entity(entity=entity)
+        invalidate_wall(wall.id)
+        # temporary walls are found by the expiry sweeper through their creation day
+        if wall.status == WallStatus.NEW:
+            self.table_client.upsert_entity(entity={
+                'PartitionKey': self.expiry_bucket(wall.created),
+                'RowKey': wall.id
+            })
+
+    # new walls are indexed by the day they were created, so the sweeper can
+    # find expired ones by reading a few small partitions instead of all walls
+    @staticmethod
+    def expiry_bucket(created):
+        return f"expiry-{created.strftime('%Y%m%d')}"
 
-    def get_by_id(self, id):
+    def list_expiry_bucket(self, day):
+        query = f"PartitionKey eq '{self.expiry_bucket(day)}'"
+        return [entity['RowKey'] for entity in self.table_client.query_entities(query, select=['RowKey'])]
+
+    def remove_from_expiry_bucket(self, day, wall_id):
         try:
-            entity = self.table_client.get_entity(partition_key='wall', row_key=id)
-            wall = Wall(None)
-            wall.from_dict(entity)
-            return wall
+            self.table_client.delete_entity(partition_key=self.expiry_bucket(day), row_key=wall_id)
         except ResourceNotFoundError:
-            return None
+            pass
+
+    def delete_stats(self, wall_id):
+        markers = self.table_client.query_entities("PartitionKey eq 'stats' and RowKey gt @first and RowKey lt @last",
+                                                   parameters={'first': f'{wall_id}~', 'last': f'{wall_id}~~'},
+                                                   select=['PartitionKey', 'RowKey'])
+        delete_entities_batched(self.table_client, markers)
+        try:
+            self.table_client.delete_entity(partition_key='stats', row_key=wall_id)
+        except ResourceNotFoundError:
+            pass
+
+    def get_by_id(self, id):
+        # callers mutate the wall they get, so every call builds a fresh one
+        entity = wall_cache.get(id)
+        if entity is None:
+            token = wall_cache.token()
+            try:
+                entity = dict(self.table_client.get_entity(partition_key='wall', row_key=id))
+            except ResourceNotFoundError:
+                return None
+            wall_cache.put(id, entity, token)
+        return Wall.create_from_entity(entity)
         
     def add_image_to_wall(self, wall_id, image_id):
         entity = {
@@ -107,6 +412,7 @@ class WallDataLayer:
         entity['RowKey'] = wall.id
         del entity['image_ids']
         self.table_client.update_entity(mode='merge', entity=entity)
+        invalidate_wall(wall.id)
         # if the wall is owned, create an index to the owner email
         if wall.status == WallStatus.OWNED:
             entity['PartitionKey'] = wall.owner_email
@@ -114,12 +420,118 @@ class WallDataLayer:
             self.table_client.upsert_entity(entity=entity)
 
     def delete(self, wall):
-        self.table_client.delete_entity(partition_key='id', row_key=wall.id)
+        self.table_client.delete_entity(partition_key='wall', row_key=wall.id)
+        invalidate_wall(wall.id)
+
+    # aggregates for each wall live in the 'stats' partition, kept current on
+    # upload and delete so nobody has to count the images. every counted image
+    # has a marker row next to its wall's row, written in the same transaction,
+    # so a retried job can't count an image twice or remove one never counted
+    def add_image_to_stats(self, wall_id, image_id, size, timestamp):
+        # returns None if the image was counted already
+        def add(stats):
+            stats.num_images += 1
+            stats.bytes_stored += size
+            stats.first_upload = timestamp if stats.first_upload is None else min(stats.first_upload, timestamp)
+            stats.last_upload = timestamp if stats.last_upload is None else max(stats.last_upload, timestamp)
+        return self._update_stats(wall_id, add, image_id, counted=True)
+
+    def remove_image_from_stats(self, wall_id, image_id, size):
+        # returns None if the image was never counted
+        def remove(stats):
+            stats.num_images = max(stats.num_images - 1, 0)
+            stats.bytes_stored = max(stats.bytes_stored - size, 0)
+            # first and last are only exact while images are added, reset them once empty
+            if stats.num_images == 0:
+                stats.first_upload = None
+                stats.last_upload = None
+        return self._update_stats(wall_id, remove, image_id, counted=False)
+
+    def set_stats(self, stats, image_ids = ()):
+        self.table_client.upsert_entity(entity=self._stats_entity(stats), mode='replace')
+        markers = [self._counted_entity(stats.wall_id, image_id) for image_id in image_ids]
+        for i in range(0, len(markers), MAX_BATCH_SIZE):
+            self.table_client.submit_transaction([('upsert', marker) for marker in markers[i:i + MAX_BATCH_SIZE]])
+
+    def is_counted(self, wall_id, image_id):
+        try:
+            self.table_client.get_entity(partition_key='stats', row_key=self._counted_key(wall_id, image_id))
+            return True
+        except ResourceNotFoundError:
+            return False
+
+    def _update_stats(self, wall_id, change, image_id, counted, attempts = 10):
+        # optimistic concurrency, uploads to one wall race for the same row
+        for _ in range(attempts):
+            try:
+                entity = self.table_client.get_entity(partition_key='stats', row_key=wall_id)
+            except ResourceNotFoundError:
+                entity = None
+            stats = WallStats(wall_id)
+            if entity is not None:
+                stats.from_dict(entity)
+            change(stats)
+            if entity is None:
+                operations = [('create', self._stats_entity(stats))]
+            else:
+                operations = [('update', self._stats_entity(stats), {'mode': UpdateMode.REPLACE,
+                                                                     'etag': entity.metadata['etag'],
+                                                                     'match_condition': MatchConditions.IfNotModified})]
+            operations.append(('create' if counted else 'delete', self._counted_entity(wall_id, image_id)))
+            try:
+                self.table_client.submit_transaction(operations)
+                return stats
+            except HttpResponseError as ex:
+                # 409 someone created the row first, 412 someone updated it first,
+                # or the marker says there is nothing to do
+                if ex.status_code not in (404, 409, 412):
+                    raise
+            if self.is_counted(wall_id, image_id) == counted:
+                return None
+        raise RuntimeError(f'Could not update stats for wall {wall_id}')
+
+    @staticmethod
+    def _counted_key(wall_id, image_id):
+        # image ids are alphanumeric, so a wall's markers sort between '<wall>~' and '<wall>~~'
+        return f'{wall_id}~{image_id}'
+
+    @classmethod
+    def _counted_entity(cls, wall_id, image_id):
+        return {'PartitionKey': 'stats', 'RowKey': cls._counted_key(wall_id, image_id)}
+
+    @staticmethod
+    def _stats_entity(stats):
+        entity = {k: v for k, v in stats.to_dict().items() if v is not None}
+        entity['PartitionKey'] = 'stats'
+        entity['RowKey'] = stats.wall_id
+        return entity
+
+    def get_stats_for_walls(self, wall_ids):
+        # returns wall id -> WallStats, one query per 15 walls, run concurrently
+        wall_ids = list(wall_ids)
+        chunks = [wall_ids[i:i + MAX_FILTER_COMPARISONS - 1] for i in range(0, len(wall_ids), MAX_FILTER_COMPARISONS - 1)]
+
+        def query_chunk(chunk):
+            parameters = {f'w{n}': wall_id for n, wall_id in enumerate(chunk)}
+            rows = " or ".join(f"RowKey eq @w{n}" for n in range(len(chunk)))
+            return list(self.table_client.query_entities(f"PartitionKey eq 'stats' and ({rows})", parameters=parameters))
+
+        result = {wall_id: WallStats(wall_id) for wall_id in wall_ids}
+        for entities in fetch_concurrently(query_chunk, chunks):
+            for entity in entities:
+                result[entity['RowKey']].from_dict(entity)
+        return result
 
     def list_walls(self):
-        query = "PartitionKey eq 'wall'"
-        entities = self.table_client.query_entities(query)
-        return [Wall.create_from_entity(entity) for entity in entities]
+        return list(self.iter_walls())
+
+    def iter_walls(self, page_size = ADMIN_PAGE_SIZE):
+        for entity in _iter_query(self.table_client, "PartitionKey eq 'wall'", page_size):
+            yield Wall.create_from_entity(entity)
+
+    def list_walls_page(self, page_size = ADMIN_PAGE_SIZE, continuation_token = None):
+        entities, token = _query_page(self.table_client, "PartitionKey eq 'wall'", page_size, continuation_token)
+        return [Wall.create_from_entity(entity) for entity in entities], token
     
     def list_walls_for_user(self, email):
         query = f"PartitionKey eq '{email}'"
@@ -128,32 +540,42 @@ class WallDataLayer:
 
 
 
+# the wall partition of the images table holds the image rows (RowKey is the
+# image id) and two ordering index rows per image. shortuuid ids are
+# alphanumeric, so index keys starting with '~' sort after every image row
+INDEX_NEWEST_PREFIX = '~n~' # reverse timestamp, newest first
+INDEX_OLDEST_PREFIX = '~o~' # timestamp, oldest first
+INDEX_MAX_TS = 10**13 - 1 # milliseconds, good until year 2286
+# originals are stored under the sha256 of their bytes and shared by identical
+# uploads. reference counts live in 256 '~b~xx' partitions of the same table
+BLOB_REF_PREFIX = '~b~'
+
 class ImageDataLayer:
     def __init__(self, connection_string = AZURE_STORAGE_CS, table_name = 'images'):
         self.connection_string = connection_string
         self.table_name = table_name
-        self.table_service_client = TableServiceClient.from_connection_string(conn_str=connection_string)
-        self.table_client = self.table_service_client.get_table_client(table_name=table_name)
+        self.table_service_client = get_table_service_client(connection_string)
+        self.table_client = CountingTableClient(get_table_client(table_name, connection_string))
 
     def create(self, image):
+        # two round trips in parallel: one batch for the wall partition (image
+        # row and ordering index) and one for the id index. upserts so a
+        # retried upload job can finish a partial write
         entity = image.to_dict()
-        # associate the image with the wall
-        entity['PartitionKey'] = image.wall_id
-        entity['RowKey'] = image.id
-        self.table_client.create_entity(entity=entity)
-        # create an index of the image id
         p, k = self.__split_id(image.id)
-        entity['PartitionKey'] = p
-        entity['RowKey'] = k
-        self.table_client.create_entity(entity=entity)
+        id_index = _submit_write(self.table_client.upsert_entity, entity=dict(entity, PartitionKey=p, RowKey=k))
+        # associate the image with the wall, hidden images stay out of the ordering index
+        wall_rows = [dict(entity, PartitionKey=image.wall_id, RowKey=image.id)]
+        if not image.hidden:
+            wall_rows += self._index_entities(image.wall_id, image.id, image.timestamp, image.blob_name)
+        self.table_client.submit_transaction([('upsert', row) for row in wall_rows])
+        id_index.result()
 
     def get_by_id(self, image_id):
         try:
             p, r = self.__split_id(image_id)
             entity = self.table_client.get_entity(partition_key=p, row_key=r)
-            img = Image(None)
-            img.from_dict(entity)
-            return img
+            return Image.create_from_entity(entity)
         except ResourceNotFoundError:
             return None
 
@@ -168,15 +590,188 @@ class ImageDataLayer:
         entity['RowKey'] = k
         self.table_client.update_entity(mode='merge', entity=entity)
 
+    def set_hidden(self, image, hidden):
+        # hiding takes the image out of the ordering index, showing puts it back
+        image.hidden = hidden
+        p, k = self.__split_id(image.id)
+        id_index = _submit_write(self.table_client.update_entity,
+                                 entity={'PartitionKey': p, 'RowKey': k, 'hidden': hidden}, mode=UpdateMode.MERGE)
+        index_rows = self._index_entities(image.wall_id, image.id, image.timestamp, image.blob_name)
+        operations = [('update', {'PartitionKey': image.wall_id, 'RowKey': image.id, 'hidden': hidden}, {'mode': UpdateMode.MERGE})]
+        if hidden:
+            operations += [('delete', row) for row in index_rows]
+        else:
+            operations += [('upsert', row) for row in index_rows]
+        try:
+            self.table_client.submit_transaction(operations)
+        except TableTransactionError:
+            if not hidden:
+                raise
+            # the index rows were already gone
+            self.table_client.update_entity(entity=operations[0][1], mode=UpdateMode.MERGE)
+        id_index.result()
+
     def delete(self, image):
         p, k = self.__split_id(image.id)
-        self.table_client.delete_entity(partition_key=p, row_key=k)
-        self.table_client.delete_entity(partition_key=image.wall_id, row_key=image.id)
+        id_index = _submit_write(self.table_client.delete_entity, partition_key=p, row_key=k)
+        wall_rows = [{'PartitionKey': image.wall_id, 'RowKey': image.id}]
+        wall_rows += self._index_entities(image.wall_id, image.id, image.timestamp)
+        try:
+            self.table_client.submit_transaction([('delete', row) for row in wall_rows])
+        except TableTransactionError:
+            # a batch fails as a whole, e.g. for images without index rows yet
+            for row in wall_rows:
+                try:
+                    self.table_client.delete_entity(partition_key=row['PartitionKey'], row_key=row['RowKey'])
+                except ResourceNotFoundError:
+                    pass
+        id_index.result()
 
     def list_images_for_wall(self, wall_id):
+        # every image of the wall, unordered. prefer list_images_page
+        query = f"PartitionKey eq '{wall_id}' and RowKey lt '~'"
+        entities = self.table_client.query_entities(query, select=['RowKey', 'timestamp', 'hidden', 'size', 'blob_name'])
+        return [ {"id": entity['RowKey'], "ts": entity['timestamp'], "hidden": bool(entity.get('hidden')),
+                  "size": entity.get('size') or 0, "blob_name": entity.get('blob_name') or entity['RowKey']}
+                 for entity in entities]
+
+    def list_images_page(self, wall_id, limit = 50, cursor = None, newest_first = True):
+        # returns (images, cursor), pass the cursor back to get the next page, None means done
+        prefix = INDEX_NEWEST_PREFIX if newest_first else INDEX_OLDEST_PREFIX
+        after = prefix
+        if cursor is not None:
+            after = self._decode_cursor(cursor)
+            if after is None or not after.startswith(prefix):
+                raise ValueError('invalid cursor')
+        # the prefix range ends where its last character is bumped by one
+        before = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        query = "PartitionKey eq @wall_id and RowKey gt @after and RowKey lt @before"
+        entities = self.table_client.query_entities(query,
+                                                    parameters={'wall_id': wall_id, 'after': after, 'before': before},
+                                                    select=['RowKey', 'id', 'timestamp', 'blob_name'],
+                                                    results_per_page=limit + 1)
+        rows = list(islice(entities, limit + 1))
+        # index rows written before content addressing have no blob name, it was the id
+        images = [ {"id": row['id'], "ts": row['timestamp'], "blob_name": row.get('blob_name') or row['id']}
+                   for row in rows[:limit] ]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = self._encode_cursor(rows[limit - 1]['RowKey'])
+        return images, next_cursor
+
+    def purge_wall(self, wall_id):
+        # deletes every image row of the wall and their id index rows,
+        # returns (image id, blob name) for each image
         query = f"PartitionKey eq '{wall_id}'"
-        entities = self.table_client.query_entities(query, select=['RowKey', 'timestamp'])
-        return [ {"id": entity['RowKey'], "ts": entity['timestamp']} for entity in entities]
+        entities = list(self.table_client.query_entities(query, select=['PartitionKey', 'RowKey', 'blob_name']))
+        images = [(entity['RowKey'], entity.get('blob_name') or entity['RowKey'])
+                  for entity in entities if not entity['RowKey'].startswith('~')]
+        id_rows = []
+        for image_id, _ in images:
+            p, k = self.__split_id(image_id)
+            id_rows.append({'PartitionKey': p, 'RowKey': k})
+        delete_entities_batched(self.table_client, [{'PartitionKey': e['PartitionKey'], 'RowKey': e['RowKey']} for e in entities] + id_rows)
+        return images
+
+    def add_blob_reference(self, blob_name, only_existing = False, attempts = 10):
+        # returns False when there is no reference yet and only_existing is set,
+        # the caller then uploads the blob before adding the first reference.
+        # a row with count 0 is the tombstone of a delete in progress, it is
+        # taken over like a missing row
+        key = {'PartitionKey': BLOB_REF_PREFIX + blob_name[:2], 'RowKey': blob_name}
+        for _ in range(attempts):
+            try:
+                entity = self.table_client.get_entity(partition_key=key['PartitionKey'], row_key=key['RowKey'])
+            except ResourceNotFoundError:
+                entity = None
+            if only_existing and (entity is None or entity['count'] < 1):
+                return False
+            try:
+                if entity is None:
+                    self.table_client.create_entity(entity=dict(key, count=1))
+                else:
+                    self.table_client.update_entity(mode='replace', entity=dict(key, count=entity['count'] + 1),
+                                                    etag=entity.metadata['etag'],
+                                                    match_condition=MatchConditions.IfNotModified)
+                return True
+            except HttpResponseError as ex:
+                if ex.status_code not in (409, 412):
+                    raise
+        raise RuntimeError(f'Could not reference blob {blob_name}')
+
+    def release_blob_reference(self, blob_name, attempts = 10):
+        # returns (last, tombstone). last is True when that was the last
+        # reference and the blob can go. the row then stays as a tombstone
+        # with count 0 until drop_blob_tombstone, so an identical upload in
+        # between is seen. blobs from before content addressing have no row
+        # and are never shared
+        key = {'PartitionKey': BLOB_REF_PREFIX + blob_name[:2], 'RowKey': blob_name}
+        for _ in range(attempts):
+            try:
+                entity = self.table_client.get_entity(partition_key=key['PartitionKey'], row_key=key['RowKey'])
+            except ResourceNotFoundError:
+                return True, None
+            if entity['count'] < 1:
+                # another delete holds the tombstone
+                return False, None
+            try:
+                metadata = self.table_client.update_entity(mode='replace', entity=dict(key, count=entity['count'] - 1),
+                                                           etag=entity.metadata['etag'],
+                                                           match_condition=MatchConditions.IfNotModified)
+                if entity['count'] > 1:
+                    return False, None
+                return True, metadata['etag']
+            except ResourceNotFoundError:
+                # someone else released it in between, look again
+                continue
+            except HttpResponseError as ex:
+                if ex.status_code != 412:
+                    raise
+        raise RuntimeError(f'Could not release blob {blob_name}')
+
+    def drop_blob_tombstone(self, blob_name, tombstone):
+        # fails quietly when an identical upload took the row over meanwhile
+        try:
+            self.table_client.delete_entity(partition_key=BLOB_REF_PREFIX + blob_name[:2], row_key=blob_name,
+                                            etag=tombstone, match_condition=MatchConditions.IfNotModified)
+        except ResourceNotFoundError:
+            pass
+        except HttpResponseError as ex:
+            if ex.status_code != 412:
+                raise
+
+    def migrate_wall_index(self, wall_id):
+        # writes the ordering index rows for images stored before they existed.
+        # hidden images get theirs when moderation shows them
+        count = 0
+        for image in self.list_images_for_wall(wall_id):
+            if image['hidden']:
+                continue
+            for row in self._index_entities(wall_id, image['id'], image['ts'], image['blob_name']):
+                self.table_client.upsert_entity(entity=row)
+            count += 1
+        return count
+
+    @staticmethod
+    def _index_entities(wall_id, image_id, timestamp, blob_name = None):
+        # the blob name lets a listing link renditions without reading the image rows
+        ts = int(float(timestamp) * 1000)
+        values = {'id': image_id, 'timestamp': timestamp, 'blob_name': blob_name or image_id}
+        return [
+            dict(values, PartitionKey=wall_id, RowKey=f'{INDEX_NEWEST_PREFIX}{INDEX_MAX_TS - ts:013d}~{image_id}'),
+            dict(values, PartitionKey=wall_id, RowKey=f'{INDEX_OLDEST_PREFIX}{ts:013d}~{image_id}'),
+        ]
+
+    @staticmethod
+    def _encode_cursor(row_key):
+        return base64.urlsafe_b64encode(row_key.encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        try:
+            return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        except (ValueError, UnicodeError):
+            return None
 
     @staticmethod
     def __split_id(id):
@@ -185,34 +780,55 @@ class ImageDataLayer:
     
 
 class CleanDatabase:
-    def __init__(self, connection_string = AZURE_STORAGE_CS):
+    def __init__(self, connection_string = AZURE_STORAGE_CS, workers = PURGE_WORKERS):
         self.connection_string = connection_string
-        self.table_service_client = TableServiceClient.from_connection_string(conn_str=connection_string)
-        self.queue_service_client = QueueServiceClient.from_connection_string(conn_str=connection_string)
-        self.blob_service_client = BlobServiceClient.from_connection_string(conn_str=connection_string)
+        self.workers = workers
+        self.table_service_client = get_table_service_client(connection_string)
+        # the local backend has no queues, local job queues live in memory
+        self.queue_service_client = get_queue_service_client(connection_string) if STORAGE_BACKEND != 'local' else None
+        self.blob_service_client = get_blob_service_client(connection_string)
 
     def clean_everything(self):
-        for table in self.table_service_client.list_tables():
-            self._clean_table(table.name)
-        for queue in self.queue_service_client.list_queues():
-            self._clean_queue(queue.name)
-        for container in self.blob_service_client.list_containers():
-            self._clean_blob_container(container.name)
-
-    def _clean_table(self, table_name):
-        table_service_client = TableServiceClient.from_connection_string(self.connection_string)
-        table_client = table_service_client.get_table_client(table_name)
-        for entity in table_client.list_entities():
-            table_client.delete_entity(partition_key=entity['PartitionKey'], row_key=entity['RowKey'])
+        started = time.time()
+        # the threads go away with the run, not with the instance
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='purge') as executor:
+            for table in self.table_service_client.list_tables():
+                self._report(table.name, self._clean_table(table.name, executor), started)
+            for queue in self.queue_service_client.list_queues() if self.queue_service_client else ():
+                self._clean_queue(queue.name)
+                print(f"Cleared queue {queue.name}")
+            for container in self.blob_service_client.list_containers():
+                self._report(container.name, self._clean_blob_container(container.name, executor), started)
+
+    @staticmethod
+    def _report(name, count, started):
+        elapsed = time.time() - started
+        print(f"Deleted {count} from {name}, {elapsed:.1f}s elapsed")
+
+    def _clean_table(self, table_name, executor):
+        table_client = get_table_client(table_name, self.connection_string)
+        entities = table_client.list_entities(select=['PartitionKey', 'RowKey'], results_per_page=1000)
+        return delete_entities_batched(table_client, entities, executor)
 
     def _clean_queue(self, queue_name):
-        queue_service_client = QueueServiceClient.from_connection_string(self.connection_string)
-        queue_client = queue_service_client.get_queue_client(queue_name)
-        for message in queue_client.receive_messages():
-            queue_client.delete_message(message)
-
-    def _clean_blob_container(self, container_name):
-        blob_service_client = BlobServiceClient.from_connection_string(self.connection_string)
-        container_client = blob_service_client.get_container_client(container_name)
+        queue_client = self.queue_service_client.get_queue_client(queue_name)
+        queue_client.clear_messages()
+
+    def _clean_blob_container(self, container_name, executor, batch_size = 256):
+        # blob batches take up to 256 deletes per request
+        container_client = self.blob_service_client.get_container_client(container_name)
+        futures = []
+        names = []
+        deleted = 0
         for blob in container_client.list_blobs():
-            container_client.delete_blob(blob)
+            names.append(blob.name)
+            if len(names) == batch_size:
+                if len(futures) >= self.workers * 2:
+                    deleted += len(list(futures.pop(0).result()))
+                futures.append(executor.submit(container_client.delete_blobs, *names))
+                names = []
+        if names:
+            futures.append(executor.submit(container_client.delete_blobs, *names))
+        for future in futures:
+            deleted += len(list(future.result()))
+        return deleted
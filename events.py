@@ -0,0 +1,334 @@
+import json
+import time
+import queue
+import threading
+from collections import deque, OrderedDict
+
+from config import EVENT_QUEUE_SIZE, EVENT_REPLAY_SIZE, EVENT_HEARTBEAT_INTERVAL, EVENT_HISTORY_WALLS
+from config import EVENT_BUS, REDIS_URL
+from metrics import timed
+
+
+def format_sse(event_id, data):
+    return f"id: {event_id}\ndata: {data}\n\n"
+
+SSE_HEARTBEAT = ": keepalive\n\n"
+SSE_RETRY = "retry: 3000\n\n"
+
+
+class Subscription:
+    def __init__(self, wall_id, maxsize = EVENT_QUEUE_SIZE):
+        self.wall_id = wall_id
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.evicted = False
+
+    def offer(self, event_id, data):
+        # never block the publisher, a full queue means a slow consumer
+        try:
+            self.queue.put_nowait((event_id, data))
+            return True
+        except queue.Full:
+            return False
+
+    def evict(self):
+        self.evicted = True
+
+    def stream(self, heartbeat_interval = EVENT_HEARTBEAT_INTERVAL):
+        # yields server-sent event frames until the subscription is evicted
+        yield SSE_RETRY
+        while not self.evicted:
+            try:
+                event_id, data = self.queue.get(timeout=heartbeat_interval)
+            except queue.Empty:
+                yield SSE_HEARTBEAT
+                continue
+            yield format_sse(event_id, data)
+
+
+class EventHub:
+    def __init__(self, queue_size = EVENT_QUEUE_SIZE, replay_size = EVENT_REPLAY_SIZE, history_walls = EVENT_HISTORY_WALLS):
+        self.queue_size = queue_size
+        self.replay_size = replay_size
+        self.history_walls = history_walls
+        self._lock = threading.Lock()
+        self._subscribers = {} # wall id -> set of subscriptions
+        # both only for the walls seen last, a wall that went quiet is forgotten
+        self._history = OrderedDict() # wall id -> ring buffer of (event id, data)
+        self._last_ids = {} # wall id -> last event id handed out
+
+    def _next_id(self, wall_id):
+        # millisecond based ids keep increasing across restarts, so a client
+        # reconnecting to a fresh process is not replayed stale history
+        event_id = max(self._last_ids.get(wall_id, 0) + 1, int(time.time() * 1000))
+        self._last_ids[wall_id] = event_id
+        return event_id
+
+    def subscribe(self, wall_id, last_event_id = None, subscription = None):
+        if subscription is None:
+            subscription = Subscription(wall_id, self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(wall_id, set()).add(subscription)
+            # replay whatever the client missed while it was disconnected
+            if last_event_id is not None:
+                for event_id, data in self._history.get(wall_id, ()):
+                    if event_id > last_event_id:
+                        subscription.offer(event_id, data)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.wall_id)
+            if subscribers is None:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.wall_id]
+
+    def publish(self, wall_id, data, event_id = None):
+        with self._lock:
+            if event_id is None:
+                event_id = self._next_id(wall_id)
+            elif event_id <= self._last_ids.get(wall_id, 0):
+                # seen already, e.g. merged from the shared history first
+                return event_id
+            else:
+                self._last_ids[wall_id] = event_id
+            self._wall_history(wall_id).append((event_id, data))
+            subscribers = list(self._subscribers.get(wall_id, ()))
+        self._deliver(subscribers, [(event_id, data)])
+        return event_id
+
+    def merge_history(self, wall_id, events):
+        # (event id, data) pairs from a shared history, oldest first. events newer
+        # than any seen here are delivered like a publish, older ones only fill
+        # in the replay buffer
+        with self._lock:
+            last_id = self._last_ids.get(wall_id, 0)
+            history = self._wall_history(wall_id)
+            merged = dict(history)
+            merged.update(events)
+            history.clear()
+            history.extend(sorted(merged.items()))
+            newer = [(event_id, data) for event_id, data in events if event_id > last_id]
+            if newer:
+                self._last_ids[wall_id] = newer[-1][0]
+            subscribers = list(self._subscribers.get(wall_id, ()))
+        self._deliver(subscribers, newer)
+
+    def _wall_history(self, wall_id):
+        # called with the lock held
+        history = self._history.get(wall_id)
+        if history is None:
+            history = self._history[wall_id] = deque(maxlen=self.replay_size)
+        self._history.move_to_end(wall_id)
+        while len(self._history) > self.history_walls:
+            forgotten, _ = self._history.popitem(last=False)
+            self._last_ids.pop(forgotten, None)
+        return history
+
+    def _deliver(self, subscribers, events):
+        # outside the lock, evict anyone who can't keep up
+        for subscription in subscribers:
+            for event_id, data in events:
+                if not subscription.offer(event_id, data):
+                    subscription.evict()
+                    self.unsubscribe(subscription)
+                    break
+
+    def subscriber_counts(self):
+        # wall id -> number of subscriptions in this process
+        with self._lock:
+            return {wall_id: len(s) for wall_id, s in self._subscribers.items()}
+
+    def subscriber_count(self, wall_id = None):
+        with self._lock:
+            if wall_id is not None:
+                return len(self._subscribers.get(wall_id, ()))
+            return sum(len(s) for s in self._subscribers.values())
+
+
+def parse_last_event_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class LocalEventBus:
+    # delivers events to subscribers living in this process only
+    def __init__(self, hub = None):
+        self.hub = hub if hub is not None else EventHub()
+
+    def publish(self, wall_id, data):
+        return self.hub.publish(wall_id, data)
+
+    def subscribe(self, wall_id, last_event_id = None, subscription = None):
+        return self.hub.subscribe(wall_id, last_event_id, subscription)
+
+    def unsubscribe(self, subscription):
+        self.hub.unsubscribe(subscription)
+
+    def publish_invalidation(self, kind, key):
+        # caches in this process are invalidated directly by the writer
+        pass
+
+    def on_invalidation(self, callback):
+        pass
+
+    def close(self):
+        pass
+
+
+class RedisEventBus(LocalEventBus):
+    # publishes on one redis channel per wall, and only listens to the walls
+    # that have subscribers in this process. the replay buffer lives in redis
+    # so a client can reconnect to any worker without losing events
+    CHANNEL_PREFIX = 'livewall:wall:'
+    HISTORY_PREFIX = 'livewall:history:'
+    SEQUENCE_PREFIX = 'livewall:seq:'
+    INVALIDATION_CHANNEL = 'livewall:invalidate'
+    HISTORY_TTL = 24 * 3600
+    SUBSCRIBE_TIMEOUT = 5
+
+    def __init__(self, client = None, url = REDIS_URL, hub = None, poll_interval = 0.2):
+        super().__init__(hub)
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.poll_interval = poll_interval
+        self._pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self._lock = threading.Lock()
+        self._wall_refs = {} # wall id -> number of local subscriptions
+        self._channels_ready = {} # wall id -> set once the listener subscribed its channel
+        self._pending = queue.Queue() # (action, channel, event set when done) for the listener thread
+        self._listener = None
+        self._closed = threading.Event()
+        self._invalidation_callbacks = []
+
+    def publish(self, wall_id, data):
+        event_id = self.client.incr(self.SEQUENCE_PREFIX + wall_id)
+        message = json.dumps({'id': event_id, 'data': data})
+        pipe = self.client.pipeline()
+        pipe.publish(self.CHANNEL_PREFIX + wall_id, message)
+        pipe.lpush(self.HISTORY_PREFIX + wall_id, message)
+        pipe.ltrim(self.HISTORY_PREFIX + wall_id, 0, self.hub.replay_size - 1)
+        pipe.expire(self.HISTORY_PREFIX + wall_id, self.HISTORY_TTL)
+        pipe.expire(self.SEQUENCE_PREFIX + wall_id, self.HISTORY_TTL)
+        with timed('redis', 'publish'):
+            pipe.execute()
+        return event_id
+
+    def subscribe(self, wall_id, last_event_id = None, subscription = None):
+        with self._lock:
+            refs = self._wall_refs.get(wall_id, 0)
+            self._wall_refs[wall_id] = refs + 1
+            if refs == 0:
+                self._channels_ready[wall_id] = threading.Event()
+                self._pending.put(('subscribe', self.CHANNEL_PREFIX + wall_id, self._channels_ready[wall_id]))
+            ready = self._channels_ready[wall_id]
+            self._ensure_listener()
+        if last_event_id is not None:
+            # read the shared history only once the channel is live, so nothing
+            # falls between the two. the hub skips what arrives from both
+            if not ready.wait(self.SUBSCRIBE_TIMEOUT):
+                print("Event bus subscribe not confirmed", wall_id)
+            history = [json.loads(raw) for raw in reversed(self.client.lrange(self.HISTORY_PREFIX + wall_id, 0, -1))]
+            self.hub.merge_history(wall_id, [(message['id'], message['data']) for message in history])
+        return self.hub.subscribe(wall_id, last_event_id, subscription)
+
+    def unsubscribe(self, subscription):
+        self.hub.unsubscribe(subscription)
+        wall_id = subscription.wall_id
+        with self._lock:
+            refs = self._wall_refs.get(wall_id, 0) - 1
+            if refs > 0:
+                self._wall_refs[wall_id] = refs
+            elif wall_id in self._wall_refs:
+                del self._wall_refs[wall_id]
+                del self._channels_ready[wall_id]
+                self._pending.put(('unsubscribe', self.CHANNEL_PREFIX + wall_id, None))
+
+    def publish_invalidation(self, kind, key):
+        self.client.publish(self.INVALIDATION_CHANNEL, json.dumps({'kind': kind, 'key': key}))
+
+    def on_invalidation(self, callback):
+        # callback(kind, key) runs on the listener thread for writes in any process
+        with self._lock:
+            if not self._invalidation_callbacks:
+                self._pending.put(('subscribe', self.INVALIDATION_CHANNEL, None))
+            self._invalidation_callbacks.append(callback)
+            self._ensure_listener()
+
+    def close(self):
+        self._closed.set()
+        if self._listener is not None:
+            self._listener.join()
+        self._pubsub.close()
+
+    def _ensure_listener(self):
+        if self._listener is None:
+            self._listener = threading.Thread(target=self._listen, name='redis-event-bus', daemon=True)
+            self._listener.start()
+
+    def _listen(self):
+        # the only thread touching the pubsub connection
+        while not self._closed.is_set():
+            try:
+                self._apply_pending()
+            except Exception as ex:
+                print("Event bus error", ex)
+                self._closed.wait(1)
+                continue
+            if not self._pubsub.subscribed:
+                self._closed.wait(self.poll_interval)
+                continue
+            try:
+                message = self._pubsub.get_message(timeout=self.poll_interval)
+            except Exception as ex:
+                print("Event bus error", ex)
+                self._closed.wait(1)
+                continue
+            if message is None or message['type'] != 'message':
+                continue
+            channel = message['channel']
+            if isinstance(channel, bytes):
+                channel = channel.decode('utf-8')
+            payload = json.loads(message['data'])
+            if channel == self.INVALIDATION_CHANNEL:
+                for callback in list(self._invalidation_callbacks):
+                    try:
+                        callback(payload['kind'], payload['key'])
+                    except Exception as ex:
+                        print("Invalidation callback failed", ex)
+                continue
+            self.hub.publish(channel[len(self.CHANNEL_PREFIX):], payload['data'], payload['id'])
+
+
+    def _apply_pending(self):
+        while True:
+            try:
+                action, channel, done = self._pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                getattr(self._pubsub, action)(channel)
+            except Exception:
+                # retry it on the next round, still ahead of what was queued after it
+                retry = [(action, channel, done)]
+                while True:
+                    try:
+                        retry.append(self._pending.get_nowait())
+                    except queue.Empty:
+                        break
+                for item in retry:
+                    self._pending.put(item)
+                raise
+            if done is not None:
+                done.set()
+
+
+def create_event_bus(backend = EVENT_BUS):
+    if backend == 'redis':
+        return RedisEventBus()
+    return LocalEventBus()
@@ -0,0 +1,182 @@
+import asyncio
+import threading
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+
+from config import EVENTS_HOST, EVENTS_PORT, EVENT_QUEUE_SIZE, EVENT_HEARTBEAT_INTERVAL
+from events import Subscription, SSE_HEARTBEAT, SSE_RETRY, format_sse, create_event_bus, parse_last_event_id
+
+# Serves /events from a single asyncio loop, so an idle wall screen costs a
+# socket and a few objects instead of a whole WSGI thread. It shares the event
+# bus with the flask app (embedded mode) or listens to redis on its own
+# (python -m eventstream with EVENT_BUS=redis).
+
+MAX_REQUEST_HEAD = 8192
+
+RESPONSE_HEAD = (
+    "HTTP/1.1 200 OK\r\n"
+    "Content-Type: text/event-stream\r\n"
+    "Cache-Control: no-cache\r\n"
+    "Connection: close\r\n"
+    "Access-Control-Allow-Origin: *\r\n"
+    "X-Accel-Buffering: no\r\n"
+    "\r\n"
+).encode('utf-8')
+
+
+class AsyncSubscription(Subscription):
+    # same contract as Subscription, but the consumer is a coroutine. offer is
+    # called from publisher threads and only wakes the loop when needed
+    def __init__(self, wall_id, loop, maxsize = EVENT_QUEUE_SIZE):
+        self.wall_id = wall_id
+        self.evicted = False
+        self.maxsize = maxsize
+        self.loop = loop
+        self.items = deque()
+        self.ready = asyncio.Event()
+
+    def offer(self, event_id, data):
+        if len(self.items) >= self.maxsize:
+            return False
+        self.items.append((event_id, data))
+        if not self.ready.is_set():
+            self.loop.call_soon_threadsafe(self.ready.set)
+        return True
+
+    def evict(self):
+        self.evicted = True
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    async def frames(self, heartbeat_interval = EVENT_HEARTBEAT_INTERVAL):
+        yield SSE_RETRY
+        while not self.evicted:
+            self.ready.clear()
+            while self.items:
+                event_id, data = self.items.popleft()
+                yield format_sse(event_id, data)
+            try:
+                await asyncio.wait_for(self.ready.wait(), heartbeat_interval)
+            except asyncio.TimeoutError:
+                yield SSE_HEARTBEAT
+
+
+class EventStreamServer:
+    def __init__(self, event_bus, host = EVENTS_HOST, port = EVENTS_PORT):
+        self.event_bus = event_bus
+        self.host = host
+        self.port = port
+        self.connections = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=MAX_REQUEST_HEAD)
+        return self._server
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+
+        lines = head.decode('latin-1').split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            await self._reply(writer, "400 Bad Request")
+            return
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+        url = urlsplit(target)
+        if method != 'GET' or url.path != '/events':
+            await self._reply(writer, "404 Not Found")
+            return
+        args = parse_qs(url.query)
+        wall_id = args.get('w', [None])[0]
+        if not wall_id:
+            await self._reply(writer, "400 Bad Request")
+            return
+        last_event_id = parse_last_event_id(headers.get('last-event-id') or args.get('lastEventId', [None])[0])
+
+        subscription = AsyncSubscription(wall_id, asyncio.get_running_loop())
+        self.event_bus.subscribe(wall_id, last_event_id, subscription)
+        self.connections += 1
+        # a client that hangs up is let go right away, not on the next write
+        watcher = asyncio.ensure_future(self._watch_for_close(reader, subscription))
+        try:
+            writer.write(RESPONSE_HEAD)
+            async for frame in subscription.frames():
+                writer.write(frame.encode('utf-8'))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            watcher.cancel()
+            self.connections -= 1
+            self.event_bus.unsubscribe(subscription)
+            writer.close()
+
+    @staticmethod
+    async def _watch_for_close(reader, subscription):
+        # nothing more is expected after the request head, reading only finds the end
+        try:
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        subscription.evict()
+
+    @staticmethod
+    async def _reply(writer, status):
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode('utf-8'))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+
+def raise_file_limit():
+    # every subscriber is a socket, lift the soft limit as far as we are allowed
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def start_in_thread(event_bus, host = EVENTS_HOST, port = EVENTS_PORT):
+    # run the stream server next to the WSGI app, sharing its event bus
+    raise_file_limit()
+    server = EventStreamServer(event_bus, host, port)
+    started = threading.Event()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        started.set()
+        loop.run_until_complete(server.serve_forever())
+
+    threading.Thread(target=run, name='event-stream', daemon=True).start()
+    started.wait()
+    return server
+
+
+if __name__ == '__main__':
+    raise_file_limit()
+    server = EventStreamServer(create_event_bus())
+    print("Event stream", f"http://{EVENTS_HOST}:{EVENTS_PORT}/events")
+    asyncio.run(server.serve_forever())
@@ -0,0 +1,231 @@
+import os
+import atexit
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from config import IMAGE_CACHE_MEMORY_MB, IMAGE_CACHE_DISK_MB, IMAGE_CACHE_DIR, IMAGE_CACHE_METADATA_ITEMS
+
+# Two tier cache for image bytes: a byte bounded LRU in memory for the hot
+# set, and a larger LRU of files on local disk that are handed to the WSGI
+# server as files (sendfile where the server supports it). Concurrent misses
+# for the same key share one load.
+
+
+class CachedFile:
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ImageCache:
+    def __init__(self, memory_bytes = IMAGE_CACHE_MEMORY_MB * 1024 * 1024,
+                 disk_bytes = IMAGE_CACHE_DISK_MB * 1024 * 1024,
+                 directory = IMAGE_CACHE_DIR,
+                 metadata_items = IMAGE_CACHE_METADATA_ITEMS):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        # items bigger than this skip the memory tier so one upload can't flush it
+        self.memory_item_max = memory_bytes // 8
+        self.metadata_items = metadata_items
+        if disk_bytes > 0:
+            # a directory of our own inside IMAGE_CACHE_DIR, workers sharing it
+            # never touch each other's files and nothing else in it is removed
+            if directory is not None:
+                os.makedirs(directory, exist_ok=True)
+            directory = tempfile.mkdtemp(prefix='livewall-images-', dir=directory)
+            atexit.register(shutil.rmtree, directory, True)
+        self.directory = directory
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict() # key -> bytes
+        self._memory_used = 0
+        self._disk = OrderedDict() # key -> size
+        self._disk_used = 0
+        self._metadata = OrderedDict() # image id -> image
+        self._keys_by_id = {} # image id -> set of byte keys
+        self._flights = {}
+        # a load that started before an invalidation of its image must not
+        # store its result, same as EntityCache
+        self._generation = 0
+        self._invalidated = {} # image id -> generation of its last invalidation
+        self._floor = 0 # loads older than this may have missed an invalidation
+        self.counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'memory_evictions': 0,
+            'disk_evictions': 0,
+            'metadata_hits': 0,
+            'metadata_misses': 0,
+            'invalidations': 0,
+        }
+
+    def get_metadata(self, image_id, loader):
+        with self._lock:
+            image = self._metadata.get(image_id)
+            if image is not None:
+                self._metadata.move_to_end(image_id)
+                self.counters['metadata_hits'] += 1
+                return image
+            self.counters['metadata_misses'] += 1
+            token = self._generation
+        image = self._coalesce(('meta', image_id), lambda: loader(image_id))
+        # don't remember misses, the image may still be on its way in
+        if image is not None:
+            with self._lock:
+                if self._is_stale(image_id, token):
+                    return image
+                self._metadata[image_id] = image
+                self._metadata.move_to_end(image_id)
+                while len(self._metadata) > self.metadata_items:
+                    self._metadata.popitem(last=False)
+        return image
+
+    def get(self, image_id, variant, loader):
+        # returns bytes from memory, or a CachedFile for the disk tier
+        key = (image_id, variant)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return data
+            if key in self._disk:
+                self._disk.move_to_end(key)
+                self.counters['disk_hits'] += 1
+                return CachedFile(self._path(key), self._disk[key])
+            self.counters['misses'] += 1
+            token = self._generation
+        return self._coalesce(key, lambda: self._load(key, loader, token))
+
+    def invalidate(self, image_id):
+        with self._lock:
+            self.counters['invalidations'] += 1
+            self._generation += 1
+            self._invalidated[image_id] = self._generation
+            if len(self._invalidated) > self.metadata_items:
+                # forget the history, and with it every load in flight
+                self._invalidated.clear()
+                self._floor = self._generation
+            # later misses start their own load instead of joining a stale one
+            for key in [key for key in self._flights if image_id in key]:
+                del self._flights[key]
+            self._metadata.pop(image_id, None)
+            for key in self._keys_by_id.pop(image_id, ()):
+                data = self._memory.pop(key, None)
+                if data is not None:
+                    self._memory_used -= len(data)
+                size = self._disk.pop(key, None)
+                if size is not None:
+                    self._disk_used -= size
+                    self._remove_file(key)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['memory_items'] = len(self._memory)
+            stats['memory_bytes'] = self._memory_used
+            stats['disk_items'] = len(self._disk)
+            stats['disk_bytes'] = self._disk_used
+            stats['metadata_items'] = len(self._metadata)
+        return stats
+
+    def _coalesce(self, key, load):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.counters['coalesced'] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = load()
+            return flight.result
+        except BaseException as ex:
+            flight.error = ex
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+
+    def _is_stale(self, image_id, token):
+        return token < self._floor or self._invalidated.get(image_id, -1) > token
+
+    def _load(self, key, loader, token):
+        data = bytes(loader())
+        if self.directory is not None and len(data) <= self.disk_bytes:
+            self._write_file(key, data)
+        with self._lock:
+            if self._is_stale(key[0], token):
+                if key not in self._disk:
+                    self._remove_file(key)
+                return data
+            self._keys_by_id.setdefault(key[0], set()).add(key)
+            if self.directory is not None and len(data) <= self.disk_bytes:
+                if key not in self._disk:
+                    self._disk[key] = len(data)
+                    self._disk_used += len(data)
+                while self._disk_used > self.disk_bytes:
+                    evicted, size = self._disk.popitem(last=False)
+                    self._disk_used -= size
+                    self.counters['disk_evictions'] += 1
+                    self._remove_file(evicted)
+                    self._forget_key(evicted)
+            if len(data) <= self.memory_item_max and key not in self._memory:
+                self._memory[key] = data
+                self._memory_used += len(data)
+                while self._memory_used > self.memory_bytes:
+                    evicted, evicted_data = self._memory.popitem(last=False)
+                    self._memory_used -= len(evicted_data)
+                    self.counters['memory_evictions'] += 1
+                    self._forget_key(evicted)
+            if key not in self._memory and key not in self._disk:
+                # too big for either tier
+                self._forget_key(key)
+        return data
+
+    def _forget_key(self, key):
+        # called with the lock held once a key left a tier
+        if key in self._memory or key in self._disk:
+            return
+        keys = self._keys_by_id.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_id[key[0]]
+
+    def _path(self, key):
+        image_id, variant = key
+        return os.path.join(self.directory, f'{image_id}.{variant}')
+
+    def _write_file(self, key, data):
+        # write then rename, readers never see a partial file
+        path = self._path(key)
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _remove_file(self, key):
+        # open readers keep their handle, unlinking is safe
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
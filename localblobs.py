@@ -0,0 +1,302 @@
+import os
+import hmac
+import json
+import mmap
+import time
+import base64
+import hashlib
+import secrets
+import tempfile
+import threading
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError, ResourceModifiedError
+
+# Blob storage in a local directory, for single node runs and benchmarks
+# without the network. Implements the part of the azure BlobServiceClient /
+# ContainerClient / BlobClient api that BlobService and CleanDatabase use.
+# Reads go through memory mapped files, writes through a temp file and a
+# rename so readers never see half a blob. Signed urls are hmac'ed with a key
+# kept next to the data, and served by the app (see server.local_blob).
+
+COPY_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+def _error(cls, message, status_code):
+    error = cls(message=message)
+    error.status_code = status_code
+    return error
+
+
+class LocalContentSettings:
+    def __init__(self, content_type = None, cache_control = None):
+        self.content_type = content_type
+        self.cache_control = cache_control
+
+
+class LocalBlobProperties:
+    def __init__(self, name, container, size, last_modified, content_settings, etag = None):
+        self.name = name
+        self.container = container
+        self.size = size
+        self.last_modified = last_modified
+        self.content_settings = content_settings
+        self.etag = etag
+
+
+class _Named:
+    def __init__(self, name):
+        self.name = name
+
+
+class FileBlobServiceClient:
+    def __init__(self, root, url_prefix = '/blobs'):
+        self.root = os.path.abspath(root)
+        self.url_prefix = url_prefix.rstrip('/')
+        # makes a conditional delete and a replacing write one step each
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._key = self._load_key()
+
+    def _load_key(self):
+        path = os.path.join(self.root, '.key')
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            key = secrets.token_bytes(32)
+            fd, tmp = tempfile.mkstemp(dir=self.root)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(key)
+            try:
+                # another process may have won the race, use its key
+                os.link(tmp, path)
+            except FileExistsError:
+                pass
+            os.remove(tmp)
+            with open(path, 'rb') as f:
+                return f.read()
+
+    def get_blob_client(self, container, blob):
+        return FileBlobClient(self, container, blob)
+
+    def get_container_client(self, container):
+        return FileContainerClient(self, container)
+
+    def list_containers(self):
+        return [_Named(name) for name in sorted(os.listdir(self.root))
+                if not name.startswith('.') and os.path.isdir(os.path.join(self.root, name))]
+
+    def get_account_information(self):
+        return {'sku_name': 'Local', 'account_kind': 'Filesystem'}
+
+    # signed urls, the local stand-in for sas tokens
+    def _signature(self, container, blob, expires):
+        message = f'{container}/{blob}\n{expires}'.encode('utf-8')
+        return base64.urlsafe_b64encode(hmac.new(self._key, message, hashlib.sha256).digest()).decode('ascii').rstrip('=')
+
+    def signed_url(self, container, blob, expiry):
+        expires = int(expiry.timestamp())
+        return f'{self.url_prefix}/{container}/{quote(blob)}?se={expires}&sig={self._signature(container, blob, expires)}'
+
+    def verify(self, container, blob, expires, signature):
+        try:
+            expires = int(expires)
+        except (TypeError, ValueError):
+            return False
+        if expires < time.time() or not signature:
+            return False
+        return hmac.compare_digest(signature, self._signature(container, blob, expires))
+
+    def _path(self, *parts):
+        # blob names are flat here, refuse anything that could leave the root
+        for part in parts:
+            if not part or part.startswith('.') or '/' in part or '\\' in part or '\0' in part:
+                raise ValueError(f'Invalid blob path {part!r}')
+        return os.path.join(self.root, *parts)
+
+    def _properties_path(self, container, blob):
+        return os.path.join(self.root, '.properties', container, blob + '.json')
+
+    def _blocks_path(self, container, blob):
+        return os.path.join(self.root, '.blocks', container, blob)
+
+
+class FileContainerClient:
+    def __init__(self, service, container):
+        self.service = service
+        self.container_name = container
+
+    def create_container(self):
+        path = self.service._path(self.container_name)
+        if os.path.isdir(path):
+            raise _error(ResourceExistsError, 'The specified container already exists.', 409)
+        os.makedirs(path)
+
+    def list_blobs(self, name_starts_with = None):
+        try:
+            names = sorted(os.listdir(self.service._path(self.container_name)))
+        except FileNotFoundError:
+            return []
+        return [_Named(name) for name in names
+                if not name.startswith('.') and (name_starts_with is None or name.startswith(name_starts_with))]
+
+    def delete_blobs(self, *blobs, **kwargs):
+        deleted = []
+        for blob in blobs:
+            name = getattr(blob, 'name', blob)
+            try:
+                FileBlobClient(self.service, self.container_name, name).delete_blob()
+                deleted.append(name)
+            except ResourceNotFoundError:
+                pass
+        return deleted
+
+
+class FileBlobDownloader:
+    def __init__(self, path, offset, length, properties):
+        self.path = path
+        self.properties = properties
+        self.size = properties.size
+        self.offset = offset or 0
+        end = self.size if length is None else min(self.offset + length, self.size)
+        self.length = max(end - self.offset, 0)
+
+    def readall(self):
+        return b''.join(self.chunks())
+
+    def readinto(self, stream):
+        for chunk in self.chunks():
+            stream.write(chunk)
+        return self.length
+
+    def chunks(self, chunk_size = COPY_CHUNK_BYTES):
+        if self.length == 0:
+            return
+        with open(self.path, 'rb') as f:
+            # the mapping stays valid even if the blob is replaced or deleted meanwhile
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for start in range(self.offset, self.offset + self.length, chunk_size):
+                    yield mapped[start:min(start + chunk_size, self.offset + self.length)]
+
+
+class FileBlobClient:
+    def __init__(self, service, container, blob):
+        self.service = service
+        self.container_name = container
+        self.blob_name = blob
+        self.path = service._path(container, blob)
+
+    @property
+    def url(self):
+        return f'{self.service.url_prefix}/{self.container_name}/{quote(self.blob_name)}'
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def upload_blob(self, data, overwrite = False, content_settings = None, **kwargs):
+        if not overwrite and self.exists():
+            raise _error(ResourceExistsError, 'The specified blob already exists.', 409)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._write(lambda f: self._copy(data, f), content_settings)
+        return {'last_modified': datetime.now(timezone.utc)}
+
+    def stage_block(self, block_id, data, length = None, **kwargs):
+        directory = self.service._blocks_path(self.container_name, self.blob_name)
+        os.makedirs(directory, exist_ok=True)
+        name = base64.urlsafe_b64encode(block_id.encode('utf-8')).decode('ascii')
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            self._copy(data, f)
+        os.replace(tmp, os.path.join(directory, name))
+        return {}
+
+    def commit_block_list(self, block_list, content_settings = None, **kwargs):
+        directory = self.service._blocks_path(self.container_name, self.blob_name)
+        paths = []
+        for block in block_list:
+            block_id = getattr(block, 'id', None) or getattr(block, 'block_id', block)
+            path = os.path.join(directory, base64.urlsafe_b64encode(block_id.encode('utf-8')).decode('ascii'))
+            if not os.path.isfile(path):
+                raise _error(ResourceNotFoundError, f'The specified block list is invalid, missing {block_id}.', 400)
+            paths.append(path)
+
+        def write(f):
+            for path in paths:
+                with open(path, 'rb') as block:
+                    self._copy(block, f)
+        self._write(write, content_settings)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+        return {'last_modified': datetime.now(timezone.utc)}
+
+    def download_blob(self, offset = None, length = None, **kwargs):
+        return FileBlobDownloader(self.path, offset, length, self.get_blob_properties())
+
+    def get_blob_properties(self, **kwargs):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            raise _error(ResourceNotFoundError, 'The specified blob does not exist.', 404)
+        settings = {}
+        try:
+            with open(self.service._properties_path(self.container_name, self.blob_name)) as f:
+                settings = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+        return LocalBlobProperties(self.blob_name, self.container_name, stat.st_size,
+                                   datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+                                   LocalContentSettings(settings.get('content_type'), settings.get('cache_control')),
+                                   self._etag(stat))
+
+    @staticmethod
+    def _etag(stat):
+        # every write renames a new file into place, so the inode changes with the content
+        return f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}"'
+
+    def delete_blob(self, etag = None, match_condition = None, **kwargs):
+        with self.service._lock:
+            try:
+                if match_condition == MatchConditions.IfNotModified and self._etag(os.stat(self.path)) != etag:
+                    raise _error(ResourceModifiedError, 'The condition specified using HTTP conditional header(s) is not met.', 412)
+                os.remove(self.path)
+            except FileNotFoundError:
+                raise _error(ResourceNotFoundError, 'The specified blob does not exist.', 404)
+            try:
+                os.remove(self.service._properties_path(self.container_name, self.blob_name))
+            except FileNotFoundError:
+                pass
+
+    def _write(self, write, content_settings):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            with self.service._lock:
+                if content_settings is not None:
+                    properties_path = self.service._properties_path(self.container_name, self.blob_name)
+                    os.makedirs(os.path.dirname(properties_path), exist_ok=True)
+                    with open(properties_path, 'w') as f:
+                        json.dump({'content_type': content_settings.content_type,
+                                   'cache_control': content_settings.cache_control}, f)
+                os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    @staticmethod
+    def _copy(data, f):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            f.write(data)
+            return
+        while True:
+            chunk = data.read(COPY_CHUNK_BYTES)
+            if not chunk:
+                return
+            f.write(chunk)
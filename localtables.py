@@ -0,0 +1,471 @@
+import os
+import re
+import json
+import uuid
+import base64
+import sqlite3
+import threading
+from enum import Enum
+from datetime import datetime, timezone
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError, ResourceModifiedError
+from azure.data.tables import TableTransactionError
+
+# Table storage in an embedded sqlite database, for single node runs and
+# benchmarks without the network. It implements the part of the azure
+# TableServiceClient / TableClient api the data layers use, with the same
+# semantics: entities are keyed and ordered by (PartitionKey, RowKey), etags
+# guard conditional writes, transactions are atomic within one partition and
+# queries take the same OData filters and continuation tokens.
+
+MAX_TRANSACTION_OPERATIONS = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tables (name TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS entities (
+    table_name TEXT NOT NULL,
+    pk TEXT NOT NULL,
+    rk TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    ts TEXT NOT NULL,
+    props TEXT NOT NULL,
+    PRIMARY KEY (table_name, pk, rk)
+) WITHOUT ROWID;
+"""
+
+
+def _error(cls, message, status_code):
+    # the data layers look at status_code like they would for a service response
+    error = cls(message=message)
+    error.status_code = status_code
+    return error
+
+
+class LocalTableEntity(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metadata = {}
+
+
+# property values are stored as [type, value] so they compare like the service does
+def _encode_value(value):
+    if isinstance(value, bool):
+        return ['b', value]
+    if isinstance(value, int):
+        return ['i', value]
+    if isinstance(value, float):
+        return ['f', value]
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return ['dt', value.astimezone(timezone.utc).isoformat()]
+    if isinstance(value, bytes):
+        return ['bin', base64.b64encode(value).decode('ascii')]
+    if isinstance(value, (str, Enum, uuid.UUID)):
+        return ['s', str(value)]
+    raise TypeError(f'Type not supported when sending data to the service: {type(value)}.')
+
+def _decode_value(encoded):
+    kind, value = encoded
+    if kind == 'dt':
+        return datetime.fromisoformat(value)
+    if kind == 'bin':
+        return base64.b64decode(value)
+    return value
+
+def _encode_props(entity):
+    # like the service, None values are not stored
+    return json.dumps({k: _encode_value(v) for k, v in entity.items()
+                       if k not in ('PartitionKey', 'RowKey') and v is not None})
+
+
+# OData filters, e.g. "PartitionKey eq @wall_id and (RowKey gt 'a' or not (RowKey eq 'b'))"
+_TOKEN = re.compile(r"""
+    \s*(?:
+      (?P<string>'(?:[^']|'')*')
+    | (?P<datetime>datetime'[^']*')
+    | (?P<param>@\w+)
+    | (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?L?)
+    | (?P<paren>[()])
+    | (?P<word>[A-Za-z_]\w*)
+    )""", re.VERBOSE)
+
+_COMPARISONS = {'eq': '=', 'ne': '!=', 'gt': '>', 'ge': '>=', 'lt': '<', 'le': '<='}
+_KEY_COLUMNS = {'PartitionKey': 'pk', 'RowKey': 'rk', 'Timestamp': 'ts'}
+
+
+class FilterError(ValueError):
+    pass
+
+
+def _tokenize(query):
+    tokens = []
+    position = 0
+    query = query.rstrip()
+    while position < len(query):
+        match = _TOKEN.match(query, position)
+        if match is None:
+            raise FilterError(f'Cannot parse filter at {query[position:]!r}')
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        position = match.end()
+    return tokens
+
+
+class _FilterCompiler:
+    # recursive descent: or > and > not > comparison, translated to a sql
+    # expression with bound arguments
+    def __init__(self, query, parameters):
+        self.tokens = _tokenize(query)
+        self.parameters = parameters or {}
+        self.position = 0
+        self.args = []
+
+    def compile(self):
+        sql = self._or()
+        if self.position != len(self.tokens):
+            raise FilterError(f'Unexpected {self.tokens[self.position][1]!r} in filter')
+        return sql, self.args
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def _take(self):
+        token = self._peek()
+        if token[0] is None:
+            raise FilterError('Unexpected end of filter')
+        self.position += 1
+        return token
+
+    def _or(self):
+        sql = self._and()
+        while self._peek() == ('word', 'or'):
+            self._take()
+            sql = f'({sql} OR {self._and()})'
+        return sql
+
+    def _and(self):
+        sql = self._not()
+        while self._peek() == ('word', 'and'):
+            self._take()
+            sql = f'({sql} AND {self._not()})'
+        return sql
+
+    def _not(self):
+        if self._peek() == ('word', 'not'):
+            self._take()
+            return f'(NOT {self._not()})'
+        if self._peek() == ('paren', '('):
+            self._take()
+            sql = self._or()
+            if self._take() != ('paren', ')'):
+                raise FilterError('Missing ) in filter')
+            return sql
+        return self._comparison()
+
+    def _comparison(self):
+        kind, name = self._take()
+        if kind != 'word':
+            raise FilterError(f'Expected a property name, got {name!r}')
+        kind, operator = self._take()
+        if operator not in _COMPARISONS:
+            raise FilterError(f'Unknown operator {operator!r}')
+        value = self._value()
+        if isinstance(value, datetime):
+            value = _encode_value(value)[1]
+        if name in _KEY_COLUMNS:
+            column = _KEY_COLUMNS[name]
+        else:
+            # property values sit in the json document as [type, value]
+            column = "json_extract(props, ?)"
+            self.args.append(f'$."{name}"[1]')
+        self.args.append(value)
+        return f'{column} {_COMPARISONS[operator]} ?'
+
+    def _value(self):
+        kind, text = self._take()
+        if kind == 'string':
+            return text[1:-1].replace("''", "'")
+        if kind == 'datetime':
+            return datetime.fromisoformat(text[9:-1].replace('Z', '+00:00'))
+        if kind == 'number':
+            text = text.rstrip('L')
+            return float(text) if any(c in text for c in '.eE') else int(text)
+        if kind == 'param':
+            name = text[1:]
+            if name not in self.parameters:
+                raise FilterError(f'Missing parameter {name}')
+            value = self.parameters[name]
+            return int(value) if isinstance(value, bool) else value
+        if kind == 'word' and text in ('true', 'false'):
+            return 1 if text == 'true' else 0
+        raise FilterError(f'Expected a value, got {text!r}')
+
+
+def compile_filter(query, parameters = None):
+    # returns (sql, args) for the where clause
+    return _FilterCompiler(query, parameters).compile()
+
+
+class _PageIterator:
+    # mimics azure.core.paging: iterates pages, continuation_token points at the next one
+    def __init__(self, fetch, continuation_token):
+        self._fetch = fetch
+        self.continuation_token = continuation_token
+        self._started = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._started and self.continuation_token is None:
+            raise StopIteration()
+        self._started = True
+        entities, self.continuation_token = self._fetch(self.continuation_token)
+        return iter(entities)
+
+
+class _ItemPaged:
+    def __init__(self, fetch):
+        self._fetch = fetch
+
+    def by_page(self, continuation_token = None):
+        return _PageIterator(self._fetch, continuation_token)
+
+    def __iter__(self):
+        for page in self.by_page():
+            yield from page
+
+
+class _Table:
+    # the service's table listing entries
+    def __init__(self, name):
+        self.name = name
+
+
+class SqliteTableServiceClient:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._local = threading.local()
+        self._tables = {}
+        self._tables_lock = threading.Lock()
+        self.connection().db.executescript(SCHEMA)
+
+    def connection(self):
+        # sqlite connections can't be shared between threads, one per thread
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+        return _Transaction(db)
+
+    def get_table_client(self, table_name):
+        with self._tables_lock:
+            client = self._tables.get(table_name)
+            if client is None:
+                client = self._tables[table_name] = SqliteTableClient(self, table_name)
+        return client
+
+    def create_table(self, table_name):
+        with self.connection() as db:
+            if db.execute('INSERT OR IGNORE INTO tables (name) VALUES (?)', (table_name,)).rowcount == 0:
+                raise _error(ResourceExistsError, f'The table {table_name} already exists', 409)
+        return self.get_table_client(table_name)
+
+    def create_table_if_not_exists(self, table_name):
+        with self.connection() as db:
+            db.execute('INSERT OR IGNORE INTO tables (name) VALUES (?)', (table_name,))
+        return self.get_table_client(table_name)
+
+    def delete_table(self, table_name):
+        with self.connection() as db:
+            db.execute('DELETE FROM entities WHERE table_name = ?', (table_name,))
+            db.execute('DELETE FROM tables WHERE name = ?', (table_name,))
+
+    def list_tables(self):
+        with self.connection() as db:
+            rows = db.execute('SELECT name FROM tables ORDER BY name').fetchall()
+        return [_Table(name) for name, in rows]
+
+
+class _Transaction:
+    # BEGIN IMMEDIATE takes the write lock up front, so a read-check-write
+    # (etags, transactions) can't interleave with another writer
+    def __init__(self, db, write = False):
+        self.db = db
+        self.write = write
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE' if self.write else 'BEGIN')
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+class SqliteTableClient:
+    def __init__(self, service, table_name):
+        self.service = service
+        self.table_name = table_name
+        self._registered = False
+
+    def _read(self):
+        return self.service.connection()
+
+    def _write(self):
+        transaction = self.service.connection()
+        transaction.write = True
+        if not self._registered:
+            # tables spring into existence on first write, like a pre-created azure table
+            self.service.create_table_if_not_exists(self.table_name)
+            self._registered = True
+        return transaction
+
+    def _entity(self, pk, rk, etag, ts, props, select = None):
+        values = {k: _decode_value(v) for k, v in json.loads(props).items()}
+        entity = LocalTableEntity()
+        if select is None:
+            entity['PartitionKey'] = pk
+            entity['RowKey'] = rk
+            entity.update(values)
+        else:
+            for name in select:
+                if name == 'PartitionKey':
+                    entity[name] = pk
+                elif name == 'RowKey':
+                    entity[name] = rk
+                elif name in values:
+                    entity[name] = values[name]
+        entity.metadata = {'etag': etag, 'timestamp': datetime.fromisoformat(ts)}
+        return entity
+
+    @staticmethod
+    def _new_etag():
+        now = datetime.now(timezone.utc)
+        return f'W/"datetime\'{now.isoformat()}\'-{uuid.uuid4().hex[:8]}"', now.isoformat()
+
+    def _get_row(self, db, pk, rk):
+        return db.execute('SELECT etag, ts, props FROM entities WHERE table_name = ? AND pk = ? AND rk = ?',
+                          (self.table_name, pk, rk)).fetchone()
+
+    def get_entity(self, partition_key, row_key, select = None, **kwargs):
+        with self._read() as db:
+            row = self._get_row(db, partition_key, row_key)
+        if row is None:
+            raise _error(ResourceNotFoundError, 'The specified resource does not exist.', 404)
+        return self._entity(partition_key, row_key, *row, select=[select] if isinstance(select, str) else select)
+
+    def create_entity(self, entity, **kwargs):
+        with self._write() as db:
+            return self._apply(db, 'create', entity)
+
+    def upsert_entity(self, entity, mode = 'merge', **kwargs):
+        with self._write() as db:
+            return self._apply(db, 'upsert', entity, {'mode': mode})
+
+    def update_entity(self, entity, mode = 'merge', etag = None, match_condition = None, **kwargs):
+        with self._write() as db:
+            return self._apply(db, 'update', entity, {'mode': mode, 'etag': etag, 'match_condition': match_condition})
+
+    def delete_entity(self, *args, **kwargs):
+        # (partition_key, row_key) or (entity), like the sdk
+        if args and isinstance(args[0], dict):
+            entity = args[0]
+        elif 'entity' in kwargs:
+            entity = kwargs.pop('entity')
+        else:
+            keys = list(args) + [kwargs.pop('partition_key', None), kwargs.pop('row_key', None)]
+            keys = [k for k in keys if k is not None]
+            entity = {'PartitionKey': keys[0], 'RowKey': keys[1]}
+        with self._write() as db:
+            self._apply(db, 'delete', entity, kwargs)
+
+    def submit_transaction(self, operations, **kwargs):
+        operations = list(operations)
+        if len(operations) > MAX_TRANSACTION_OPERATIONS:
+            raise _error(TableTransactionError, f'0:The batch request contains more than {MAX_TRANSACTION_OPERATIONS} operations.', 400)
+        if len({op[1]['PartitionKey'] for op in operations}) > 1:
+            raise _error(TableTransactionError, '0:All operations in a batch must share the PartitionKey.', 400)
+        results = []
+        # any failure rolls back the whole batch
+        with self._write() as db:
+            for index, operation in enumerate(operations):
+                action = getattr(operation[0], 'value', operation[0]).lower()
+                options = operation[2] if len(operation) > 2 else {}
+                try:
+                    results.append(self._apply(db, action, operation[1], options, strict_delete=True))
+                except (ResourceNotFoundError, ResourceExistsError, ResourceModifiedError) as ex:
+                    raise _error(TableTransactionError, f'{index}:{ex.message}', ex.status_code) from ex
+        return results
+
+    def _apply(self, db, action, entity, options = None, strict_delete = False):
+        options = options or {}
+        pk, rk = entity['PartitionKey'], entity['RowKey']
+        row = self._get_row(db, pk, rk)
+        etag, ts = self._new_etag()
+        mode = str(getattr(options.get('mode'), 'value', options.get('mode') or 'merge')).lower()
+
+        if options.get('match_condition') == MatchConditions.IfNotModified and action in ('update', 'delete'):
+            if row is not None and row[0] != options.get('etag'):
+                raise _error(ResourceModifiedError, 'The update condition specified in the request was not satisfied.', 412)
+
+        if action == 'delete':
+            if row is None:
+                # the sdk ignores deletes of missing entities, a batch does not
+                if strict_delete or options.get('match_condition') == MatchConditions.IfNotModified:
+                    raise _error(ResourceNotFoundError, 'The specified resource does not exist.', 404)
+                return {}
+            db.execute('DELETE FROM entities WHERE table_name = ? AND pk = ? AND rk = ?', (self.table_name, pk, rk))
+            return {}
+        if action == 'create':
+            if row is not None:
+                raise _error(ResourceExistsError, 'The specified entity already exists.', 409)
+            props = _encode_props(entity)
+        elif action in ('update', 'upsert'):
+            if row is None and action == 'update':
+                raise _error(ResourceNotFoundError, 'The specified resource does not exist.', 404)
+            if row is not None and mode == 'merge':
+                merged = json.loads(row[2])
+                merged.update(json.loads(_encode_props(entity)))
+                props = json.dumps(merged)
+            else:
+                props = _encode_props(entity)
+        else:
+            raise ValueError(f'Unknown operation {action}')
+        db.execute('INSERT OR REPLACE INTO entities (table_name, pk, rk, etag, ts, props) VALUES (?, ?, ?, ?, ?, ?)',
+                   (self.table_name, pk, rk, etag, ts, props))
+        return {'etag': etag, 'date': datetime.fromisoformat(ts)}
+
+    def query_entities(self, query_filter, results_per_page = None, select = None, parameters = None, **kwargs):
+        where, args = compile_filter(query_filter, parameters)
+        return self._paged(where, args, results_per_page, select)
+
+    def list_entities(self, results_per_page = None, select = None, **kwargs):
+        return self._paged('1', [], results_per_page, select)
+
+    def _paged(self, where, args, results_per_page, select):
+        if isinstance(select, str):
+            select = [s.strip() for s in select.split(',')]
+        page_size = results_per_page or 1000
+
+        def fetch(token):
+            sql = f'SELECT pk, rk, etag, ts, props FROM entities WHERE table_name = ? AND ({where})'
+            sql_args = [self.table_name] + list(args)
+            if token:
+                sql += ' AND (pk, rk) >= (?, ?)'
+                sql_args += [token['PartitionKey'], token['RowKey']]
+            sql += ' ORDER BY pk, rk LIMIT ?'
+            sql_args.append(page_size + 1)
+            with self._read() as db:
+                rows = db.execute(sql, sql_args).fetchall()
+            next_token = None
+            if len(rows) > page_size:
+                next_token = {'PartitionKey': rows[page_size][0], 'RowKey': rows[page_size][1]}
+            return [self._entity(*row, select=select) for row in rows[:page_size]], next_token
+
+        return _ItemPaged(fetch)
@@ -0,0 +1,180 @@
+import time
+import threading
+from bisect import bisect_left
+
+# In-process metrics in the prometheus text format, served on /metrics.
+# Counters and histograms are plain dicts keyed by the label values behind
+# one lock per metric, an observation costs a bisect and a few additions.
+# Gauges are read from their source when scraped.
+
+# seconds, local stores answer in well under a millisecond
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra = None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {} # label values -> count
+
+    def inc(self, *labels, amount = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in sorted(values):
+            yield self.name, _labels(self.label_names, labels), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {} # label values -> [count per bucket..., count above, sum]
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self._values.items()]
+        for labels, counts in sorted(values):
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                yield self.name + '_bucket', _labels(self.label_names, labels, f'le="{_number(bound)}"'), total
+            yield self.name + '_sum', _labels(self.label_names, labels), counts[-1]
+            yield self.name + '_count', _labels(self.label_names, labels), total
+
+
+class Gauge:
+    # collect() returns a number, or {label values: number} for labelled gauges
+    type = 'gauge'
+
+    def __init__(self, name, help, collect, labels = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.collect = collect
+
+    def samples(self):
+        try:
+            values = self.collect()
+        except Exception as ex:
+            # a broken source shouldn't take the whole page down
+            print("Metric failed", self.name, ex)
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            if not isinstance(labels, tuple):
+                labels = (labels,)
+            yield self.name, _labels(self.label_names, labels), value
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels = ()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, collect, labels = ()):
+        return self.register(Gauge(name, help, collect, labels))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+http_requests = registry.counter(
+    'livewall_http_requests_total', 'Requests handled, by route and status.', ('route', 'method', 'status'))
+http_request_seconds = registry.histogram(
+    'livewall_http_request_duration_seconds', 'Time until the response is handed to the server.', ('route', 'method'))
+dependency_calls = registry.counter(
+    'livewall_dependency_calls_total', 'Calls to storage and external services, by outcome.',
+    ('dependency', 'operation', 'outcome'))
+dependency_seconds = registry.histogram(
+    'livewall_dependency_duration_seconds', 'Time spent in calls to storage and external services.',
+    ('dependency', 'operation'))
+
+
+class _Timing:
+    __slots__ = ('dependency', 'operation', 'started')
+
+    def __init__(self, dependency, operation):
+        self.dependency = dependency
+        self.operation = operation
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is StopIteration:
+            # the end of a pager, nothing was fetched
+            return False
+        dependency_seconds.observe(time.perf_counter() - self.started, self.dependency, self.operation)
+        # the outcome is the exception class, e.g. ResourceNotFoundError for a miss
+        dependency_calls.inc(self.dependency, self.operation, 'ok' if exc_type is None else exc_type.__name__)
+        return False
+
+def timed(dependency, operation):
+    # with timed('blob', 'get'): ...
+    return _Timing(dependency, operation)
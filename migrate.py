@@ -0,0 +1,52 @@
+import sys
+import time
+
+from datalayers import WallDataLayer, ImageDataLayer
+from models import WallStats, WallStatus
+
+# Backfills the time ordered image index, the per-wall statistics and the expiry buckets for walls
+# created before they existed. Safe to run more than once, but don't run the
+# stats step while the walls are taking uploads.
+# Usage: python migrate.py [wall_id ...]
+
+def migrate_image_index(wall_ids):
+    idl = ImageDataLayer()
+    started = time.time()
+    total = 0
+    for n, wall_id in enumerate(wall_ids, start=1):
+        count = idl.migrate_wall_index(wall_id)
+        total += count
+        print(f"[{n}] {wall_id}: {count} images indexed")
+    print(f"Indexed {total} images in {time.time() - started:.1f}s")
+
+def migrate_wall_stats(wall_ids):
+    # only visible images count, like on upload. images stored before sizes
+    # were recorded count as 0 bytes
+    idl = ImageDataLayer()
+    wdl = WallDataLayer()
+    for n, wall_id in enumerate(wall_ids, start=1):
+        images = [image for image in idl.list_images_for_wall(wall_id) if not image['hidden']]
+        stats = WallStats(wall_id)
+        stats.num_images = len(images)
+        stats.bytes_stored = sum(image['size'] for image in images)
+        if images:
+            stats.first_upload = min(image['ts'] for image in images)
+            stats.last_upload = max(image['ts'] for image in images)
+        # the markers let later deletes take these images off the stats
+        wdl.set_stats(stats, [image['id'] for image in images])
+        print(f"[{n}] {wall_id}: {stats.num_images} images counted")
+
+def migrate_expiry_index(wall_ids):
+    # temporary walls created before the expiry buckets existed
+    wdl = WallDataLayer()
+    for wall_id in wall_ids:
+        wall = wdl.get_by_id(wall_id)
+        if wall is not None and wall.status == WallStatus.NEW:
+            wdl.table_client.upsert_entity(entity={'PartitionKey': wdl.expiry_bucket(wall.created), 'RowKey': wall.id})
+            print(f"{wall_id}: added to {wdl.expiry_bucket(wall.created)}")
+
+if __name__ == '__main__':
+    wall_ids = sys.argv[1:] or [wall.id for wall in WallDataLayer().iter_walls()]
+    migrate_image_index(wall_ids)
+    migrate_wall_stats(wall_ids)
+    migrate_expiry_index(wall_ids)
@@ -14,7 +14,34 @@ def normalize_datetime(value):
     val =  datetime.fromisoformat(value.isoformat())
     return val
 
+def isoformat(value):
+    # timestamps that were never read are written back as they came
+    return value.isoformat() if isinstance(value, datetime) else value
+
+class LazyDatetime:
+    # keeps what the table returned (usually an iso string) in the _<name>
+    # slot and only parses it when somebody reads it. listings mostly don't
+    def __set_name__(self, owner, name):
+        self.slot = '_' + name
+
+    def __get__(self, obj, objtype = None):
+        if obj is None:
+            return self
+        value = getattr(obj, self.slot)
+        if value is not None and not isinstance(value, datetime):
+            value = normalize_datetime(value)
+            setattr(obj, self.slot, value)
+        return value
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
 class User:
+    __slots__ = ('id', 'email', 'validation_code', 'validated', '_created', '_modified')
+
+    created = LazyDatetime()
+    modified = LazyDatetime()
+
     def __init__(self, email):
         self.id = shortuuid.uuid()
         self.email = email
@@ -29,8 +56,8 @@ class User:
             'email': self.email,
             'validation_code': self.validation_code,
             'validated': self.validated,
-            'created': self.created.isoformat(),
-            'modified': self.modified.isoformat()
+            'created': isoformat(self._created),
+            'modified': isoformat(self._modified)
         }
     
     def from_dict(self, data):
@@ -38,22 +65,32 @@ class User:
         self.email = data['email']
         self.validation_code = data['validation_code']
         self.validated = data['validated']
-        self.created = normalize_datetime(data['created'])
-        self.modified = normalize_datetime(data['modified'])
+        self._created = data['created']
+        self._modified = data['modified']
 
     @classmethod
     def create_from_entity(cls, data):
-        user = cls(data['email'])
+        # skips __init__, from_dict overwrites its fresh ids, codes and clocks anyway
+        user = cls.__new__(cls)
         user.from_dict(data)
         return user
 
 class Image:
+    __slots__ = ('id', 'wall_id', 'data', 'blob_url', 'content_type', 'size', 'hidden', 'blob_name',
+                 'owner_key', 'timestamp', '_created', '_modified')
+
+    created = LazyDatetime()
+    modified = LazyDatetime()
+
     def __init__(self, id=None, wall_id=None, data=None, content_type=None):
         self.id = id
         self.wall_id = wall_id
         self.data = data
         self.blob_url = None
         self.content_type = content_type
+        self.size = len(data) if data is not None else 0
+        self.hidden = False # kept off the wall, e.g. until moderation approves it
+        self.blob_name = id # the original in blob storage, shared by identical uploads
         self.owner_key = shortuuid.uuid()
         self.timestamp = time.time()
         self.created = datetime.now(tz=timezone.utc)
@@ -65,10 +102,13 @@ class Image:
             'wall_id': self.wall_id,
             'blob_url': self.blob_url,
             'content_type': self.content_type,
+            'size': self.size,
+            'hidden': self.hidden,
+            'blob_name': self.blob_name,
             'owner_key': self.owner_key,
             'timestamp': self.timestamp,
-            'created': self.created.isoformat(),
-            'modified': self.modified.isoformat()
+            'created': isoformat(self._created),
+            'modified': isoformat(self._modified)
         }
     
     def from_dict(self, data):
@@ -76,18 +116,64 @@ class Image:
         self.wall_id = data['wall_id']
         self.blob_url = data['blob_url']
         self.content_type = data['content_type']
+        self.size = data.get('size', 0)
+        self.hidden = data.get('hidden', False)
+        # images from before content addressing are stored under their id
+        self.blob_name = data.get('blob_name') or self.id
         self.owner_key = data['owner_key']
         self.timestamp = data['timestamp']
-        self.created = normalize_datetime(data['created'])
-        self.modified = normalize_datetime(data['modified'])
+        self._created = data['created']
+        self._modified = data['modified']
         self.data = None
 
+    @classmethod
+    def create_from_entity(cls, data):
+        image = cls.__new__(cls)
+        image.from_dict(data)
+        return image
+
+class WallStats:
+    __slots__ = ('wall_id', 'num_images', 'bytes_stored', 'first_upload', 'last_upload')
+
+    def __init__(self, wall_id):
+        self.wall_id = wall_id
+        self.num_images = 0
+        self.bytes_stored = 0
+        self.first_upload = None
+        self.last_upload = None
+
+    def to_dict(self):
+        return {
+            'wall_id': self.wall_id,
+            'num_images': self.num_images,
+            'bytes_stored': self.bytes_stored,
+            'first_upload': self.first_upload,
+            'last_upload': self.last_upload
+        }
+
+    def from_dict(self, data):
+        self.wall_id = data['wall_id']
+        self.num_images = data['num_images']
+        self.bytes_stored = data['bytes_stored']
+        self.first_upload = data.get('first_upload')
+        self.last_upload = data.get('last_upload')
+
 class WallStatus(Enum):
     NEW = 'new'
     OWNED = 'owned'
     PREMIUM = 'premium'
 
+# WallStatus(value) goes through the enum machinery, a dict lookup doesn't
+WALL_STATUSES = {status.value: status for status in WallStatus}
+
 class Wall:
+    # stats, num_images and images are only filled in for the user page
+    __slots__ = ('id', 'owner_key', 'image_ids', 'owner_email', 'status', '_created', '_modified',
+                 'stats', 'num_images', 'images')
+
+    created = LazyDatetime()
+    modified = LazyDatetime()
+
     def __init__(self, id=None):
         if id is None:
             id = shortuuid.uuid()
@@ -107,22 +193,22 @@ class Wall:
             'image_ids': self.image_ids,
             'owner_email': self.owner_email,
             'status': self.status.value,
-            'created': self.created.isoformat(),
-            'modified': self.modified.isoformat()
+            'created': isoformat(self._created),
+            'modified': isoformat(self._modified)
         }
     
     def from_dict(self, data):
         self.id = data['id']
         self.owner_key = data['owner_key']
-        self.image_ids = data['image_ids'] if 'image_ids' in data else []
-        self.owner_email = data['owner_email'] if 'owner_email' in data else None
-        self.status = WallStatus(data['status'])
-        self.created = normalize_datetime(data['created'])
-        self.modified = normalize_datetime(data['modified'])
+        self.image_ids = data.get('image_ids', [])
+        self.owner_email = data.get('owner_email')
+        self.status = WALL_STATUSES[data['status']]
+        self._created = data['created']
+        self._modified = data['modified']
 
     @classmethod
     def create_from_entity(cls, data):
-        wall = cls(data['id'])
+        wall = cls.__new__(cls)
         wall.from_dict(data)
         return wall
 
@@ -132,6 +218,8 @@ class EventType(Enum):
     UPDATE = 'update'
 
 class Event:
+    __slots__ = ('type', 'image', 'wall_id', 'timestamp')
+
     def __init__(self, type : EventType, image : Image, wall_id : str):
         self.type = type
         self.image = image
@@ -143,4 +231,4 @@ class Event:
         if self.image is None:
             return f'{{"type": "{self.type.value}"}}'
         else:
-            return f'{{"type": "{self.type.value}", "id": "{self.image.id}", "url": "/i/{self.image.id}?t={self.image.timestamp}"}}'
\ No newline at end of file
+            return f'{{"type": "{self.type.value}", "id": "{self.image.id}", "url": "/i/{self.image.id}?size=wall&t={self.image.timestamp}"}}'
\ No newline at end of file
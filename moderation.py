@@ -0,0 +1,124 @@
+import threading
+from collections import OrderedDict
+from azure.core.exceptions import ResourceNotFoundError
+
+from config import MODERATION_QUEUE, MODERATION_QUEUE_NAME, MODERATION_WORKERS, MODERATION_MAX_ATTEMPTS
+from config import MODERATION_MAX_EDGE, MODERATION_CACHE_ITEMS
+from models import Image
+from pipeline import Pipeline, create_job_queue
+
+# Upload stage that runs after the image rows are written. New images start
+# hidden; a worker downscales the original to a small jpeg (the safety api
+# doesn't take webp, and fewer pixels answer faster), asks the content safety
+# endpoint and reports the verdict. Verdicts are remembered by the blob name,
+# which is the hash of the original, so the same photo posted again is not
+# downloaded or analyzed twice.
+
+
+# the endpoint refused the image itself, asking again won't help
+FINAL_STATUS_CODES = (400, 413, 415)
+
+
+class VerdictCache:
+    def __init__(self, max_items = MODERATION_CACHE_ITEMS):
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._verdicts = OrderedDict() # blob name of the original -> safe
+        self.counters = {'hits': 0, 'misses': 0, 'safe': 0, 'unsafe': 0}
+
+    def get(self, digest):
+        with self._lock:
+            safe = self._verdicts.get(digest)
+            if safe is None:
+                self.counters['misses'] += 1
+                return None
+            self._verdicts.move_to_end(digest)
+            self.counters['hits'] += 1
+            return safe
+
+    def put(self, digest, safe):
+        with self._lock:
+            self._verdicts[digest] = safe
+            self._verdicts.move_to_end(digest)
+            while len(self._verdicts) > self.max_items:
+                self._verdicts.popitem(last=False)
+
+    def count(self, safe):
+        with self._lock:
+            self.counters['safe' if safe else 'unsafe'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['items'] = len(self._verdicts)
+        return stats
+
+
+def moderation_preview(original, max_edge = MODERATION_MAX_EDGE):
+    from services import RenditionService
+    return RenditionService.render(original, max_edge, quality=85, format='JPEG')
+
+
+class ModerationStage:
+    def __init__(self, load_original, on_verdict, service = None, verdicts = None, job_queue = None,
+                 workers = MODERATION_WORKERS, max_attempts = MODERATION_MAX_ATTEMPTS):
+        # load_original(image) returns the uploaded bytes,
+        # on_verdict(image, safe) shows or keeps hiding the image
+        if service is None:
+            from services import ModerationService
+            service = ModerationService()
+        self.load_original = load_original
+        self.on_verdict = on_verdict
+        self.service = service
+        self.verdicts = verdicts if verdicts is not None else VerdictCache()
+        if job_queue is None:
+            job_queue = create_job_queue(MODERATION_QUEUE, MODERATION_QUEUE_NAME)
+        self.pipeline = Pipeline(self._moderate, job_queue, workers, max_attempts, name='moderation')
+
+    def start(self):
+        self.pipeline.start()
+        return self
+
+    def stop(self):
+        self.pipeline.stop()
+
+    def submit(self, image):
+        self.pipeline.submit({'image': image.to_dict()})
+
+    def check(self, image):
+        safe = self.verdicts.get(image.blob_name)
+        if safe is None:
+            safe = self._analyze(self.load_original(image))
+            self.verdicts.put(image.blob_name, safe)
+        self.verdicts.count(safe)
+        return safe
+
+    def _analyze(self, original):
+        # failures that come back the same on every attempt are a verdict, an
+        # image nobody can check stays hidden. anything else is retried
+        try:
+            preview = moderation_preview(original)
+        except MemoryError:
+            raise
+        except Exception as ex:
+            # PIL raises OSError, ValueError or its own errors for bad or hostile files
+            print("Moderation can't decode image, keeping it hidden", ex)
+            return False
+        try:
+            return self.service.check_image(preview)
+        except Exception as ex:
+            response = getattr(ex, 'response', None)
+            if getattr(response, 'status_code', None) not in FINAL_STATUS_CODES:
+                raise
+            print("Moderation rejected image, keeping it hidden", ex)
+            return False
+
+    def _moderate(self, job):
+        image = Image.create_from_entity(job['image'])
+        try:
+            safe = self.check(image)
+        except ResourceNotFoundError:
+            # deleted while it waited, nothing left to show
+            return
+        self.on_verdict(image, safe)
+
@@ -0,0 +1,71 @@
+import threading
+
+from config import EMAIL_TRANSPORT, EMAIL_QUEUE, EMAIL_QUEUE_NAME, EMAIL_WORKERS, EMAIL_MAX_ATTEMPTS
+from pipeline import Pipeline, create_job_queue
+
+# Request handlers drop emails in the outbox and return, a few background
+# workers render and deliver them with the shared email client. Jobs carry
+# the template name and its (json-able) variables, not the rendered html, so
+# they stay small enough for a storage queue.
+
+
+class EmailDeliveryError(Exception):
+    pass
+
+
+class AzureEmailTransport:
+    def __init__(self, email_service = None):
+        if email_service is None:
+            from services import EmailService
+            email_service = EmailService()
+        self.email_service = email_service
+
+    def send(self, to, subject, body):
+        # waits for the service to accept it, so failures are retried
+        if not self.email_service.send_email(to, subject, body, wait_success=True):
+            raise EmailDeliveryError(f'sending "{subject}" to {to} failed')
+
+
+class LocalEmailTransport:
+    # keeps sent messages in memory, for tests and runs without a mail service
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sent = []
+
+    def send(self, to, subject, body):
+        with self._lock:
+            self.sent.append({'to': to, 'subject': subject, 'body': body})
+        print("Email", to, subject)
+
+
+def create_email_transport(backend = EMAIL_TRANSPORT):
+    if backend == 'local':
+        return LocalEmailTransport()
+    return AzureEmailTransport()
+
+
+class Outbox:
+    def __init__(self, render, transport = None, job_queue = None, workers = EMAIL_WORKERS, max_attempts = EMAIL_MAX_ATTEMPTS):
+        # render(template, variables) returns the email body
+        self.render = render
+        self.transport = transport if transport is not None else create_email_transport()
+        if job_queue is None:
+            job_queue = create_job_queue(EMAIL_QUEUE, EMAIL_QUEUE_NAME)
+        self.pipeline = Pipeline(self._deliver, job_queue, workers, max_attempts, name='outbox')
+
+    def start(self):
+        self.pipeline.start()
+        return self
+
+    def stop(self):
+        self.pipeline.stop()
+
+    def send(self, to, subject, template, **variables):
+        self.pipeline.submit({'to': to, 'subject': subject, 'template': template, 'variables': variables})
+
+    def depth(self):
+        return self.pipeline.job_queue.depth()
+
+    def _deliver(self, job):
+        body = self.render(job['template'], job['variables'])
+        self.transport.send(job['to'], job['subject'], body)
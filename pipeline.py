@@ -0,0 +1,155 @@
+import json
+import time
+import queue
+import threading
+
+from config import UPLOAD_QUEUE, UPLOAD_QUEUE_NAME, UPLOAD_WORKERS, UPLOAD_MAX_ATTEMPTS, AZURE_STORAGE_CS
+from metrics import timed
+
+# Background stage for work that doesn't have to happen before we answer the
+# uploader. Jobs are plain json-able dicts, handlers are retried with backoff
+# and dropped (with a log line) after max_attempts.
+
+
+class Delivery:
+    def __init__(self, job, attempt, handle = None):
+        self.job = job
+        self.attempt = attempt
+        self.handle = handle
+
+
+class LocalJobQueue:
+    # in-memory, for tests and single node runs. jobs are lost on restart
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def put(self, job):
+        self._queue.put(Delivery(job, 1))
+
+    def get(self, timeout):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def ack(self, delivery):
+        pass
+
+    def retry(self, delivery, delay):
+        retry = Delivery(delivery.job, delivery.attempt + 1)
+        timer = threading.Timer(delay, self._queue.put, args=(retry,))
+        timer.daemon = True
+        timer.start()
+
+    def depth(self):
+        return self._queue.qsize()
+
+
+class AzureJobQueue:
+    # at-least-once delivery through an azure storage queue, survives restarts
+    # and spreads the work over every process reading the queue
+    def __init__(self, queue_name = UPLOAD_QUEUE_NAME, connection_string = AZURE_STORAGE_CS, visibility_timeout = 60):
+        from azure.core.exceptions import ResourceExistsError
+        from clients import get_queue_service_client
+        self.visibility_timeout = visibility_timeout
+        self.queue_client = get_queue_service_client(connection_string).get_queue_client(queue_name)
+        try:
+            self.queue_client.create_queue()
+        except ResourceExistsError:
+            pass
+
+    def put(self, job):
+        with timed('queue', 'put'):
+            self.queue_client.send_message(json.dumps(job))
+
+    def get(self, timeout):
+        with timed('queue', 'get'):
+            messages = list(self.queue_client.receive_messages(max_messages=1, visibility_timeout=self.visibility_timeout))
+        for message in messages:
+            return Delivery(json.loads(message.content), message.dequeue_count, message)
+        time.sleep(timeout)
+        return None
+
+    def ack(self, delivery):
+        with timed('queue', 'ack'):
+            self.queue_client.delete_message(delivery.handle)
+
+    def retry(self, delivery, delay):
+        # the message becomes visible again after the delay
+        with timed('queue', 'retry'):
+            self.queue_client.update_message(delivery.handle, visibility_timeout=int(delay))
+
+    def depth(self):
+        with timed('queue', 'depth'):
+            return self.queue_client.get_queue_properties().approximate_message_count
+
+
+def create_job_queue(backend = UPLOAD_QUEUE, queue_name = UPLOAD_QUEUE_NAME):
+    if backend == 'azure':
+        return AzureJobQueue(queue_name)
+    return LocalJobQueue()
+
+
+class Pipeline:
+    def __init__(self, handler, job_queue = None, workers = UPLOAD_WORKERS, max_attempts = UPLOAD_MAX_ATTEMPTS, name = 'pipeline',
+                 on_give_up = None):
+        self.handler = handler
+        self.on_give_up = on_give_up # undoes what was done for a job before it was queued
+        self.job_queue = job_queue if job_queue is not None else create_job_queue()
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.name = name
+        self._threads = []
+        self._stopped = threading.Event()
+
+    def submit(self, job):
+        self.job_queue.put(job)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'{self.name}-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+
+    @staticmethod
+    def backoff(attempt):
+        return min(2 ** attempt, 60)
+
+    def _work(self):
+        while not self._stopped.is_set():
+            try:
+                delivery = self.job_queue.get(timeout=1)
+            except Exception as ex:
+                print(f"{self.name} queue error", ex)
+                self._stopped.wait(1)
+                continue
+            if delivery is None:
+                continue
+            try:
+                self.handler(delivery.job)
+                self.job_queue.ack(delivery)
+            except Exception as ex:
+                self._failed(delivery, ex)
+
+    def _failed(self, delivery, ex):
+        try:
+            if delivery.attempt >= self.max_attempts:
+                print(f"{self.name} giving up after {delivery.attempt} attempts", delivery.job, ex)
+                if self.on_give_up:
+                    try:
+                        self.on_give_up(delivery.job)
+                    except Exception as give_up_ex:
+                        print(f"{self.name} give up handler failed", give_up_ex)
+                self.job_queue.ack(delivery)
+            else:
+                print(f"{self.name} attempt {delivery.attempt} failed, retrying", ex)
+                self.job_queue.retry(delivery, self.backoff(delivery.attempt))
+        except Exception as queue_ex:
+            # the queue will hand the job out again once it times out
+            print(f"{self.name} queue error", queue_ex)
@@ -0,0 +1,87 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from config import QR_CACHE_ITEMS
+
+# The QR code of a wall only depends on the camera url it points to, so the
+# matrix and its renderings are built once and kept in a small LRU. Each
+# format is rendered the first time somebody asks for it. qrcode (and pillow
+# behind it) is imported on first use, it isn't needed to start the app.
+
+QR_CONTENT_TYPES = {
+    'svg': 'image/svg+xml',
+    'png': 'image/png',
+}
+
+
+class QRCode:
+    def __init__(self, data):
+        self.data = data
+        self.etag = hashlib.sha1(data.encode('utf-8')).hexdigest()
+        import qrcode
+        self._qr = qrcode.QRCode(
+            version=1,
+            error_correction=qrcode.constants.ERROR_CORRECT_L,
+            box_size=10,
+            border=4,
+        )
+        self._qr.add_data(data)
+        self._qr.make(fit=True)
+        self._lock = threading.Lock()
+        self._rendered = {} # format -> bytes
+
+    def svg(self):
+        return self.render('svg').decode('utf-8')
+
+    def render(self, format):
+        body = self._rendered.get(format)
+        if body is None:
+            with self._lock:
+                body = self._rendered.get(format)
+                if body is None:
+                    body = self._rendered[format] = self._render(format)
+        return body
+
+    def _render(self, format):
+        if format == 'svg':
+            import qrcode.image.svg
+            return self._qr.make_image(fill='black', image_factory=qrcode.image.svg.SvgPathFillImage).to_string()
+        if format == 'png':
+            buf = BytesIO()
+            self._qr.make_image(fill='black', back_color='white').save(buf)
+            return buf.getvalue()
+        raise ValueError(f'unknown qr format {format}')
+
+
+class QRCodeCache:
+    def __init__(self, max_items = QR_CACHE_ITEMS):
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._items = OrderedDict() # (wall id, camera url) -> QRCode
+        self.counters = {'hits': 0, 'misses': 0}
+
+    def get(self, wall_id, camera_url):
+        key = (wall_id, camera_url)
+        with self._lock:
+            code = self._items.get(key)
+            if code is not None:
+                self._items.move_to_end(key)
+                self.counters['hits'] += 1
+                return code
+            self.counters['misses'] += 1
+        # built outside the lock, two racing misses just build it twice
+        code = QRCode(camera_url)
+        with self._lock:
+            code = self._items.setdefault(key, code)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return code
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['items'] = len(self._items)
+        return stats
@@ -1,24 +1,36 @@
 import os
-import queue
-import qrcode.image.svg
+import hmac
+import time
+import importlib
+import threading
 import shortuuid
-import qrcode
-import qrcode.image.svg
 import base64
+import functools
 import tempfile
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
-from flask import Flask, Response, redirect, request, render_template, url_for
+from flask import Flask, Response, g, redirect, request, render_template, send_file, url_for
 from flask_cors import CORS
-from io import BytesIO
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import is_resource_modified
 
 from config import STRIPE_SIGNING_SECRET, STRIPE_API_KEY, STRIPE_PUBLIC_KEY, STRIPE_PRICE_ID
+from config import EVENT_STREAM, EVENTS_URL, EVENTS_PORT, IMAGE_DELIVERY, MAX_UPLOAD_BYTES, WALL_PAGE_SIZE, MODERATION
+from config import STORAGE_BACKEND, LOCAL_BLOB_URL, METRICS_TOKEN
 
-import stripe
-stripe.api_key = STRIPE_API_KEY
-
-from services import EmailService, BlobService
+from services import BlobService, RenditionService, RENDITION_SIZES, RENDITION_CONTENT_TYPE, SAS_REFRESH_MARGIN
+from services import UploadTooLargeError
 from models import Image, Wall, WallStatus, Event, EventType, User
-from datalayers import UserDataLayer, WallDataLayer, ImageDataLayer
+from datalayers import UserDataLayer, WallDataLayer, ImageDataLayer, set_invalidation_publisher, invalidate_wall
+from datalayers import start_counting_writes, fetch_concurrently
+from events import create_event_bus, parse_last_event_id
+from imagecache import ImageCache, CachedFile
+from clients import connections_opened, warmup, get_blob_service_client
+from pipeline import Pipeline
+from qrcodes import QRCodeCache, QR_CONTENT_TYPES
+from outbox import Outbox
+from moderation import ModerationStage
+import metrics
 
 
 DEBUG_MODE = True
@@ -32,7 +44,59 @@ if DEBUG_MODE == False:
     from werkzeug.middleware.proxy_fix import ProxyFix
     app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
-event_clients = []
+event_bus = create_event_bus()
+image_cache = ImageCache()
+qr_codes = QRCodeCache()
+
+# keep the wall and image caches of every process in step with writes made here
+def on_invalidation(kind, key):
+    if kind == 'wall':
+        invalidate_wall(key, publish=False)
+    elif kind == 'image':
+        image_cache.invalidate(key)
+
+set_invalidation_publisher(event_bus.publish_invalidation)
+event_bus.on_invalidation(on_invalidation)
+
+if DEBUG_MODE:
+    # report how many new storage connections and table writes each request
+    # made, with concurrent requests the connection numbers overlap
+    @app.before_request
+    def count_request_costs_start():
+        g.connections_at_start = connections_opened()
+        g.table_writes = start_counting_writes()
+
+    @app.after_request
+    def count_request_costs_end(response):
+        response.headers['X-Connections-Opened'] = str(connections_opened() - g.connections_at_start)
+        response.headers['X-Table-Writes'] = f"{g.table_writes.requests} requests, {g.table_writes.entities} entities"
+        return response
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # servers that import the app instead of running __main__ prewarm here
+    if not prewarm_started.is_set():
+        prewarm()
+
+@app.after_request
+def observe_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = metrics_route()
+        metrics.http_request_seconds.observe(time.perf_counter() - started, route, request.method)
+        metrics.http_requests.inc(route, request.method, str(response.status_code))
+    return response
+
+def metrics_route():
+    # the url rule, not the path, so walls and images don't each get a series
+    if request.url_rule is None:
+        return 'unmatched'
+    rule = request.url_rule.rule
+    # keep the random admin path out of the metrics
+    if rule.startswith(f'/{admin_route}'):
+        return '/<admin>' + rule[len(admin_route) + 1:]
+    return rule
 
 # if DEBUG_MODE == False:
 #     app.config['PREFERRED_URL_SCHEME'] = 'https'
@@ -50,23 +114,32 @@ def photo_booth(wall_id):
 def sse():
     # get the wall id from the w query parameter
     wall_id = request.args.get('w')
+    if not wall_id:
+        return '', 400
+    # browsers send Last-Event-ID when they reconnect, our own reconnect passes it in the query
+    last_event_id = parse_last_event_id(request.headers.get('Last-Event-ID') or request.args.get('lastEventId'))
+
+    subscription = event_bus.subscribe(wall_id, last_event_id)
 
     def generate():
-        q = queue.Queue()
-        event_clients.append(q)
         try:
-            while True:
-                event = q.get()
-                if event.wall_id == wall_id:
-                    yield f"data: {event}\n\n"
-        except GeneratorExit:
-            event_clients.remove(q)
+            yield from subscription.stream()
+        finally:
+            event_bus.unsubscribe(subscription)
 
-    return Response(generate(), mimetype='text/event-stream')
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 def broadcast_event(event):
-    for client in event_clients:
-        client.put(event)
+    event_bus.publish(event.wall_id, str(event))
+
+def events_url():
+    if EVENTS_URL:
+        return EVENTS_URL
+    if EVENT_STREAM == 'async':
+        # the asyncio stream listens on its own port of the same host
+        host = request.host if request.host.endswith(']') else request.host.rsplit(':', 1)[0]
+        return f"{request.scheme}://{host}:{EVENTS_PORT}/events"
+    return url_for('sse')
 
 @app.route('/w/<wall_id>', methods=['GET'])
 def wall(wall_id):
@@ -80,44 +153,72 @@ def wall(wall_id):
     if request.args.get('k') != wall.owner_key:
         return '', 403
 
-    # Generate QR code for /app URL
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(f"{url_for('camera', _external=True)}?w={wall_id}")
-    qr.make(fit=True)
-    img = qr.make_image(fill='black', back_color='white')
-    buf = BytesIO()
-    img.save(buf)
-    buf.seek(0)
-    qr_code_base64 = base64.b64encode(buf.getvalue()).decode('utf-8')
-    
-    svg = qr.make_image(fill='black', image_factory=qrcode.image.svg.SvgPathFillImage)
-    qr_svg = svg.to_string().decode('utf-8')
+    camera_url = f"{url_for('camera', _external=True)}?w={wall_id}"
+    qr_svg = qr_codes.get(wall_id, camera_url).svg()
 
-    # get the images from the wall
-    images_in_wall = ImageDataLayer().list_images_for_wall(wall_id)
-    images_list = sorted(images_in_wall, key=lambda x: x['ts'], reverse=False)
+    # get the newest page of images, the page fetches older ones itself
+    images, next_cursor = ImageDataLayer().list_images_page(wall_id, limit=WALL_PAGE_SIZE)
+    # the wall puts each image on top, so hand them over oldest first
+    images_list = list(reversed(images))
     # add url to the images_list
     for image in images_list:
-        image['url'] = url_for('show_image', id=image['id'])
+        image['url'] = wall_image_url(image['id'], image.pop('blob_name'))
 
     # console print the url to the camera app
-    print(f"{url_for('camera', _external=True)}?w={wall_id}")
+    print(camera_url)
 
     # return the wall
     return render_template('wall.html', 
                            wall_id=wall_id,
                            wall=wall,
                            images=images_list, 
-                           qr_png=qr_code_base64, 
+                           next_cursor=next_cursor,
                            qr_svg=qr_svg, 
-                           camera_url=f"{url_for('camera', _external=True)}?w={wall_id}"
+                           qr_png_url=url_for('wall_qr', wall_id=wall_id, format='png'),
+                           events_url=events_url(),
+                           camera_url=camera_url
                            )
 
+@app.route('/w/<wall_id>/qr.<format>', methods=['GET'])
+def wall_qr(wall_id, format):
+    # the qr code only points at the public camera page, no owner key needed
+    if format not in QR_CONTENT_TYPES:
+        return '', 404
+    if WallDataLayer().get_by_id(wall_id) is None:
+        return '', 404
+    code = qr_codes.get(wall_id, f"{url_for('camera', _external=True)}?w={wall_id}")
+    if not is_resource_modified(request.environ, etag=code.etag):
+        response = Response(status=304)
+    else:
+        response = Response(code.render(format), mimetype=QR_CONTENT_TYPES[format])
+    response.set_etag(code.etag)
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+@app.route('/w/<wall_id>/images', methods=['GET'])
+def wall_images(wall_id):
+    # one page of the wall's images, newest first unless ?order=oldest
+    wall = WallDataLayer().get_by_id(wall_id)
+    if wall is None:
+        return '', 404
+    if request.args.get('k') != wall.owner_key:
+        return '', 403
+    limit = min(request.args.get('limit', WALL_PAGE_SIZE, type=int), WALL_PAGE_SIZE)
+    if limit < 1:
+        return '', 400
+    try:
+        images, next_cursor = ImageDataLayer().list_images_page(wall_id, limit=limit,
+                                                                cursor=request.args.get('cursor'),
+                                                                newest_first=request.args.get('order') != 'oldest')
+    except ValueError:
+        return '', 400
+    for image in images:
+        image['url'] = wall_image_url(image['id'], image.pop('blob_name'))
+    return {
+        'images': images,
+        'cursor': next_cursor
+    }
+
 @app.route('/w/<wall_id>', methods=['POST'])
 def upload_image(wall_id):
     # Get the wall
@@ -129,23 +230,132 @@ def upload_image(wall_id):
     # Get the content type
     content_type = request.headers.get('Content-Type')
     # check that the type is a valid image, content type image/*
-    if not content_type.startswith('image/'):
+    if content_type is None or not content_type.startswith('image/'):
         return '', 400
-    # Store the image in the images dictionary
-    image = Image(short_id, wall_id, request.data, content_type)
-    BlobService().upload_image(short_id, request.data)
-    url_to_image = BlobService().get_image_url(short_id)
-    image.blob_url = url_to_image
-    ImageDataLayer().create(image)
-    # Update the wall
-    wall.image_ids.append(short_id)
-    WallDataLayer().update(wall)
-    # Broadcast the event
-    broadcast_event(Event(EventType.ADD, image, wall.id))
+    # refuse oversized bodies before reading any of them
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES:
+        return '', 413
+    # Stream the body to blob storage under its content hash, duplicates are not stored again
+    try:
+        blob_name, size = BlobService().store_image_stream(request.stream, MAX_UPLOAD_BYTES, content_type=content_type)
+    except UploadTooLargeError:
+        return '', 413
+    image = Image(short_id, wall_id, None, content_type)
+    image.size = size
+    image.blob_name = blob_name
+    # stays off the wall until moderation has seen it
+    image.hidden = MODERATION
+    # the bytes are durable now, the table writes and broadcast happen in the background
+    remember_pending_image(image)
+    upload_pipeline().submit({'image': image.to_dict()})
+    location = url_for('show_image', id=short_id)
     return {
-        'location': url_for('show_image', id=short_id),
+        'location': location,
         'owner_key': image.owner_key
-        }, 201
+        }, 202, {'Location': location}
+
+# images accepted but not persisted yet, so /i/<id> works right after the 202
+PENDING_IMAGE_TTL = 600
+pending_images = OrderedDict() # image id -> (accepted at, image)
+pending_images_lock = threading.Lock()
+
+def remember_pending_image(image):
+    now = time.time()
+    with pending_images_lock:
+        pending_images[image.id] = (now, image)
+        # with a shared queue another process may persist it, don't keep it forever
+        while pending_images and next(iter(pending_images.values()))[0] < now - PENDING_IMAGE_TTL:
+            pending_images.popitem(last=False)
+
+def get_pending_image(image_id):
+    with pending_images_lock:
+        entry = pending_images.get(image_id)
+    return entry[1] if entry is not None else None
+
+def find_image(image_id):
+    return get_pending_image(image_id) or ImageDataLayer().get_by_id(image_id)
+
+# table round trips per persisted upload, tracked so the budget can be checked under load
+upload_write_stats = {'jobs': 0, 'requests': 0, 'entities': 0, 'max_requests': 0}
+upload_write_stats_lock = threading.Lock()
+
+def persist_upload(job):
+    writes = start_counting_writes()
+    image = Image.create_from_entity(job['image'])
+    image.blob_url = BlobService().get_image_url(image.blob_name)
+    # the wall entity is not touched, its image list is the wall partition in the images table
+    ImageDataLayer().create(image)
+    if image.hidden:
+        # counted and broadcast once moderation approves it
+        moderation_stage().submit(image)
+    else:
+        show_image_on_wall(image)
+    with pending_images_lock:
+        pending_images.pop(image.id, None)
+    with upload_write_stats_lock:
+        upload_write_stats['jobs'] += 1
+        upload_write_stats['requests'] += writes.requests
+        upload_write_stats['entities'] += writes.entities
+        upload_write_stats['max_requests'] = max(upload_write_stats['max_requests'], writes.requests)
+
+def abandon_upload(job):
+    # the blob reference was taken when the upload was accepted, give it back
+    # together with whatever the failed attempts managed to write
+    image = Image.create_from_entity(job['image'])
+    with pending_images_lock:
+        pending_images.pop(image.id, None)
+    remove_image(image)
+
+# the background workers start on first use or in prewarm, importing the app starts no threads
+background_workers = {} # name -> started pipeline, outbox or moderation stage
+background_workers_lock = threading.Lock()
+
+def background_worker(name, create):
+    with background_workers_lock:
+        if name not in background_workers:
+            background_workers[name] = create().start()
+        return background_workers[name]
+
+def upload_pipeline():
+    return background_worker('uploads', lambda: Pipeline(persist_upload, name='uploads', on_give_up=abandon_upload))
+
+def show_image_on_wall(image):
+    # images count once they are visible. a retried job finds the image
+    # counted already and doesn't broadcast it again
+    if WallDataLayer().add_image_to_stats(image.wall_id, image.id, image.size, image.timestamp) is not None:
+        broadcast_event(Event(EventType.ADD, image, image.wall_id))
+
+def moderation_verdict(image, safe):
+    if not safe:
+        # it never made it onto the wall, leave it hidden
+        print("Image hidden by moderation", image.id, image.wall_id)
+        return
+    ImageDataLayer().set_hidden(image, False)
+    image_cache.invalidate(image.id)
+    event_bus.publish_invalidation('image', image.id)
+    show_image_on_wall(image)
+
+def moderation_stage():
+    return background_worker('moderation', lambda: ModerationStage(lambda image: BlobService().get_image(image.blob_name),
+                                                                   moderation_verdict))
+
+# read once, on the first email or in prewarm, instead of on every email
+@functools.cache
+def get_image_data_url(image_path):
+    with open(image_path, 'rb') as img_file:
+        encoded_string = base64.b64encode(img_file.read()).decode('utf-8')
+        return f'data:image/webp;base64,{encoded_string}'
+
+def render_email(template, variables):
+    # runs on the outbox workers, outside of any request
+    with app.app_context():
+        return render_template(template,
+                               logo=get_image_data_url('static/logo.webp'),
+                               current_year=datetime.now(tz=timezone.utc).year,
+                               **variables)
+
+def outbox():
+    return background_worker('outbox', lambda: Outbox(render_email))
 
 @app.route('/i/<image_id>', methods=['DELETE'])
 def delete_image(image_id):
@@ -161,25 +371,116 @@ def delete_image(image_id):
         wall = WallDataLayer().get_by_id(image.wall_id)
         if wall is None or owner_key != wall.owner_key:
             return '', 403
+    remove_image(image)
+    return '', 204
+
+def remove_image(image):
     # remove the image from its wall
     ImageDataLayer().delete(image)
-    # delete the image from the blob storage
-    BlobService().delete_image(image_id)
+    WallDataLayer().remove_image_from_stats(image.wall_id, image.id, image.size)
+    # delete the original once no other image shares it, its renditions with it
+    if BlobService().delete_image(image.blob_name):
+        RenditionService().delete_renditions(image.blob_name)
+    image_cache.invalidate(image.id)
+    event_bus.publish_invalidation('image', image.id)
     # broadcast the event
-    broadcast_event(Event(EventType.DELETE, image, wall.id))
-    return '', 204
+    broadcast_event(Event(EventType.DELETE, image, image.wall_id))
+
+# image ids are never reused and the bytes behind them never change
+IMAGE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def image_blob_url(image, size):
+    # read-only sas url for direct delivery, memoized per blob until close to expiry
+    if size == 'orig':
+        return BlobService().get_image_url_with_expiry(image.blob_name)
+    return RenditionService().get_rendition_url_with_expiry(image.blob_name, size)
+
+def wall_image_url(image_id, blob_name):
+    # with direct delivery, embed the blob url when the rendition is already
+    # known to exist, otherwise /i/ creates it and redirects
+    if IMAGE_DELIVERY == 'redirect' and RenditionService.has_known_rendition(blob_name, 'wall'):
+        return RenditionService().get_rendition_url_with_expiry(blob_name, 'wall')[0]
+    return url_for('show_image', id=image_id, size='wall')
 
 @app.route('/i/<id>', methods=['GET'])
 def show_image(id):
+    # ?size=thumb|wall serves a downscaled rendition, orig (default) the upload
+    size = request.args.get('size', 'orig')
+    if size != 'orig' and size not in RENDITION_SIZES:
+        return '', 400
     try:
-        image : Image = ImageDataLayer().get_by_id(id)
-        if image is None:
+        image : Image = image_cache.get_metadata(id, find_image)
+        if image is None or image.hidden:
             return '', 404
-        data = BlobService().get_image(id)
-        return data, 200, {'Content-Type': image.content_type}
+        if IMAGE_DELIVERY == 'redirect':
+            # image bytes go straight from blob storage to the browser
+            url, expiry = image_blob_url(image, size)
+            response = redirect(url, code=302)
+            max_age = int((expiry - datetime.now(tz=timezone.utc) - SAS_REFRESH_MARGIN).total_seconds())
+            response.headers['Cache-Control'] = f'private, max-age={max(max_age, 0)}'
+            return response
+        etag = f'{id}.{size}'
+        # answer revalidations before touching the blob
+        if not is_resource_modified(request.environ, etag=etag, last_modified=image.created):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = IMAGE_CACHE_CONTROL
+            return response
+        content_type = image.content_type
+        body = None
+        if size != 'orig':
+            try:
+                loader = lambda: RenditionService().get_rendition(image.blob_name, size)
+                body = image_cache.get(id, size, loader)
+                content_type = RENDITION_CONTENT_TYPE
+            except OSError as ex:
+                # pillow could not decode it, fall back to the original
+                print("Rendition failed", id, ex)
+        if body is None:
+            loader = lambda: BlobService().get_image(image.blob_name)
+            body = image_cache.get(id, 'orig', loader)
+        if isinstance(body, CachedFile):
+            try:
+                # disk cache hits go out by path, so the server can sendfile them
+                # (or hand them to the proxy with USE_X_SENDFILE)
+                response = send_file(body.path, mimetype=content_type, etag=etag, last_modified=image.created)
+                response.headers['Cache-Control'] = IMAGE_CACHE_CONTROL
+                return response
+            except FileNotFoundError:
+                # evicted between lookup and open
+                body = loader()
+        length = len(body)
+        response = Response(body, mimetype=content_type)
+        response.content_length = length
+        response.set_etag(etag)
+        response.last_modified = image.created
+        response.headers['Cache-Control'] = IMAGE_CACHE_CONTROL
+        # handles Range requests with 206/416
+        return response.make_conditional(request, accept_ranges=True, complete_length=length)
+    except HTTPException:
+        # e.g. 416 for an unsatisfiable range
+        raise
     except:
         return '', 404
 
+if STORAGE_BACKEND == 'local':
+    # what blob storage does for sas urls, for blobs in the local store
+    @app.route(f'{LOCAL_BLOB_URL}/<container>/<blob_name>', methods=['GET'])
+    def local_blob(container, blob_name):
+        from azure.core.exceptions import ResourceNotFoundError
+        store = get_blob_service_client()
+        try:
+            if not store.verify(container, blob_name, request.args.get('se'), request.args.get('sig')):
+                return '', 403
+            blob = store.get_blob_client(container, blob_name)
+            properties = blob.get_blob_properties()
+        except (ValueError, ResourceNotFoundError):
+            return '', 404
+        response = send_file(blob.path, mimetype=properties.content_settings.content_type or 'application/octet-stream',
+                             conditional=True, etag=False)
+        response.headers['Cache-Control'] = properties.content_settings.cache_control or 'private'
+        return response
+
 @app.route('/w/<wall_id>', methods=['PATCH'])
 def patch_wall(wall_id):
     # Get the wall
@@ -205,17 +506,13 @@ def patch_wall(wall_id):
     if user is None:
         user = User(wall.owner_email)
         udl.create(user)
-    # render and send claim email
-    email_html = render_template('emails/claim.html',
-                    logo = get_image_data_url('static/logo.webp'),
-                    email=wall.owner_email,
-                    wall_link = url_for('validate', wall_id=wall.id, token=user.validation_code, _external=True),
-                    current_year = datetime.now(tz=timezone.utc).year
-                    )
-    EmailService().send_email(
+    # queue the claim email
+    outbox().send(
         wall.owner_email, 
         "Take ownership of your LiveWall", 
-        email_html)
+        'emails/claim.html',
+        email=wall.owner_email,
+        wall_link = url_for('validate', wall_id=wall.id, token=user.validation_code, _external=True))
     # for easy debugging, print the link to the console
     current_full_url = f"{url_for('validate', wall_id=wall.id, token=user.validation_code, _external=True)}"
     print("Confirmation link", current_full_url)
@@ -247,19 +544,14 @@ def validate(wall_id, token):
         # broadcast the event
         broadcast_event(Event(EventType.UPDATE, None, wall.id))
         # send email to the user of the wall
-        email_html = render_template('emails/owner.html',
-                        logo = get_image_data_url('static/logo.webp'),
-                        email = email,
-                        wall_link = url_for('wall', wall_id=wall.id, _external=True) + f"?k={wall.owner_key}",
-                        moderation_link = url_for('moderation_page', wall_id=wall.id, key=wall.owner_key, _external=True),
-                        user_link = url_for('user_page', user_id=found_user.id, validation_token=found_user.validation_code, _external=True),
-                        current_year = datetime.now(tz=timezone.utc).year)
-        
-        EmailService().send_email(
+        outbox().send(
             email, 
             "Your LiveWall is ready", 
-            email_html,
-            wait_success=False)
+            'emails/owner.html',
+            email = email,
+            wall_link = url_for('wall', wall_id=wall.id, _external=True) + f"?k={wall.owner_key}",
+            moderation_link = url_for('moderation_page', wall_id=wall.id, key=wall.owner_key, _external=True),
+            user_link = url_for('user_page', user_id=found_user.id, validation_token=found_user.validation_code, _external=True))
     # redirect the user to the control panel for the wall
     return redirect(url_for('moderation_page', wall_id=wall.id, key=wall.owner_key))
 
@@ -273,11 +565,15 @@ def user_page(user_id, validation_token):
     if user.validation_code != validation_token:
         return '', 403
     # list walls for the user
-    walls = WallDataLayer().list_walls_for_user(user.email)
-    # find number of images per wall
-    for wall in walls:
-        images = ImageDataLayer().list_images_for_wall(wall.id)
-        wall.num_images = len(images)
+    wdl = WallDataLayer()
+    walls = wdl.list_walls_for_user(user.email)
+    # image counts come from the maintained aggregates
+    stats = wdl.get_stats_for_walls(wall.id for wall in walls)
+    # the latest thumbnails of every wall are fetched side by side
+    latest = fetch_concurrently(lambda wall: ImageDataLayer().list_images_page(wall.id, limit=10)[0], walls)
+    for wall, images in zip(walls, latest):
+        wall.stats = stats[wall.id]
+        wall.num_images = wall.stats.num_images
         wall.images = images
     # return the control panel
     return render_template('user.html', user=user, walls=walls)
@@ -296,21 +592,61 @@ def moderation_page(wall_id, key):
     # external link to wall
     wall_external_link = url_for('wall', wall_id=wall.id, _external=True) + f"?k={wall.owner_key}"
     # list the 10 latest images for the wall
-    images = ImageDataLayer().list_images_for_wall(wall_id)
-    images = sorted(images, key=lambda x: x['ts'], reverse=True)
+    images, _ = ImageDataLayer().list_images_page(wall_id, limit=10)
     # return the control panel
-    return render_template('moderation.html', wall=wall, user=user, wall_link=wall_external_link, images=images[:10])
+    return render_template('moderation.html', wall=wall, user=user, wall_link=wall_external_link, images=images)
 
 admin_route = shortuuid.uuid()
 if DEBUG_MODE:
     admin_route = 'admin'
 @app.route(f"/{admin_route}", methods=['GET'])
 def admin():
-    all_users = UserDataLayer().list_users()
-    all_walls = WallDataLayer().list_walls()
-    return render_template('admin.html', users=all_users, walls=all_walls, delete_all_url=url_for('admin'))
-
-print(f"Admin", f"http://localhost:3000/{admin_route}")
+    # users and walls are paged independently with table continuation tokens
+    users_token = request.args.get('users')
+    walls_token = request.args.get('walls')
+    try:
+        users, next_users = UserDataLayer().list_users_page(continuation_token=users_token)
+        walls, next_walls = WallDataLayer().list_walls_page(continuation_token=walls_token)
+    except ValueError:
+        return '', 400
+    return render_template('admin.html', users=users, walls=walls, delete_all_url=url_for('admin'),
+                           first_page_url=url_for('admin'),
+                           next_users_url=url_for('admin', users=next_users, walls=walls_token) if next_users else None,
+                           next_walls_url=url_for('admin', users=users_token, walls=next_walls) if next_walls else None)
+
+@app.route(f"/{admin_route}/cache", methods=['GET'])
+def admin_cache_stats():
+    stats = image_cache.stats()
+    stats['qr_codes'] = qr_codes.stats()
+    if MODERATION:
+        stats['moderation_verdicts'] = moderation_stage().verdicts.stats()
+    return stats
+
+@app.route(f"/{admin_route}/writes", methods=['GET'])
+def admin_write_stats():
+    with upload_write_stats_lock:
+        return dict(upload_write_stats)
+
+def queue_depths():
+    depths = {'uploads': upload_pipeline().job_queue.depth(), 'outbox': outbox().depth()}
+    if MODERATION:
+        depths['moderation'] = moderation_stage().pipeline.job_queue.depth()
+    return depths
+
+metrics.registry.gauge('livewall_sse_connections', 'Open event streams per wall.',
+                       lambda: event_bus.hub.subscriber_counts(), ('wall',))
+metrics.registry.gauge('livewall_queue_depth', 'Jobs waiting in the background pipelines.', queue_depths, ('queue',))
+metrics.registry.gauge('livewall_image_cache_bytes', 'Bytes held by the image cache tiers.',
+                       lambda: {tier: image_cache.stats()[f'{tier}_bytes'] for tier in ('memory', 'disk')}, ('tier',))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_page():
+    # route names and wall ids are nobody else's business
+    if not METRICS_TOKEN:
+        return '', 404
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+        return '', 401
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
 
 @app.route(f"/{admin_route}", methods=['DELETE'])
 def delete_everything():
@@ -335,7 +671,11 @@ def start():
     WallDataLayer().create(wall)
     return redirect(f"{url_for('wall', wall_id=wall.id)}?k={wall.owner_key}")
 
-print(f"New wall:", f"http://localhost:3000/start")
+def get_stripe():
+    # only the payment routes need stripe, keep it off the startup path
+    import stripe
+    stripe.api_key = STRIPE_API_KEY
+    return stripe
 
 @app.route('/upgrade/<wall_id>/<owner_key>', methods=['GET'])
 def upgrade(wall_id, owner_key):
@@ -362,27 +702,29 @@ def initiate_checkout(wall_id, owner_key):
     if wall.owner_email is not None:
         customer_email_address = wall.owner_email
     
-    session = stripe.checkout.Session.create(
-        payment_method_types=['card'],
-        line_items=[{
-            'price': STRIPE_PRICE_ID,
-            'quantity': 1,
-        }],
-        mode='payment',
-        success_url=url_for('transaction_success', wall_id=wall_id, owner_key=wall.owner_key, _external=True),
-        cancel_url=url_for('upgrade', wall_id=wall.id, owner_key=owner_key, _external=True) + '?canceled=true',
-        payment_intent_data={ # saved with transaction metadata
-            'metadata': {
-                'site': 'LiveWall',
-                'wall_id': wall_id,
-                'owner_key': wall.owner_key
-            }
-        },
-        metadata={ # session metadata
-            'wall_id': wall_id
-        },
-        customer_email=customer_email_address
-    )
+    stripe = get_stripe()
+    with metrics.timed('stripe', 'checkout'):
+        session = stripe.checkout.Session.create(
+            payment_method_types=['card'],
+            line_items=[{
+                'price': STRIPE_PRICE_ID,
+                'quantity': 1,
+            }],
+            mode='payment',
+            success_url=url_for('transaction_success', wall_id=wall_id, owner_key=wall.owner_key, _external=True),
+            cancel_url=url_for('upgrade', wall_id=wall.id, owner_key=owner_key, _external=True) + '?canceled=true',
+            payment_intent_data={ # saved with transaction metadata
+                'metadata': {
+                    'site': 'LiveWall',
+                    'wall_id': wall_id,
+                    'owner_key': wall.owner_key
+                }
+            },
+            metadata={ # session metadata
+                'wall_id': wall_id
+            },
+            customer_email=customer_email_address
+        )
 
     return {
         'id': session.id
@@ -402,6 +744,7 @@ def stripe_webhook():
         f.write(payload.encode('utf-8'))
         print(f"Saved payload to {f.name}")
 
+    stripe = get_stripe()
     event = None
     try:
         event = stripe.Webhook.construct_event(
@@ -443,20 +786,16 @@ def stripe_webhook():
                 user = User(wall.owner_email)
                 udl.create(user)
             # send confirmation email
-            html_email = render_template('emails/premium.html',
-                logo=get_image_data_url('static/logo.webp'),
+            outbox().send(
+                wall.owner_email, 
+                "Your LiveWall has entered premium mode", 
+                'emails/premium.html',
                 email=wall.owner_email,
                 wall_link=url_for('wall', wall_id=wall.id, _external=True) + f"?k={wall.owner_key}",
                 moderation_link=url_for('moderation_page', wall_id=wall.id, key=wall.owner_key, _external=True),
-                current_year=datetime.now(tz=timezone.utc).year,
-                expiry=datetime.now(tz=timezone.utc) + timedelta(days=365),
-                booth_link=url_for('photo_booth', wall_id=wall.id, _external=True)
-                )
-            EmailService().send_email(
-                wall.owner_email, 
-                "Your LiveWall has entered premium mode", 
-                html_email,
-                wait_success=False)
+                # jobs carry json, so the date goes as text
+                expiry=(datetime.now(tz=timezone.utc) + timedelta(days=365)).strftime('%Y-%m-%d'),
+                booth_link=url_for('photo_booth', wall_id=wall.id, _external=True))
             # update the page on all screens
             broadcast_event(Event(EventType.UPDATE, None, wall.id))
         else:
@@ -493,40 +832,71 @@ def create_wall():
 def home():
     return render_template('home.html')
 
-print(f"Home:", f"http://localhost:3000/")
-print(f"External:", f"https://chph.eu.ngrok.io/")
-
-def get_image_data_url(image_path):
-    with open(image_path, 'rb') as img_file:
-        encoded_string = base64.b64encode(img_file.read()).decode('utf-8')
-        return f'data:image/webp;base64,{encoded_string}'
-    
 @app.route('/email')
 def email():
-    wall = WallDataLayer().list_walls()[0]
-    user = UserDataLayer().list_users()[0]
+    wall = next(WallDataLayer().iter_walls(page_size=1))
+    user = next(UserDataLayer().iter_users(page_size=1))
     email_address = user.email
-    # render the template email/owner.html
-    email_html = render_template('emails/owner.html', 
-                    logo=get_image_data_url('static/logo.webp'),
-                    email=email_address,
-                    wall_link=url_for('wall', wall_id=wall.id, _external=True) + f"?k={wall.owner_key}",
-                    user_link=url_for('user_page', user_id=user.id, validation_token=user.validation_code, _external=True),
-                    current_year=datetime.now(tz=timezone.utc).year,
-                    )
-    
-    EmailService().send_email(
-        recipientAddress='christopher@frenning.com',
-        subject='Test email',
-        body=email_html,
-        wait_success=False)
-    EmailService().send_email(
-        recipientAddress='c@perceptron.no',
-        subject='Test email',
-        body=email_html,
-        wait_success=False)
+    # queue the template email/owner.html
+    for recipient in ('christopher@frenning.com', 'c@perceptron.no'):
+        outbox().send(
+            recipient,
+            'Test email',
+            'emails/owner.html',
+            email=email_address,
+            wall_link=url_for('wall', wall_id=wall.id, _external=True) + f"?k={wall.owner_key}",
+            user_link=url_for('user_page', user_id=user.id, validation_token=user.validation_code, _external=True))
     return 'Email sent', 201
 
+prewarm_started = threading.Event()
+
+def prewarm():
+    # runs once the port is bound (or on the first request), so a cold
+    # container answers its health check before paying for any of this
+    if prewarm_started.is_set():
+        return
+    prewarm_started.set()
+    threading.Thread(target=_prewarm, name='prewarm', daemon=True).start()
+
+def _prewarm():
+    print(f"Admin", f"http://localhost:3000/{admin_route}")
+    print(f"New wall:", f"http://localhost:3000/start")
+    print(f"Home:", f"http://localhost:3000/")
+    print(f"External:", f"https://chph.eu.ngrok.io/")
+    # the shared clients and their first connections
+    warmup()
+    # workers of a shared queue pick up jobs other processes accepted
+    upload_pipeline()
+    outbox()
+    if MODERATION:
+        moderation_stage()
+    # the libraries behind the first upload, wall and checkout
+    for module in ('PIL.Image', 'qrcode', 'qrcode.image.svg', 'stripe'):
+        try:
+            importlib.import_module(module)
+        except ImportError as ex:
+            print("Prewarm failed", module, ex)
+    for template in ('home.html', 'wall.html', 'camera.html',
+                     'emails/claim.html', 'emails/owner.html', 'emails/premium.html'):
+        app.jinja_env.get_template(template)
+    get_image_data_url('static/logo.webp')
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=port, debug=DEBUG_MODE)
\ No newline at end of file
+    # with the debug reloader only the child process serves requests
+    if EVENT_STREAM == 'async' and (not DEBUG_MODE or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        # idle wall screens are held by an asyncio loop instead of WSGI threads
+        from eventstream import start_in_thread
+        event_stream_server = start_in_thread(event_bus)
+        print(f"Events:", f"http://localhost:{event_stream_server.port}/events")
+    if DEBUG_MODE:
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            prewarm()
+        app.run(host='0.0.0.0', port=port, debug=DEBUG_MODE)
+    else:
+        from werkzeug.serving import make_server
+        # bind first, then warm up while the server is already answering
+        http_server = make_server('0.0.0.0', port, app, threaded=True)
+        print(f"Serving on port {port}")
+        prewarm()
+        http_server.serve_forever()
\ No newline at end of file
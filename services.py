@@ -1,10 +1,21 @@
 import os
-import requests
+import base64
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from datetime import datetime, timedelta, timezone
-from azure.communication.email import EmailClient
-from azure.storage.blob import BlobServiceClient, BlobSasPermissions, generate_blob_sas
-from config import AZURE_STORAGE_CS, AZURE_COMMS_CS, EMAIL_SENDER_ADDRESS
-from config import CONTENT_SAFETY_ENDPOINT, CONTENT_SAFETY_KEY
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError, HttpResponseError
+from clients import get_blob_service_client, get_email_client, get_http_session
+from config import AZURE_STORAGE_CS, AZURE_COMMS_CS, EMAIL_SENDER_ADDRESS, STORAGE_BACKEND
+from config import CONTENT_SAFETY_ENDPOINT, CONTENT_SAFETY_KEY, MODERATION_THRESHOLD
+from config import MAX_UPLOAD_BYTES, UPLOAD_CHUNK_BYTES, UPLOAD_PARALLELISM, UPLOAD_SPOOL_BYTES
+from config import SAS_CACHE_ITEMS, RENDITION_CACHE_ITEMS
+from datalayers import ImageDataLayer
+from metrics import timed
 
 class EmailService:
     def __init__(self, connection_string = AZURE_COMMS_CS, sender_address = EMAIL_SENDER_ADDRESS):
@@ -13,7 +24,7 @@ class EmailService:
 
     def send_email(self, recipientAddress, subject, body, wait_success = False):
         try:
-            client = EmailClient.from_connection_string(self.connection_string)
+            client = get_email_client(self.connection_string)
 
             # if body starts with <!DOCTYPE html> then it is html content
             if body.startswith('<!DOCTYPE html>'):
@@ -39,11 +50,13 @@ class EmailService:
                     }
                 }
 
-            poller = client.begin_send(message)
+            with timed('email', 'send'):
+                poller = client.begin_send(message)
             if not wait_success:
                 return True
             
-            result = poller.result()
+            with timed('email', 'wait'):
+                result = poller.result()
             if result['error'] is not None:
                 return False
             else:
@@ -56,84 +69,385 @@ class EmailService:
 ORIGINALS_CONTAINER_NAME = 'orgs'
 PREVIEWS_CONTAINER_NAME = 'pvs'
 
+# blobs are immutable, let browsers and CDNs keep them
+IMAGE_BLOB_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+SAS_LIFETIME = timedelta(hours=1)
+# hand out a fresh url when less than this is left of the old one
+SAS_REFRESH_MARGIN = timedelta(minutes=10)
+
+# sas urls are reused per blob until they are about to expire, which also
+# keeps the url stable so browser caches keep working. all urls live equally
+# long, so the oldest entry is always the first to expire
+_sas_cache = OrderedDict() # (container, blob) -> (url, expiry)
+_sas_lock = threading.Lock()
+
+# shared by all uploads, each upload also caps its own blocks in flight
+_block_upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_PARALLELISM * 4, thread_name_prefix='block-upload')
+
+class UploadTooLargeError(Exception):
+    pass
+
+def _read_chunk(stream, size):
+    # socket backed streams may return short reads before the end
+    parts = []
+    remaining = size
+    while remaining > 0:
+        part = stream.read(remaining)
+        if not part:
+            break
+        parts.append(part)
+        remaining -= len(part)
+    return b''.join(parts)
+
+def _spool_and_hash(stream, max_bytes, chunk_size = UPLOAD_CHUNK_BYTES):
+    # the blob name is the hash of the whole body, so it has to be read in full
+    # before anything is written. uploads are no longer streamed straight to
+    # the blob: small ones wait in memory, bigger ones spill to a temp file,
+    # and the request holds a body's worth of disk until the blob is written
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        while True:
+            chunk = _read_chunk(stream, chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLargeError()
+            digest.update(chunk)
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    return spool, digest.hexdigest(), size
+
+def _content_settings(content_type):
+    # azure.storage.blob is only imported when blobs really go to azure
+    if STORAGE_BACKEND == 'local':
+        from localblobs import LocalContentSettings as ContentSettings
+    else:
+        from azure.storage.blob import ContentSettings
+    return ContentSettings(content_type=content_type, cache_control=IMAGE_BLOB_CACHE_CONTROL)
+
+def _stage_block(blob_client, block_id, chunk):
+    with timed('blob', 'stage_block'):
+        return blob_client.stage_block(block_id, chunk)
+
 class BlobService:
     def __init__(self, connection_string = AZURE_STORAGE_CS):
         self.connection_string = connection_string
-        self.blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+        self.blob_service_client = get_blob_service_client(connection_string)
 
     def _upload_file_to_blob(self, local_file_name, container_name, blob_name, overwrite=False):
-        blob_service_client = BlobServiceClient.from_connection_string(self.connection_string)
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
-        with open(local_file_name, "rb") as data:
+        blob_client = self.blob_service_client.get_blob_client(container=container_name, blob=blob_name)
+        with open(local_file_name, "rb") as data, timed('blob', 'put'):
             blob_client.upload_blob(data, overwrite=overwrite)
         return blob_client.url
     
-    def _upload_bytes_to_blob(self, data, container_name, blob_name, overwrite=False):
-        blob_service_client = BlobServiceClient.from_connection_string(self.connection_string)
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
-        blob_client.upload_blob(data, overwrite=overwrite)
+    def _upload_bytes_to_blob(self, data, container_name, blob_name, overwrite=False, content_type=None):
+        blob_client = self.blob_service_client.get_blob_client(container=container_name, blob=blob_name)
+        content_settings = _content_settings(content_type)
+        with timed('blob', 'put'):
+            blob_client.upload_blob(data, overwrite=overwrite, content_settings=content_settings)
         return blob_client.url
 
+    def _upload_stream_to_blob(self, stream, container_name, blob_name, max_bytes = MAX_UPLOAD_BYTES,
+                               content_type = None, chunk_size = UPLOAD_CHUNK_BYTES, parallelism = UPLOAD_PARALLELISM,
+                               overwrite = False):
+        # reads at most chunk_size * (parallelism + 1) bytes into memory at a time,
+        # raises UploadTooLargeError as soon as the stream passes max_bytes
+        blob_client = self.blob_service_client.get_blob_client(container=container_name, blob=blob_name)
+        content_settings = _content_settings(content_type)
+
+        chunk = _read_chunk(stream, chunk_size)
+        if len(chunk) < chunk_size:
+            # the whole body fit in one chunk, upload it in a single request
+            if len(chunk) > max_bytes:
+                raise UploadTooLargeError()
+            with timed('blob', 'put'):
+                blob_client.upload_blob(chunk, overwrite=overwrite, content_settings=content_settings)
+            return blob_client.url, len(chunk)
+
+        # larger bodies are staged as blocks in parallel and committed at the end.
+        # the block list is plain ids, which both the sdk and the local store take
+        blocks = []
+        futures = []
+        slots = threading.BoundedSemaphore(parallelism)
+        total = 0
+        try:
+            while chunk:
+                total += len(chunk)
+                if total > max_bytes:
+                    raise UploadTooLargeError()
+                block_id = base64.b64encode(f'{len(blocks):08d}'.encode('utf-8')).decode('utf-8')
+                blocks.append(block_id)
+                slots.acquire()
+                future = _block_upload_executor.submit(_stage_block, blob_client, block_id, chunk)
+                future.add_done_callback(lambda _: slots.release())
+                futures.append(future)
+                # stop reading early if a block already failed
+                if any(f.done() and f.exception() is not None for f in futures):
+                    break
+                chunk = _read_chunk(stream, chunk_size)
+            for future in futures:
+                future.result()
+        except BaseException:
+            # uncommitted blocks are discarded by the storage service
+            for future in futures:
+                future.cancel()
+            raise
+        with timed('blob', 'commit'):
+            blob_client.commit_block_list(blocks, content_settings=content_settings)
+        return blob_client.url, total
+
     def _download_file_from_blob(self, container_name, blob_name, local_file_name):
-        blob_service_client = BlobServiceClient.from_connection_string(self.connection_string)
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
-        with open(local_file_name, "wb") as my_blob:
+        blob_client = self.blob_service_client.get_blob_client(container=container_name, blob=blob_name)
+        with open(local_file_name, "wb") as my_blob, timed('blob', 'get'):
             download_stream = blob_client.download_blob()
             my_blob.write(download_stream.readall())
         return local_file_name
     
     def _download_bytes_from_blob(self, container_name, blob_name):
-        blob_service_client = BlobServiceClient.from_connection_string(self.connection_string)
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
-        return blob_client.download_blob().readall()
+        blob_client = self.blob_service_client.get_blob_client(container=container_name, blob=blob_name)
+        with timed('blob', 'get'):
+            return blob_client.download_blob().readall()
     
-    def _delete_blob(self, container_name, blob_name):
-        blob_service_client = BlobServiceClient.from_connection_string(self.connection_string)
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
-        blob_client.delete_blob()
+    def _delete_blob(self, container_name, blob_name, etag = None):
+        # with an etag, only the blob as it was when the etag was read
+        blob_client = self.blob_service_client.get_blob_client(container=container_name, blob=blob_name)
+        conditions = {'etag': etag, 'match_condition': MatchConditions.IfNotModified} if etag else {}
+        with timed('blob', 'delete'):
+            blob_client.delete_blob(**conditions)
         return True
+
+    def _blob_etag(self, container_name, blob_name):
+        blob_client = self.blob_service_client.get_blob_client(container=container_name, blob=blob_name)
+        try:
+            with timed('blob', 'properties'):
+                return blob_client.get_blob_properties().etag
+        except ResourceNotFoundError:
+            return None
     
     def _get_blob_sas_url(self, container_name, blob_name):
-        blob_service_client = BlobServiceClient.from_connection_string(self.connection_string)
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
-        account_name, account_key = blob_client.account_name, blob_client.credential.account_key
-
-        sas_token = generate_blob_sas(
-            account_name=account_name,
-            container_name=container_name,
-            blob_name=blob_name,
-            account_key=account_key,
-            permission=BlobSasPermissions(read=True),
-            expiry=datetime.now(timezone.utc) + timedelta(hours=1)
-        )
-
-        # compose full url with token
-        return f'https://{account_name}.blob.core.windows.net/{container_name}/{blob_name}?{sas_token}'
-
-    def upload_image(self, image_id, image_data, container_name = ORIGINALS_CONTAINER_NAME):
-        return self._upload_bytes_to_blob(image_data, container_name, image_id)
+        return self._get_blob_sas_url_with_expiry(container_name, blob_name)[0]
+
+    def _get_blob_sas_url_with_expiry(self, container_name, blob_name):
+        now = datetime.now(timezone.utc)
+        with _sas_lock:
+            cached = _sas_cache.get((container_name, blob_name))
+        if cached is not None and cached[1] - now > SAS_REFRESH_MARGIN:
+            return cached
+
+        expiry = now + SAS_LIFETIME
+        if STORAGE_BACKEND == 'local':
+            # signed url served by the app
+            url = self.blob_service_client.signed_url(container_name, blob_name, expiry)
+        else:
+            from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+            blob_client = self.blob_service_client.get_blob_client(container=container_name, blob=blob_name)
+            account_name, account_key = blob_client.account_name, blob_client.credential.account_key
+            sas_token = generate_blob_sas(
+                account_name=account_name,
+                container_name=container_name,
+                blob_name=blob_name,
+                account_key=account_key,
+                permission=BlobSasPermissions(read=True),
+                expiry=expiry
+            )
+            # compose full url with token
+            url = f'https://{account_name}.blob.core.windows.net/{container_name}/{blob_name}?{sas_token}'
+        with _sas_lock:
+            _sas_cache[(container_name, blob_name)] = (url, expiry)
+            _sas_cache.move_to_end((container_name, blob_name))
+            while _sas_cache and (len(_sas_cache) > SAS_CACHE_ITEMS or next(iter(_sas_cache.values()))[1] <= now):
+                _sas_cache.popitem(last=False)
+        return url, expiry
+
+    @staticmethod
+    def _forget_sas_url(container_name, blob_name):
+        with _sas_lock:
+            _sas_cache.pop((container_name, blob_name), None)
+
+    def _blob_exists(self, container_name, blob_name):
+        blob_client = self.blob_service_client.get_blob_client(container=container_name, blob=blob_name)
+        with timed('blob', 'exists'):
+            return blob_client.exists()
+
+    def upload_image(self, image_id, image_data, container_name = ORIGINALS_CONTAINER_NAME, content_type = None):
+        return self._upload_bytes_to_blob(image_data, container_name, image_id, content_type=content_type)
     
+    def upload_image_stream(self, image_id, stream, max_bytes = MAX_UPLOAD_BYTES, container_name = ORIGINALS_CONTAINER_NAME, content_type = None):
+        return self._upload_stream_to_blob(stream, container_name, image_id, max_bytes, content_type=content_type)
+
+    def store_image_stream(self, stream, max_bytes = MAX_UPLOAD_BYTES, content_type = None):
+        # content addressed upload, returns (blob name, size). the bytes are
+        # hashed on the way in, identical uploads add a reference instead of
+        # writing the blob again
+        spool, blob_name, size = _spool_and_hash(stream, max_bytes)
+        with spool:
+            idl = ImageDataLayer()
+            if not idl.add_blob_reference(blob_name, only_existing=True):
+                spool.seek(0)
+                # overwrite, a concurrent identical upload may have got here first
+                self._upload_stream_to_blob(spool, ORIGINALS_CONTAINER_NAME, blob_name, max_bytes,
+                                            content_type=content_type, overwrite=True)
+                idl.add_blob_reference(blob_name)
+        return blob_name, size
+
     def get_image_url(self, image_id, container_name = ORIGINALS_CONTAINER_NAME):
         return self._get_blob_sas_url(container_name, image_id)
+
+    def get_image_url_with_expiry(self, image_id, container_name = ORIGINALS_CONTAINER_NAME):
+        return self._get_blob_sas_url_with_expiry(container_name, image_id)
     
     def get_image(self, image_id, container_name = ORIGINALS_CONTAINER_NAME):
         return self._download_bytes_from_blob(container_name, image_id)
 
     def delete_image(self, image_id, container_name = ORIGINALS_CONTAINER_NAME):
-        return self._delete_blob(container_name, image_id)
+        # originals may be shared, they only go with their last reference.
+        # returns whether the blob was deleted
+        etag, tombstone = None, None
+        if container_name == ORIGINALS_CONTAINER_NAME:
+            # an identical upload that comes in meanwhile sees the tombstone and
+            # writes the blob again, which changes its etag. deleting only the
+            # blob as it was before the reference went keeps the new copy
+            idl = ImageDataLayer()
+            etag = self._blob_etag(container_name, image_id)
+            last, tombstone = idl.release_blob_reference(image_id)
+            if not last:
+                return False
+        self._forget_sas_url(container_name, image_id)
+        try:
+            if tombstone is not None and etag is None:
+                # already gone, and anything there now is a new copy
+                return False
+            return self._delete_blob(container_name, image_id, etag)
+        except ResourceNotFoundError:
+            return False
+        except HttpResponseError as ex:
+            if ex.status_code != 412:
+                raise
+            return False
+        finally:
+            if tombstone is not None:
+                idl.drop_blob_tombstone(image_id, tombstone)
+
+# longest edge in pixels for each rendition, roughly 2x what the pages draw
+RENDITION_SIZES = {
+    'thumb': 256,
+    'wall': 800,
+}
+RENDITION_CONTENT_TYPE = 'image/webp'
+
+# renditions known to exist in the previews container, saves a round trip per redirect
+_known_renditions = OrderedDict() # (blob name, size) -> None, least recently used first
+_known_renditions_lock = threading.Lock()
+
+def _remember_rendition(blob_name, size):
+    with _known_renditions_lock:
+        _known_renditions[(blob_name, size)] = None
+        _known_renditions.move_to_end((blob_name, size))
+        while len(_known_renditions) > RENDITION_CACHE_ITEMS:
+            _known_renditions.popitem(last=False)
+
+def _is_known_rendition(blob_name, size):
+    with _known_renditions_lock:
+        if (blob_name, size) not in _known_renditions:
+            return False
+        _known_renditions.move_to_end((blob_name, size))
+        return True
+
+def _forget_rendition(blob_name, size):
+    with _known_renditions_lock:
+        _known_renditions.pop((blob_name, size), None)
+
+class RenditionService:
+    def __init__(self, blob_service = None):
+        self.blob_service = blob_service if blob_service is not None else BlobService()
+
+    # renditions belong to the original, not to the image, so identical
+    # uploads share them. blob_name is the image id for images stored before
+    # content addressing, which keeps their rendition names
+    @staticmethod
+    def rendition_name(blob_name, size):
+        return f'{blob_name}_{size}.webp'
+
+    def get_rendition(self, blob_name, size):
+        # renditions are made on first request and kept in the previews container
+        name = self.rendition_name(blob_name, size)
+        try:
+            return self.blob_service.get_image(name, PREVIEWS_CONTAINER_NAME)
+        except ResourceNotFoundError:
+            pass
+        return self._create_rendition(blob_name, size)
+
+    def _create_rendition(self, blob_name, size):
+        original = self.blob_service.get_image(blob_name)
+        data = self.render(original, RENDITION_SIZES[size])
+        self.blob_service._upload_bytes_to_blob(data, PREVIEWS_CONTAINER_NAME, self.rendition_name(blob_name, size),
+                                                overwrite=True, content_type=RENDITION_CONTENT_TYPE)
+        _remember_rendition(blob_name, size)
+        return data
+
+    @staticmethod
+    def has_known_rendition(blob_name, size):
+        return _is_known_rendition(blob_name, size)
+
+    def get_rendition_url_with_expiry(self, blob_name, size):
+        # for direct delivery, make sure the rendition exists without downloading it
+        name = self.rendition_name(blob_name, size)
+        if not _is_known_rendition(blob_name, size):
+            if not self.blob_service._blob_exists(PREVIEWS_CONTAINER_NAME, name):
+                self._create_rendition(blob_name, size)
+            _remember_rendition(blob_name, size)
+        return self.blob_service.get_image_url_with_expiry(name, PREVIEWS_CONTAINER_NAME)
+
+    @staticmethod
+    def render(original, max_edge, quality = 80, format = 'WEBP'):
+        from PIL import Image as PILImage, ImageOps
+        with PILImage.open(BytesIO(original)) as img:
+            # phones store rotation in exif, bake it in before it gets stripped
+            img = ImageOps.exif_transpose(img)
+            if format == 'JPEG' and img.mode != 'RGB':
+                # no alpha in jpeg
+                img = img.convert('RGB')
+            elif img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+            img.thumbnail((max_edge, max_edge), PILImage.LANCZOS)
+            buf = BytesIO()
+            if format == 'WEBP':
+                img.save(buf, format=format, quality=quality, method=4)
+            else:
+                img.save(buf, format=format, quality=quality)
+            return buf.getvalue()
+
+    def delete_renditions(self, blob_name):
+        # only once the original itself is gone
+        for size in RENDITION_SIZES:
+            _forget_rendition(blob_name, size)
+            try:
+                self.blob_service.delete_image(self.rendition_name(blob_name, size), PREVIEWS_CONTAINER_NAME)
+            except ResourceNotFoundError:
+                pass
 
 class ModerationService:
     def __init__(self, endpoint = CONTENT_SAFETY_ENDPOINT, key = CONTENT_SAFETY_KEY):
         self.endpoint = endpoint
         self.key = key
 
-    def check_content(self, blob_url, threshold = 3):
+    def check_content(self, blob_url, threshold = MODERATION_THRESHOLD):
         # NOTE: Does not support webp, we must convert to JPG
-        # Also nice to make small resized version to speed up moderation
+        return self._analyze({"blobUrl": blob_url}, threshold)
+
+    def check_image(self, data, threshold = MODERATION_THRESHOLD):
+        # data is a small jpeg, see moderation.py
+        return self._analyze({"content": base64.b64encode(data).decode('ascii')}, threshold)
+
+    def _analyze(self, image, threshold, timeout = 30):
         request = {
-            "image" : {
-                "blobUrl": blob_url
-            },
+            "image" : image,
             "categories": ["Hate", "SelfHarm", "Sexual", "Violence"],
             "outputType": "FourSeverityLevels"
         }
@@ -142,8 +456,10 @@ class ModerationService:
             "Ocp-Apim-Subscription-Key": self.key
         }
         full_endpoint = f'{self.endpoint}/contentsafety/image:analyze?api-version=2024-09-01'
-        response = requests.post(full_endpoint, json=request, headers=headers)
-        response.raise_for_status()  # Raise an exception for HTTP errors
+        # keep-alive connections shared by all moderation workers
+        with timed('content_safety', 'analyze'):
+            response = get_http_session().post(full_endpoint, json=request, headers=headers, timeout=timeout)
+            response.raise_for_status()  # Raise an exception for HTTP errors
         result = response.json()
         for category in result['categoriesAnalysis']:
             if category["severity"] >= threshold:
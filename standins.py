@@ -0,0 +1,93 @@
+import sys
+import json
+import time
+import base64
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Local stand-ins for the external http services, for tests and benchmarks
+# without azure credentials. Point the app at them through the environment,
+# e.g. CONTENT_SAFETY_ENDPOINT=http://127.0.0.1:3100
+
+CATEGORIES = ["Hate", "SelfHarm", "Sexual", "Violence"]
+
+# magic numbers of the formats the real service accepts, webp is not one of them
+ACCEPTED_IMAGE_PREFIXES = (b'\xff\xd8\xff', b'\x89PNG', b'GIF8', b'BM')
+
+
+class ContentSafetyStandIn:
+    # answers image:analyze like azure content safety. severity(data) decides
+    # the severity of every category for the decoded image, 0 by default
+    def __init__(self, host = '127.0.0.1', port = 0, severity = None, latency = 0.0):
+        self.severity = severity if severity is not None else (lambda data: 0)
+        self.latency = latency
+        self.requests = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='content-safety-standin', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _analyze(self, body):
+        # returns (status, response)
+        with self._lock:
+            self.requests += 1
+        try:
+            data = base64.b64decode(json.loads(body)['image']['content'])
+        except (ValueError, KeyError, TypeError):
+            return 400, {'error': {'code': 'InvalidRequestBody'}}
+        if not data.startswith(ACCEPTED_IMAGE_PREFIXES):
+            with self._lock:
+                self.rejected += 1
+            return 400, {'error': {'code': 'InvalidImageFormat'}}
+        if self.latency:
+            time.sleep(self.latency)
+        severity = self.severity(data)
+        return 200, {'categoriesAnalysis': [{'category': c, 'severity': severity} for c in CATEGORIES]}
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path.split('?')[0] != '/contentsafety/image:analyze':
+                    status, response = 404, {}
+                elif not self.headers.get('Ocp-Apim-Subscription-Key'):
+                    status, response = 401, {'error': {'code': 'Unauthorized'}}
+                else:
+                    status, response = standin._analyze(body)
+                payload = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 3100
+    standin = ContentSafetyStandIn(port=port)
+    print("Content safety", standin.endpoint)
+    standin._server.serve_forever()
@@ -0,0 +1,100 @@
+import time
+import threading
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+
+from config import TEMPORARY_WALL_TTL_HOURS, SWEEP_LOOKBACK_DAYS, PURGE_WORKERS
+from datalayers import WallDataLayer, ImageDataLayer, fetch_concurrently
+from events import create_event_bus
+from models import WallStatus
+from services import BlobService, RenditionService
+
+# Removes temporary (NEW) walls older than TEMPORARY_WALL_TTL_HOURS together
+# with their images, blobs and index rows. Walls are found through the daily
+# expiry buckets written by WallDataLayer.create, so a run only reads the
+# buckets that can hold expired walls. Safe to run again after a failure.
+# Usage: python sweeper.py (daily, e.g. from cron)
+
+class ExpirySweeper:
+    def __init__(self, ttl = timedelta(hours=TEMPORARY_WALL_TTL_HOURS), lookback_days = SWEEP_LOOKBACK_DAYS, workers = PURGE_WORKERS,
+                 event_bus = None):
+        self.ttl = ttl
+        self.lookback_days = lookback_days
+        self.workers = workers
+        # running servers cache walls and images, they hear about purges here
+        self.event_bus = event_bus if event_bus is not None else create_event_bus()
+        self._lock = threading.Lock()
+        self.walls_checked = 0
+        self.walls_deleted = 0
+        self.images_deleted = 0
+
+    def sweep(self, now = None):
+        now = now if now is not None else datetime.now(tz=timezone.utc)
+        cutoff = now - self.ttl
+        started = time.time()
+        wdl = WallDataLayer()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sweep') as executor:
+            # every day bucket up to and including the cutoff day
+            for days_back in range(self.lookback_days, -1, -1):
+                day = cutoff - timedelta(days=days_back)
+                wall_ids = wdl.list_expiry_bucket(day)
+                if not wall_ids:
+                    continue
+                print(f"Bucket {wdl.expiry_bucket(day)}: {len(wall_ids)} walls")
+                list(executor.map(lambda wall_id: self._sweep_wall(wall_id, day, cutoff), wall_ids))
+                self._report(started)
+        self._report(started)
+
+    def _sweep_wall(self, wall_id, day, cutoff):
+        try:
+            wdl = WallDataLayer()
+            wall = wdl.get_by_id(wall_id)
+            if wall is not None and wall.status == WallStatus.NEW:
+                if wall.created > cutoff:
+                    # same day bucket, but not old enough yet
+                    self._count(checked=1)
+                    return
+                self._count(walls=1, images=self.purge_wall(wall))
+            # owned, premium and already deleted walls just leave the bucket
+            wdl.remove_from_expiry_bucket(day, wall_id)
+            self._count(checked=1)
+        except Exception as ex:
+            # leave it in the bucket for the next run
+            print("Sweeping wall failed", wall_id, ex)
+
+    def purge_wall(self, wall):
+        # table rows and blobs of all images go in parallel, the wall itself last
+        images = ImageDataLayer().purge_wall(wall.id)
+        fetch_concurrently(self._delete_blobs, images)
+        wdl = WallDataLayer()
+        wdl.delete_stats(wall.id)
+        wdl.delete(wall)
+        self.event_bus.publish_invalidation('wall', wall.id)
+        for image_id, _ in images:
+            self.event_bus.publish_invalidation('image', image_id)
+        return len(images)
+
+    @staticmethod
+    def _delete_blobs(image):
+        _, blob_name = image
+        # the original and its renditions stay while other images share it
+        if BlobService().delete_image(blob_name):
+            RenditionService().delete_renditions(blob_name)
+
+    def _count(self, checked = 0, walls = 0, images = 0):
+        with self._lock:
+            self.walls_checked += checked
+            self.walls_deleted += walls
+            self.images_deleted += images
+
+    def _report(self, started):
+        elapsed = max(time.time() - started, 0.001)
+        print(f"Checked {self.walls_checked} walls, deleted {self.walls_deleted} walls and {self.images_deleted} images "
+              f"in {elapsed:.1f}s ({self.walls_deleted / elapsed:.1f} walls/s, {self.images_deleted / elapsed:.1f} images/s)")
+
+
+if __name__ == '__main__':
+    sweeper = ExpirySweeper()
+    sweeper.sweep()
+    sweeper.event_bus.close()
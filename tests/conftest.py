@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# the app reads its settings at import time, point it at throwaway local stores
+# before any of its modules are imported
+os.environ['STORAGE_BACKEND'] = 'local'
+os.environ['LOCAL_STORAGE_DIR'] = tempfile.mkdtemp(prefix='livewall-tests-')
+os.environ['EMAIL_TRANSPORT'] = 'local'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
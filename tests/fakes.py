@@ -0,0 +1,404 @@
+import re
+import uuid
+import queue
+import threading
+import operator
+from urllib.parse import parse_qs, urlsplit
+from datetime import datetime, timezone
+
+from azure.core import MatchConditions
+from azure.core.paging import ItemPaged
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError, ResourceModifiedError
+from azure.data.tables import TableEntity, TableTransactionError
+
+# In-memory stand-ins for the azure table and blob clients, written from the
+# service documentation and independent of localtables/localblobs, so the
+# same tests can run against both and catch where the local stores drift.
+
+
+def _error(cls, message, status_code):
+    error = cls(message=message)
+    error.status_code = status_code
+    return error
+
+
+# OData filters evaluated on python values
+_TOKEN = re.compile(r"\s*(?:('(?:[^']|'')*')|(datetime'[^']*')|(@\w+)|(-?\d+(?:\.\d+)?)L?|([()])|(\w+))")
+_OPERATORS = {'eq': operator.eq, 'ne': operator.ne, 'gt': operator.gt, 'ge': operator.ge, 'lt': operator.lt, 'le': operator.le}
+
+
+class _Truth:
+    # three valued logic like the service, a comparison with a missing
+    # property is unknown, and so is its negation
+    def __init__(self, value):
+        self.value = value # True, False or None for unknown
+
+    def __and__(self, other):
+        if self.value is False or other.value is False:
+            return _Truth(False)
+        return _Truth(None if None in (self.value, other.value) else True)
+
+    def __or__(self, other):
+        if self.value is True or other.value is True:
+            return _Truth(True)
+        return _Truth(None if None in (self.value, other.value) else False)
+
+    def __invert__(self):
+        return _Truth(None if self.value is None else not self.value)
+
+
+def _compare(entity, name, op, value):
+    actual = entity.get(name)
+    if actual is None:
+        return _Truth(None)
+    if isinstance(actual, bool) != isinstance(value, bool) or isinstance(actual, str) != isinstance(value, str):
+        return _Truth(False)
+    return _Truth(_OPERATORS[op](actual, value))
+
+
+def compile_odata(query, parameters = None):
+    # returns a predicate for an entity
+    parameters = parameters or {}
+    values = []
+    python = []
+    tokens = []
+    position = 0
+    while position < len(query.rstrip()):
+        match = _TOKEN.match(query, position)
+        if match is None:
+            raise ValueError(f'bad filter {query!r}')
+        tokens.append(match.groups())
+        position = match.end()
+
+    def value(token):
+        string, date, param, number, _, word = token
+        if string is not None:
+            return string[1:-1].replace("''", "'")
+        if date is not None:
+            return datetime.fromisoformat(date[9:-1].replace('Z', '+00:00'))
+        if param is not None:
+            return parameters[param[1:]]
+        if number is not None:
+            return float(number) if '.' in number else int(number)
+        return {'true': True, 'false': False}[word]
+
+    i = 0
+    while i < len(tokens):
+        paren, word = tokens[i][4], tokens[i][5]
+        if paren is not None:
+            python.append(paren)
+        elif word in ('and', 'or', 'not'):
+            # same precedence order as not > and > or
+            python.append({'and': '&', 'or': '|', 'not': '~'}[word])
+        else:
+            values.append(value(tokens[i + 2]))
+            python.append(f'_compare(entity, {word!r}, {tokens[i + 1][5]!r}, values[{len(values) - 1}])')
+            i += 2
+        i += 1
+    code = compile(' '.join(python), '<filter>', 'eval')
+    return lambda entity: eval(code, {'_compare': _compare, 'values': values, 'entity': entity}).value is True
+
+
+class FakeTableServiceClient:
+    def __init__(self):
+        self._tables = {}
+
+    def get_table_client(self, table_name):
+        return self._tables.setdefault(table_name, FakeTableClient(table_name))
+
+    def list_tables(self):
+        return [type('TableItem', (), {'name': name})() for name in sorted(self._tables)]
+
+
+class FakeTableClient:
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self._rows = {} # (pk, rk) -> (etag, properties)
+        # the data layers write from several threads
+        self._lock = threading.RLock()
+
+    def _entity(self, key, select = None):
+        etag, properties = self._rows[key]
+        entity = TableEntity()
+        values = dict(properties, PartitionKey=key[0], RowKey=key[1])
+        for name, value in values.items():
+            if select is None or name in select:
+                entity[name] = value
+        entity._metadata = {'etag': etag, 'timestamp': datetime.now(timezone.utc)}
+        return entity
+
+    def get_entity(self, partition_key, row_key, select = None, **kwargs):
+        with self._lock:
+            if (partition_key, row_key) not in self._rows:
+                raise _error(ResourceNotFoundError, 'ResourceNotFound', 404)
+            return self._entity((partition_key, row_key), select)
+
+    def create_entity(self, entity, **kwargs):
+        with self._lock:
+            return self._apply(self._rows, 'create', entity, {})
+
+    def upsert_entity(self, entity, mode = 'merge', **kwargs):
+        with self._lock:
+            return self._apply(self._rows, 'upsert', entity, {'mode': mode})
+
+    def update_entity(self, entity, mode = 'merge', etag = None, match_condition = None, **kwargs):
+        with self._lock:
+            return self._apply(self._rows, 'update', entity, {'mode': mode, 'etag': etag, 'match_condition': match_condition})
+
+    def delete_entity(self, partition_key = None, row_key = None, etag = None, match_condition = None, entity = None, **kwargs):
+        if entity is not None:
+            partition_key, row_key = entity['PartitionKey'], entity['RowKey']
+        try:
+            with self._lock:
+                self._apply(self._rows, 'delete', {'PartitionKey': partition_key, 'RowKey': row_key},
+                            {'etag': etag, 'match_condition': match_condition})
+        except ResourceNotFoundError:
+            # the sdk swallows a 404 on an unconditional delete
+            if match_condition == MatchConditions.IfNotModified:
+                raise
+
+    def submit_transaction(self, operations, **kwargs):
+        operations = list(operations)
+        if len(operations) > 100 or len({op[1]['PartitionKey'] for op in operations}) > 1:
+            raise _error(TableTransactionError, '0:InvalidInput', 400)
+        with self._lock:
+            rows = dict(self._rows)
+            results = []
+            for index, operation in enumerate(operations):
+                action = str(getattr(operation[0], 'value', operation[0])).lower()
+                try:
+                    results.append(self._apply(rows, action, operation[1], operation[2] if len(operation) > 2 else {}))
+                except (ResourceNotFoundError, ResourceExistsError, ResourceModifiedError) as ex:
+                    raise _error(TableTransactionError, f'{index}:{ex.message}', ex.status_code) from ex
+            self._rows = rows
+        return results
+
+    @staticmethod
+    def _apply(rows, action, entity, options):
+        key = (entity['PartitionKey'], entity['RowKey'])
+        current = rows.get(key)
+        if options.get('match_condition') == MatchConditions.IfNotModified and current is not None \
+                and current[0] != options.get('etag'):
+            raise _error(ResourceModifiedError, 'UpdateConditionNotSatisfied', 412)
+        if action == 'delete':
+            if current is None:
+                raise _error(ResourceNotFoundError, 'ResourceNotFound', 404)
+            del rows[key]
+            return {}
+        if action == 'create' and current is not None:
+            raise _error(ResourceExistsError, 'EntityAlreadyExists', 409)
+        if action == 'update' and current is None:
+            raise _error(ResourceNotFoundError, 'ResourceNotFound', 404)
+        properties = {k: v for k, v in entity.items() if k not in ('PartitionKey', 'RowKey') and v is not None}
+        if current is not None and str(getattr(options.get('mode'), 'value', options.get('mode') or 'merge')).lower() == 'merge':
+            properties = dict(current[1], **properties)
+        etag = f'W/"{uuid.uuid4().hex}"'
+        rows[key] = (etag, properties)
+        return {'etag': etag}
+
+    def query_entities(self, query_filter, results_per_page = None, select = None, parameters = None, **kwargs):
+        return self._paged(compile_odata(query_filter, parameters), results_per_page, select)
+
+    def list_entities(self, results_per_page = None, select = None, **kwargs):
+        return self._paged(lambda entity: True, results_per_page, select)
+
+    def _paged(self, predicate, results_per_page, select):
+        # the service pages by key order and hands back the key of the next entity
+        page_size = results_per_page or 1000
+
+        def get_next(token):
+            with self._lock:
+                keys = [key for key in sorted(self._rows)
+                        if (token is None or key >= (token['PartitionKey'], token['RowKey']))
+                        and predicate(self._entity(key))]
+                following = keys[page_size] if len(keys) > page_size else None
+                next_token = {'PartitionKey': following[0], 'RowKey': following[1]} if following else None
+                return next_token, [self._entity(key, select) for key in keys[:page_size]]
+
+        return ItemPaged(get_next, lambda page: (page[0], iter(page[1])))
+
+
+class FakeCredential:
+    def __init__(self, account_key):
+        self.account_key = account_key
+
+
+class FakeBlobServiceClient:
+    account_name = 'fakeaccount'
+
+    def __init__(self):
+        # a valid base64 account key, sas signatures are made with it
+        self.credential = FakeCredential('ZmFrZS1hY2NvdW50LWtleS1mb3ItdGVzdHMtb25seQ==')
+        self._blobs = {} # (container, blob) -> (etag, bytes, content settings)
+
+    def get_blob_client(self, container, blob):
+        return FakeBlobClient(self, container, blob)
+
+    def verify_sas(self, url, now = None):
+        # what the service does with a sas url: check the expiry, then the signature
+        from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+        parts = urlsplit(url)
+        container, blob = parts.path.lstrip('/').split('/', 1)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        expiry = datetime.strptime(query.get('se', ''), '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+        if expiry < (now or datetime.now(timezone.utc)):
+            return False
+        expected = generate_blob_sas(self.account_name, container, blob, account_key=self.credential.account_key,
+                                     permission=BlobSasPermissions(read=True), expiry=expiry)
+        return parse_qs(expected)['sig'][0] == query.get('sig')
+
+
+class FakeBlobClient:
+    def __init__(self, service, container, blob):
+        self.service = service
+        self.account_name = service.account_name
+        self.credential = service.credential
+        self.container_name = container
+        self.blob_name = blob
+        self._blocks = {}
+
+    @property
+    def url(self):
+        return f'https://{self.account_name}.blob.core.windows.net/{self.container_name}/{self.blob_name}'
+
+    @property
+    def _key(self):
+        return (self.container_name, self.blob_name)
+
+    def exists(self):
+        return self._key in self.service._blobs
+
+    def upload_blob(self, data, overwrite = False, content_settings = None, **kwargs):
+        if not overwrite and self.exists():
+            raise _error(ResourceExistsError, 'BlobAlreadyExists', 409)
+        data = data if isinstance(data, bytes) else data.read()
+        self.service._blobs[self._key] = (f'"{uuid.uuid4().hex}"', data, content_settings)
+
+    def stage_block(self, block_id, data, **kwargs):
+        self._blocks[block_id] = bytes(data)
+
+    def commit_block_list(self, block_list, content_settings = None, **kwargs):
+        data = b''.join(self._blocks[getattr(block, 'id', block)] for block in block_list)
+        self.service._blobs[self._key] = (f'"{uuid.uuid4().hex}"', data, content_settings)
+
+    def download_blob(self, **kwargs):
+        if not self.exists():
+            raise _error(ResourceNotFoundError, 'BlobNotFound', 404)
+        data = self.service._blobs[self._key][1]
+        return type('Downloader', (), {'readall': lambda _: data})()
+
+    def get_blob_properties(self, **kwargs):
+        if not self.exists():
+            raise _error(ResourceNotFoundError, 'BlobNotFound', 404)
+        etag, data, content_settings = self.service._blobs[self._key]
+        return type('BlobProperties', (), {'etag': etag, 'size': len(data), 'content_settings': content_settings})()
+
+    def delete_blob(self, etag = None, match_condition = None, **kwargs):
+        if not self.exists():
+            raise _error(ResourceNotFoundError, 'BlobNotFound', 404)
+        if match_condition == MatchConditions.IfNotModified and self.service._blobs[self._key][0] != etag:
+            raise _error(ResourceModifiedError, 'ConditionNotMet', 412)
+        del self.service._blobs[self._key]
+
+
+class FakeRedis:
+    # the few redis commands the event bus uses, pubsub delivery is
+    # immediate to every subscribed connection of the same server
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._lists = {}
+        self._pubsubs = []
+
+    def incr(self, key):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + 1
+            return self._values[key]
+
+    def expire(self, key, seconds):
+        return True
+
+    def lpush(self, key, value):
+        with self._lock:
+            self._lists.setdefault(key, []).insert(0, value.encode('utf-8') if isinstance(value, str) else value)
+            return len(self._lists[key])
+
+    def ltrim(self, key, start, end):
+        with self._lock:
+            self._lists[key] = self._lists.get(key, [])[start:end + 1]
+
+    def lrange(self, key, start, end):
+        with self._lock:
+            values = self._lists.get(key, [])
+            return list(values[start:] if end == -1 else values[start:end + 1])
+
+    def publish(self, channel, message):
+        with self._lock:
+            pubsubs = [p for p in self._pubsubs if channel in p.channels]
+        for pubsub in pubsubs:
+            pubsub.messages.put({'type': 'message', 'channel': channel.encode('utf-8'),
+                                 'data': message.encode('utf-8') if isinstance(message, str) else message})
+        return len(pubsubs)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages = False):
+        pubsub = FakePubSub(self)
+        with self._lock:
+            self._pubsubs.append(pubsub)
+        return pubsub
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self._commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self._commands.append((name, args))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args) for name, args in self._commands]
+
+
+class FakePubSub:
+    def __init__(self, client):
+        self.client = client
+        self.channels = set()
+        self.messages = queue.Queue()
+        self.failures = 0 # the next (un)subscribes to fail, like a dropped connection
+        # called with the channel around a subscribe, to interleave other clients
+        self.before_subscribe = None
+        self.after_subscribe = None
+
+    @property
+    def subscribed(self):
+        return bool(self.channels)
+
+    def _fail(self):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError('connection reset')
+
+    def subscribe(self, channel):
+        self._fail()
+        if self.before_subscribe is not None:
+            self.before_subscribe(channel)
+        self.channels.add(channel)
+        if self.after_subscribe is not None:
+            self.after_subscribe(channel)
+
+    def unsubscribe(self, channel):
+        self._fail()
+        self.channels.discard(channel)
+
+    def get_message(self, timeout = 0):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        with self.client._lock:
+            self.client._pubsubs.remove(self)
@@ -0,0 +1,43 @@
+import pytest
+
+import server
+from datalayers import UserDataLayer, WallDataLayer
+from models import User, Wall
+
+
+def all_pages(list_page):
+    ids, token, pages = [], None, 0
+    while True:
+        items, token = list_page(page_size=2, continuation_token=token)
+        ids += [item.id for item in items]
+        pages += 1
+        if token is None:
+            return ids, pages
+
+
+def test_walls_are_paged_with_continuation_tokens():
+    walls = [Wall() for _ in range(5)]
+    for wall in walls:
+        WallDataLayer().create(wall)
+    ids, pages = all_pages(WallDataLayer().list_walls_page)
+    assert len(ids) == len(set(ids))
+    assert {wall.id for wall in walls} <= set(ids)
+    assert pages >= 3
+
+
+def test_users_are_paged_with_continuation_tokens():
+    users = [User(f'user{n}@example.com') for n in range(3)]
+    for user in users:
+        UserDataLayer().create(user)
+    ids, pages = all_pages(UserDataLayer().list_users_page)
+    assert len(ids) == len(set(ids))
+    assert {user.id for user in users} <= set(ids)
+    assert pages >= 2
+
+
+def test_bad_continuation_token_is_refused():
+    with pytest.raises(ValueError):
+        WallDataLayer().list_walls_page(continuation_token='not a token')
+    client = server.app.test_client()
+    assert client.get(f'/{server.admin_route}?walls=not+a+token').status_code == 400
+    assert client.get(f'/{server.admin_route}').status_code == 200
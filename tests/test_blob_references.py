@@ -0,0 +1,119 @@
+import io
+import os
+import threading
+
+import shortuuid
+from PIL import Image as PILImage
+
+from datalayers import ImageDataLayer
+from models import Image
+from pipeline import LocalJobQueue, Pipeline
+from services import BlobService, RenditionService, ORIGINALS_CONTAINER_NAME, PREVIEWS_CONTAINER_NAME
+
+
+def store(data):
+    return BlobService().store_image_stream(io.BytesIO(data), content_type='image/jpeg')[0]
+
+
+def original_exists(blob_name, container = ORIGINALS_CONTAINER_NAME):
+    blob_client = BlobService().blob_service_client.get_blob_client(container=container, blob=blob_name)
+    return blob_client.exists()
+
+
+def jpeg():
+    buf = io.BytesIO()
+    PILImage.new('RGB', (64, 64), tuple(os.urandom(3))).save(buf, format='JPEG')
+    return buf.getvalue()
+
+
+def test_shared_original_goes_with_its_last_reference():
+    data = os.urandom(1024)
+    blob_name = store(data)
+    assert store(data) == blob_name
+    assert BlobService().delete_image(blob_name) is False
+    assert original_exists(blob_name)
+    assert BlobService().delete_image(blob_name) is True
+    assert not original_exists(blob_name)
+
+
+def test_identical_upload_during_delete_keeps_the_original(monkeypatch):
+    data = os.urandom(1024)
+    blob_name = store(data)
+    release = ImageDataLayer.release_blob_reference
+
+    def release_then_upload(self, name):
+        # the upload lands between the last release and the blob delete
+        result = release(self, name)
+        monkeypatch.setattr(ImageDataLayer, 'release_blob_reference', release)
+        assert store(data) == blob_name
+        return result
+
+    monkeypatch.setattr(ImageDataLayer, 'release_blob_reference', release_then_upload)
+    assert BlobService().delete_image(blob_name) is False
+    assert original_exists(blob_name)
+    # the upload holds the only reference, deleting it removes the blob
+    assert BlobService().delete_image(blob_name) is True
+    assert not original_exists(blob_name)
+
+
+def test_upload_that_takes_over_the_tombstone_after_the_delete(monkeypatch):
+    data = os.urandom(1024)
+    blob_name = store(data)
+    drop = ImageDataLayer.drop_blob_tombstone
+
+    def upload_then_drop(self, name, tombstone):
+        # the blob is gone, the upload writes it again and revives the row
+        monkeypatch.setattr(ImageDataLayer, 'drop_blob_tombstone', drop)
+        assert store(data) == blob_name
+        drop(self, name, tombstone)
+
+    monkeypatch.setattr(ImageDataLayer, 'drop_blob_tombstone', upload_then_drop)
+    assert BlobService().delete_image(blob_name) is True
+    assert original_exists(blob_name)
+    assert BlobService().delete_image(blob_name) is True
+    assert not original_exists(blob_name)
+
+
+def test_identical_uploads_share_their_renditions(monkeypatch):
+    data = jpeg()
+    blob_name = store(data)
+    assert store(data) == blob_name
+    renders = []
+    render = RenditionService.render
+    monkeypatch.setattr(RenditionService, 'render', staticmethod(lambda *args: renders.append(args) or render(*args)))
+    assert RenditionService().get_rendition(blob_name, 'thumb') == RenditionService().get_rendition(blob_name, 'thumb')
+    assert len(renders) == 1
+    rendition = RenditionService.rendition_name(blob_name, 'thumb')
+    # the renditions go with the original, not with the first copy
+    assert BlobService().delete_image(blob_name) is False
+    assert original_exists(rendition, PREVIEWS_CONTAINER_NAME)
+    assert BlobService().delete_image(blob_name) is True
+    RenditionService().delete_renditions(blob_name)
+    assert not original_exists(rendition, PREVIEWS_CONTAINER_NAME)
+
+
+def test_abandoned_upload_gives_its_reference_back():
+    import server
+    data = os.urandom(1024)
+    blob_name = store(data)
+    image = Image(shortuuid.uuid(), 'wall', None, 'image/jpeg')
+    image.size = len(data)
+    image.blob_name = blob_name
+    server.remember_pending_image(image)
+    given_up = threading.Event()
+
+    def abandon(job):
+        server.abandon_upload(job)
+        given_up.set()
+
+    def persist(job):
+        raise OSError('table service is down')
+
+    pipeline = Pipeline(persist, LocalJobQueue(), workers=1, max_attempts=1, name='test', on_give_up=abandon).start()
+    try:
+        pipeline.submit({'image': image.to_dict()})
+        assert given_up.wait(5)
+    finally:
+        pipeline.stop()
+    assert not original_exists(blob_name)
+    assert server.get_pending_image(image.id) is None
@@ -0,0 +1,64 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import clients
+from datalayers import ImageDataLayer, WallDataLayer
+from services import BlobService
+
+CONNECTION_STRING = ('DefaultEndpointsProtocol=https;AccountName=livewalltest;'
+                     'AccountKey=a2V5;EndpointSuffix=core.windows.net')
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/'
+    server.shutdown()
+
+
+def test_services_and_data_layers_share_clients():
+    assert BlobService().blob_service_client is BlobService().blob_service_client
+    # the data layers only wrap the shared table clients to count writes
+    assert ImageDataLayer().table_client._table_client is ImageDataLayer().table_client._table_client
+    assert WallDataLayer().table_client._table_client is not ImageDataLayer().table_client._table_client
+
+
+def test_concurrent_first_use_creates_one_client(monkeypatch):
+    monkeypatch.setattr(clients, 'STORAGE_BACKEND', 'azure')
+    monkeypatch.setattr(clients, '_clients', {})
+    found = []
+    threads = [threading.Thread(target=lambda: found.append(clients.get_blob_service_client(CONNECTION_STRING)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(client) for client in found}) == 1
+    # table clients come from the service client and are shared the same way
+    assert clients.get_table_client('walls', CONNECTION_STRING) is clients.get_table_client('walls', CONNECTION_STRING)
+
+
+def test_pooled_session_reuses_connections(http_server, monkeypatch):
+    monkeypatch.setattr(clients, '_clients', {})
+    session = clients.get_http_session()
+    assert session is clients.get_http_session()
+    opened = clients.connections_opened()
+    for _ in range(5):
+        assert session.get(http_server).text == 'ok'
+    assert clients.connections_opened() - opened == 1
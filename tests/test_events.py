@@ -0,0 +1,160 @@
+import time
+
+import pytest
+
+from events import EventHub, RedisEventBus
+from fakes import FakeRedis
+
+
+def wait_for(condition, timeout = 5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.01)
+
+
+def drain(subscription, count, timeout = 5):
+    return [subscription.queue.get(timeout=timeout) for _ in range(count)]
+
+
+@pytest.fixture
+def redis():
+    return FakeRedis()
+
+
+@pytest.fixture
+def buses(redis):
+    # two workers sharing one redis
+    buses = [RedisEventBus(client=redis, poll_interval=0.01) for _ in range(2)]
+    yield buses
+    for bus in buses:
+        bus.close()
+
+
+def subscribed(bus, wall_id):
+    return lambda: RedisEventBus.CHANNEL_PREFIX + wall_id in bus._pubsub.channels
+
+
+def test_publish(buses):
+    bus = buses[0]
+    subscription = bus.subscribe('w1')
+    wait_for(subscribed(bus, 'w1'))
+    first = bus.publish('w1', 'one')
+    second = bus.publish('w1', 'two')
+    assert second > first
+    assert drain(subscription, 2) == [(first, 'one'), (second, 'two')]
+    assert subscription.queue.empty()
+
+
+def test_fan_out_across_buses(buses):
+    subscriptions = [bus.subscribe('w1') for bus in buses]
+    other = buses[1].subscribe('w2')
+    for bus in buses:
+        wait_for(subscribed(bus, 'w1'))
+    event_id = buses[0].publish('w1', 'hello')
+    for subscription in subscriptions:
+        assert drain(subscription, 1) == [(event_id, 'hello')]
+    assert other.queue.empty()
+
+    # the last local subscriber leaving drops the channel
+    buses[1].unsubscribe(subscriptions[1])
+    wait_for(lambda: not subscribed(buses[1], 'w1')())
+    assert subscribed(buses[1], 'w2')()
+
+
+def test_last_event_id_replay(buses):
+    ids = [buses[0].publish('w1', f'event{i}') for i in range(4)]
+    # a client reconnecting to the other worker picks up where it left off
+    subscription = buses[1].subscribe('w1', last_event_id=ids[1])
+    assert drain(subscription, 2) == [(ids[2], 'event2'), (ids[3], 'event3')]
+    wait_for(subscribed(buses[1], 'w1'))
+    event_id = buses[0].publish('w1', 'live')
+    assert drain(subscription, 1) == [(event_id, 'live')]
+
+
+def test_replay_is_bounded(redis):
+    bus = RedisEventBus(client=redis, poll_interval=0.01)
+    bus.hub.replay_size = 3
+    ids = [bus.publish('w1', f'event{i}') for i in range(5)]
+    subscription = bus.subscribe('w1', last_event_id=0)
+    assert [event_id for event_id, _ in drain(subscription, 3)] == ids[2:]
+    bus.close()
+
+
+def test_failed_subscribe_is_retried(redis, monkeypatch):
+    bus = RedisEventBus(client=redis, poll_interval=0.01)
+    bus._pubsub.failures = 2
+    monkeypatch.setattr(bus._closed, 'wait', lambda timeout: bus._closed.is_set())
+    invalidations = []
+    bus.on_invalidation(lambda kind, key: invalidations.append((kind, key)))
+    subscription = bus.subscribe('w1')
+    wait_for(subscribed(bus, 'w1'))
+    assert bus._listener.is_alive()
+    # both subscribes survived the errors, in the order they were asked for
+    bus.publish_invalidation('wall', 'w1')
+    event_id = bus.publish('w1', 'hello')
+    assert drain(subscription, 1) == [(event_id, 'hello')]
+    wait_for(lambda: invalidations == [('wall', 'w1')])
+    bus.close()
+
+
+def test_replay_has_no_gap_and_no_duplicates(buses):
+    publisher, bus = buses
+    first = publisher.publish('w1', 'before')
+    # one event lands before the channel is live, one after it but before
+    # the history is read, so it comes both ways
+    def while_subscribing(channel):
+        time.sleep(0.1)
+        publisher.publish('w1', 'while subscribing')
+    bus._pubsub.before_subscribe = while_subscribing
+    bus._pubsub.after_subscribe = lambda channel: publisher.publish('w1', 'just subscribed')
+    subscription = bus.subscribe('w1', last_event_id=first - 1)
+    assert [data for _, data in drain(subscription, 3)] == ['before', 'while subscribing', 'just subscribed']
+    event_id = publisher.publish('w1', 'live')
+    assert drain(subscription, 1) == [(event_id, 'live')]
+    assert subscription.queue.empty()
+
+
+def test_history_is_kept_for_recent_walls_only():
+    hub = EventHub(history_walls=2)
+    for wall_id in ('w1', 'w2', 'w3'):
+        hub.publish(wall_id, 'hello')
+    hub.publish('w2', 'again')
+    hub.publish('w4', 'hello')
+    assert list(hub._history) == ['w2', 'w4']
+    assert set(hub._last_ids) == {'w2', 'w4'}
+
+
+def test_events_reach_their_own_wall_only():
+    hub = EventHub()
+    first, second = hub.subscribe('first'), hub.subscribe('second')
+    event_id = hub.publish('first', 'hello')
+    assert drain(first, 1) == [(event_id, 'hello')]
+    assert second.queue.empty()
+
+
+def test_slow_consumer_is_evicted():
+    hub = EventHub(queue_size=2)
+    slow, fast = hub.subscribe('wall'), hub.subscribe('wall')
+    for i in range(3):
+        hub.publish('wall', f'event {i}')
+        drain(fast, 1)
+    assert slow.evicted and not fast.evicted
+    assert hub.subscriber_count('wall') == 1
+    # the stream of an evicted subscription ends instead of waiting for more
+    assert list(slow.stream(heartbeat_interval=0.01))[0].startswith('retry:')
+
+
+def test_idle_stream_gets_heartbeats():
+    stream = EventHub().subscribe('wall').stream(heartbeat_interval=0.01)
+    assert next(stream).startswith('retry:')
+    assert next(stream) == ': keepalive\n\n'
+
+
+def test_reconnect_replays_missed_events():
+    hub = EventHub(replay_size=2)
+    ids = [hub.publish('wall', f'event {i}') for i in range(3)]
+    # only what came after the last seen id, and only as far back as the buffer goes
+    assert drain(hub.subscribe('wall', last_event_id=ids[1]), 1) == [(ids[2], 'event 2')]
+    assert drain(hub.subscribe('wall', last_event_id=0), 2) == [(ids[1], 'event 1'), (ids[2], 'event 2')]
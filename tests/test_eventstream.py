@@ -0,0 +1,69 @@
+import socket
+
+import pytest
+
+import server
+from datalayers import WallDataLayer
+from events import LocalEventBus
+from eventstream import start_in_thread
+from models import Wall
+from test_events import wait_for
+
+
+@pytest.fixture
+def stream():
+    bus = LocalEventBus()
+    events = start_in_thread(bus, '127.0.0.1', 0)
+    port = events._server.sockets[0].getsockname()[1]
+    return bus, port
+
+
+def connect(port, wall_id):
+    client = socket.create_connection(('127.0.0.1', port), timeout=5)
+    client.sendall(f'GET /events?w={wall_id} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode('utf-8'))
+    return client, client.makefile('rb')
+
+
+def read_frame(stream):
+    # one server-sent event block, up to its blank line
+    lines = []
+    while True:
+        line = stream.readline().decode('utf-8')
+        if line in ('\r\n', '\n', ''):
+            if lines:
+                return ''.join(lines)
+            continue
+        lines.append(line)
+
+
+def test_each_client_gets_its_own_wall(stream):
+    bus, port = stream
+    clients = {wall_id: connect(port, wall_id) for wall_id in ('w1', 'w2')}
+    for _, reader in clients.values():
+        assert read_frame(reader).startswith('HTTP/1.1 200 OK')
+        assert read_frame(reader) == 'retry: 3000\n'
+    wait_for(lambda: bus.hub.subscriber_count() == 2)
+    first = bus.publish('w1', 'one')
+    second = bus.publish('w2', 'two')
+    assert read_frame(clients['w1'][1]) == f'id: {first}\ndata: one\n'
+    assert read_frame(clients['w2'][1]) == f'id: {second}\ndata: two\n'
+
+    # a client that hangs up is dropped without waiting for an event to fail
+    for end in clients['w1']:
+        end.close()
+    wait_for(lambda: bus.hub.subscriber_count('w1') == 0)
+    assert bus.hub.subscriber_count('w2') == 1
+    for end in clients['w2']:
+        end.close()
+
+
+def test_wall_connects_to_the_async_stream(monkeypatch):
+    wall = Wall()
+    WallDataLayer().create(wall)
+    client = server.app.test_client()
+    monkeypatch.setattr(server, 'EVENT_STREAM', 'async')
+    page = client.get(f'/w/{wall.id}?k={wall.owner_key}').get_data(as_text=True)
+    assert f'"http://localhost:{server.EVENTS_PORT}/events?w={wall.id}"' in page
+    monkeypatch.setattr(server, 'EVENTS_URL', 'https://events.example.com/events')
+    page = client.get(f'/w/{wall.id}?k={wall.owner_key}').get_data(as_text=True)
+    assert f'"https://events.example.com/events?w={wall.id}"' in page
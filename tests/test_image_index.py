@@ -0,0 +1,63 @@
+import pytest
+import shortuuid
+
+from datalayers import ImageDataLayer, start_counting_writes
+from models import Image
+
+
+def add_images(wall_id, count, hidden = ()):
+    images = []
+    for n in range(count):
+        image = Image(shortuuid.uuid(), wall_id, None, 'image/jpeg')
+        image.timestamp = 1700000000 + n
+        image.hidden = n in hidden
+        ImageDataLayer().create(image)
+        images.append(image)
+    return images
+
+
+def all_pages(wall_id, limit, newest_first = True):
+    ids, cursor = [], None
+    while True:
+        images, cursor = ImageDataLayer().list_images_page(wall_id, limit=limit, cursor=cursor, newest_first=newest_first)
+        ids += [image['id'] for image in images]
+        if cursor is None:
+            return ids
+
+
+def test_upload_costs_two_round_trips():
+    image = Image(shortuuid.uuid(), shortuuid.uuid(), None, 'image/jpeg')
+    writes = start_counting_writes()
+    ImageDataLayer().create(image)
+    # the id index, and one batch with the image row and both index rows
+    assert (writes.requests, writes.entities) == (2, 4)
+
+
+def test_cursor_pages_through_every_image_once():
+    wall_id = shortuuid.uuid()
+    images = add_images(wall_id, 7, hidden={3})
+    visible = [image.id for image in images if not image.hidden]
+    for limit in (1, 2, 6, 7):
+        assert all_pages(wall_id, limit) == visible[::-1]
+        assert all_pages(wall_id, limit, newest_first=False) == visible
+
+
+def test_index_follows_hiding_and_deletes():
+    wall_id = shortuuid.uuid()
+    first, second = add_images(wall_id, 2)
+    ImageDataLayer().set_hidden(first, True)
+    assert all_pages(wall_id, 10) == [second.id]
+    ImageDataLayer().set_hidden(first, False)
+    assert all_pages(wall_id, 10) == [second.id, first.id]
+    ImageDataLayer().delete(second)
+    assert all_pages(wall_id, 10) == [first.id]
+
+
+def test_cursor_of_the_other_order_is_refused():
+    wall_id = shortuuid.uuid()
+    add_images(wall_id, 3)
+    _, cursor = ImageDataLayer().list_images_page(wall_id, limit=1)
+    with pytest.raises(ValueError):
+        ImageDataLayer().list_images_page(wall_id, limit=1, cursor=cursor, newest_first=False)
+    with pytest.raises(ValueError):
+        ImageDataLayer().list_images_page(wall_id, limit=1, cursor='not a cursor')
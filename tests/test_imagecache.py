@@ -0,0 +1,57 @@
+import os
+import threading
+
+from imagecache import ImageCache
+
+
+def test_evictions_prune_the_id_index(tmp_path):
+    cache = ImageCache(memory_bytes=800, disk_bytes=300, directory=str(tmp_path), metadata_items=10)
+    for n in range(20):
+        cache.get(f'img{n}', 'thumb', lambda: b'x' * 100)
+    # eight fit in memory and three on disk, the rest were evicted from both
+    assert set(cache._keys_by_id) == {f'img{n}' for n in range(12, 20)}
+
+
+def test_load_started_before_an_invalidation_is_not_stored(tmp_path):
+    cache = ImageCache(memory_bytes=1000, disk_bytes=1000, directory=str(tmp_path), metadata_items=10)
+    started, release = threading.Event(), threading.Event()
+
+    def slow_loader(image_id):
+        started.set()
+        release.wait()
+        return 'old'
+
+    result = []
+    reader = threading.Thread(target=lambda: result.append(cache.get_metadata('img', slow_loader)))
+    reader.start()
+    started.wait()
+    cache.invalidate('img')
+    # a read after the invalidation doesn't join the stale load
+    assert cache.get_metadata('img', lambda image_id: 'new') == 'new'
+    release.set()
+    reader.join()
+    assert result == ['old']
+    assert cache.get_metadata('img', lambda image_id: 'newer') == 'new'
+
+
+def test_bytes_loaded_before_an_invalidation_are_not_stored(tmp_path):
+    cache = ImageCache(memory_bytes=1000, disk_bytes=1000, directory=str(tmp_path), metadata_items=10)
+
+    def loader():
+        cache.invalidate('img')
+        return b'deleted'
+
+    assert cache.get('img', 'thumb', loader) == b'deleted'
+    assert cache.stats()['memory_items'] == 0 and cache.stats()['disk_items'] == 0
+    assert os.listdir(cache.directory) == []
+
+
+def test_each_cache_keeps_to_its_own_directory(tmp_path):
+    (tmp_path / 'keep.txt').write_text('not the cache')
+    caches = [ImageCache(memory_bytes=0, disk_bytes=1000, directory=str(tmp_path)) for _ in range(2)]
+    for n, cache in enumerate(caches):
+        assert os.path.dirname(cache.directory) == str(tmp_path)
+        cache.get('img', 'thumb', lambda: b'x' * (n + 1))
+    # a second worker starting doesn't wipe the first one's files or anything else
+    assert (tmp_path / 'keep.txt').read_text() == 'not the cache'
+    assert caches[0].get('img', 'thumb', lambda: b'reloaded').size == 1
@@ -0,0 +1,35 @@
+import pytest
+
+import metrics
+import server
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+def test_metrics_are_off_without_a_token(client, monkeypatch):
+    monkeypatch.setattr(server, 'METRICS_TOKEN', None)
+    assert client.get('/metrics').status_code == 404
+
+
+def test_metrics_want_the_token(client, monkeypatch):
+    monkeypatch.setattr(server, 'METRICS_TOKEN', 'secret')
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert response.content_type == metrics.CONTENT_TYPE
+    assert '# TYPE livewall_http_requests_total counter' in response.get_data(as_text=True)
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram('test_seconds', 'Test.', ('op',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe(value, 'get')
+    samples = {(name, labels): value for name, labels, value in histogram.samples()}
+    assert samples[('test_seconds_bucket', '{op="get",le="0.1"}')] == 1
+    assert samples[('test_seconds_bucket', '{op="get",le="1"}')] == 2
+    assert samples[('test_seconds_bucket', '{op="get",le="+Inf"}')] == 3
+    assert samples[('test_seconds_count', '{op="get"}')] == 3
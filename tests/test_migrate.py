@@ -0,0 +1,36 @@
+import shortuuid
+
+from datalayers import ImageDataLayer, WallDataLayer
+from migrate import migrate_image_index, migrate_wall_stats
+from models import Image
+
+
+def add_image(wall_id, size, hidden = False):
+    image = Image(shortuuid.uuid(), wall_id, None, 'image/jpeg')
+    image.size = size
+    image.hidden = hidden
+    ImageDataLayer().create(image)
+    return image
+
+
+def test_stats_count_visible_images_and_their_bytes():
+    wall_id = shortuuid.uuid()
+    shown = add_image(wall_id, 100)
+    add_image(wall_id, 50)
+    add_image(wall_id, 1000, hidden=True)
+    migrate_wall_stats([wall_id])
+    wdl = WallDataLayer()
+    stats = wdl.get_stats_for_walls([wall_id])[wall_id]
+    assert (stats.num_images, stats.bytes_stored) == (2, 150)
+    # counted images can be taken off again
+    assert wdl.remove_image_from_stats(wall_id, shown.id, shown.size) is not None
+    assert wdl.get_stats_for_walls([wall_id])[wall_id].bytes_stored == 50
+
+
+def test_index_skips_hidden_images():
+    wall_id = shortuuid.uuid()
+    shown = add_image(wall_id, 100)
+    add_image(wall_id, 100, hidden=True)
+    migrate_image_index([wall_id])
+    images, _ = ImageDataLayer().list_images_page(wall_id)
+    assert [image['id'] for image in images] == [shown.id]
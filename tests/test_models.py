@@ -0,0 +1,42 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import models
+from models import Image, User, Wall, WallStats, WallStatus
+
+CREATED = '2026-01-02T03:04:05+00:00'
+
+
+def wall_entity():
+    return {'id': 'wall', 'owner_key': 'key', 'owner_email': None, 'status': WallStatus.NEW.value,
+            'created': CREATED, 'modified': CREATED}
+
+
+@pytest.mark.parametrize('model', [User('a@example.com'), Image('image', 'wall'), Wall(), WallStats('wall')])
+def test_models_have_no_instance_dict(model):
+    assert not hasattr(model, '__dict__')
+    with pytest.raises(AttributeError):
+        model.misspelled = True
+
+
+def test_timestamps_are_parsed_on_first_read_only():
+    wall = Wall.create_from_entity(wall_entity())
+    assert wall._created == CREATED
+    # written back untouched when nobody looked at it
+    assert wall.to_dict()['created'] == CREATED
+    assert wall.created == datetime(2026, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+    assert wall.created is wall._created
+    assert wall.to_dict()['created'] == CREATED
+
+
+def test_hydration_skips_the_constructor(monkeypatch):
+    # listing thousands of rows shouldn't mint ids and keys only to overwrite them
+    monkeypatch.setattr(models.shortuuid, 'uuid', lambda: pytest.fail('constructor ran'))
+    wall = Wall.create_from_entity(wall_entity())
+    assert (wall.id, wall.owner_key, wall.image_ids) == ('wall', 'key', [])
+    image = Image.create_from_entity(Image.create_from_entity(dict(
+        id='image', wall_id='wall', blob_url=None, content_type='image/jpeg', owner_key='key',
+        timestamp=1.5, created=CREATED, modified=CREATED)).to_dict())
+    # images from before content addressing are stored under their id
+    assert (image.blob_name, image.size, image.hidden) == ('image', 0, False)
@@ -0,0 +1,85 @@
+import io
+
+import pytest
+import shortuuid
+from PIL import Image as PILImage
+
+from models import Image
+from moderation import ModerationStage, VerdictCache
+from pipeline import LocalJobQueue
+
+
+class HttpError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f'{status_code} error')
+        self.response = type('Response', (), {'status_code': status_code})()
+
+
+class FakeService:
+    def __init__(self, answer):
+        self.answer = answer
+        self.calls = 0
+
+    def check_image(self, data):
+        self.calls += 1
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return self.answer
+
+
+def jpeg(color):
+    buf = io.BytesIO()
+    PILImage.new('RGB', (32, 32), color).save(buf, format='JPEG')
+    return buf.getvalue()
+
+
+class Originals:
+    # blob name -> bytes, counting downloads
+    def __init__(self, **blobs):
+        self.blobs = blobs
+        self.loads = 0
+
+    def __call__(self, image):
+        self.loads += 1
+        return self.blobs[image.blob_name]
+
+
+def upload(blob_name):
+    image = Image(shortuuid.uuid(), 'wall', None, 'image/jpeg')
+    image.blob_name = blob_name
+    return image
+
+
+def stage(service, originals = None):
+    originals = originals or Originals(red=jpeg('red'), green=jpeg('green'), blue=jpeg('blue'), junk=b'not an image')
+    return ModerationStage(originals, None, service=service, verdicts=VerdictCache(), job_queue=LocalJobQueue())
+
+
+def test_verdict_is_remembered():
+    service = FakeService(True)
+    originals = Originals(red=jpeg('red'))
+    moderation = stage(service, originals)
+    assert moderation.check(upload('red')) is True
+    # the same photo again, under its content hash
+    assert moderation.check(upload('red')) is True
+    assert service.calls == 1
+    assert originals.loads == 1
+
+
+def test_undecodable_image_is_a_final_verdict():
+    service = FakeService(True)
+    assert stage(service).check(upload('junk')) is False
+    assert service.calls == 0
+
+
+def test_rejected_request_is_a_final_verdict():
+    assert stage(FakeService(HttpError(400))).check(upload('green')) is False
+
+
+def test_service_outage_is_retried():
+    moderation = stage(FakeService(HttpError(503)))
+    with pytest.raises(HttpError):
+        moderation.check(upload('blue'))
+    # nothing remembered, the next attempt asks again
+    moderation.service = FakeService(True)
+    assert moderation.check(upload('blue')) is True
@@ -0,0 +1,33 @@
+import server
+from datalayers import WallDataLayer
+from models import Wall
+from qrcodes import QRCode, QRCodeCache
+
+
+def test_codes_are_built_and_rendered_once():
+    cache = QRCodeCache(max_items=2)
+    code = cache.get('a', 'https://example.com/camera?w=a')
+    assert cache.get('a', 'https://example.com/camera?w=a') is code
+    assert code.render('png') is code.render('png')
+    # another host is another code
+    assert cache.get('a', 'https://other.example.com/camera?w=a') is not code
+    cache.get('b', 'https://example.com/camera?w=b')
+    assert cache.stats() == {'hits': 1, 'misses': 3, 'items': 2}
+    assert cache.get('a', 'https://example.com/camera?w=a') is not code
+
+
+def test_qr_endpoint_revalidates_with_its_etag():
+    wall = Wall()
+    WallDataLayer().create(wall)
+    client = server.app.test_client()
+    response = client.get(f'/w/{wall.id}/qr.png')
+    assert response.status_code == 200
+    assert response.content_type == 'image/png'
+    assert response.data.startswith(b'\x89PNG')
+    etag = response.headers['ETag']
+    assert etag == f'"{QRCode(f"http://localhost/camera?w={wall.id}").etag}"'
+    revalidated = client.get(f'/w/{wall.id}/qr.png', headers={'If-None-Match': etag})
+    assert revalidated.status_code == 304 and revalidated.data == b''
+    assert client.get(f'/w/{wall.id}/qr.svg').data.startswith(b'<')
+    assert client.get(f'/w/{wall.id}/qr.gif').status_code == 404
+    assert client.get('/w/nowall/qr.png').status_code == 404
@@ -0,0 +1,106 @@
+import io
+import os
+import sys
+import subprocess
+
+import pytest
+from PIL import Image as PILImage
+
+import server
+from datalayers import WallDataLayer
+from imagecache import ImageCache
+from models import Wall
+from services import RenditionService
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+@pytest.fixture
+def wall():
+    wall = Wall()
+    WallDataLayer().create(wall)
+    return wall
+
+
+def jpeg(size = (1024, 768)):
+    buf = io.BytesIO()
+    PILImage.new('RGB', size, tuple(os.urandom(3))).save(buf, format='JPEG')
+    return buf.getvalue()
+
+
+def upload(client, wall, data):
+    # answered as soon as the bytes are stored, /i/ finds it before it is persisted
+    response = client.post(f'/w/{wall.id}', data=data, content_type='image/jpeg')
+    assert response.status_code == 202
+    return response.get_json()['location']
+
+
+def test_import_starts_no_threads(tmp_path):
+    # cold starts only pay for the imports, workers and files wait for prewarm
+    code = ("import threading, server\n"
+            "print(sorted(thread.name for thread in threading.enumerate()))\n"
+            "print(server.background_workers, server.get_image_data_url.cache_info().currsize)\n")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True,
+                            env=dict(os.environ, STORAGE_BACKEND='local', LOCAL_STORAGE_DIR=str(tmp_path)))
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().splitlines()[-2:] == ["['MainThread']", '{} 0']
+
+
+def test_renditions_are_made_once_and_downscaled(client, wall, monkeypatch):
+    location = upload(client, wall, jpeg())
+    renders = []
+    render = RenditionService.render
+    monkeypatch.setattr(RenditionService, 'render', staticmethod(lambda *args: renders.append(args) or render(*args)))
+    response = client.get(f'{location}?size=thumb')
+    assert response.status_code == 200
+    assert response.content_type == 'image/webp'
+    with PILImage.open(io.BytesIO(response.data)) as img:
+        assert max(img.size) == 256
+    # the rendition is stored, a cold cache reads it instead of rendering again
+    server.image_cache.invalidate(location.rsplit('/', 1)[1])
+    assert client.get(f'{location}?size=thumb').data == response.data
+    assert len(renders) == 1
+    assert client.get(f'{location}?size=huge').status_code == 400
+
+
+@pytest.mark.parametrize('tier', ['memory', 'disk'])
+def test_conditional_and_range_requests(client, wall, tier, tmp_path, monkeypatch):
+    if tier == 'disk':
+        # nothing fits in memory, hits are sent from the file
+        monkeypatch.setattr(server, 'image_cache', ImageCache(memory_bytes=0, directory=str(tmp_path)))
+    data = jpeg()
+    location = upload(client, wall, data)
+    response = client.get(location)
+    assert response.status_code == 200 and response.data == data
+    assert response.headers['Cache-Control'] == server.IMAGE_CACHE_CONTROL
+    etag = response.headers['ETag']
+    # served twice so the second one is a cache hit
+    for _ in range(2):
+        assert client.get(location, headers={'If-None-Match': etag}).status_code == 304
+        assert client.get(location, headers={'If-Modified-Since': response.headers['Last-Modified']}).status_code == 304
+        partial = client.get(location, headers={'Range': 'bytes=10-19'})
+        assert partial.status_code == 206 and partial.data == data[10:20]
+        assert partial.headers['Content-Range'] == f'bytes 10-19/{len(data)}'
+        assert client.get(location, headers={'Range': f'bytes={len(data)}-'}).status_code == 416
+
+
+def test_redirects_reuse_the_sas_url_until_it_nears_expiry(client, wall, monkeypatch):
+    import services
+    monkeypatch.setattr(server, 'IMAGE_DELIVERY', 'redirect')
+    data = jpeg()
+    location = upload(client, wall, data)
+    first, second = client.get(location), client.get(location)
+    assert first.status_code == 302
+    assert first.headers['Location'] == second.headers['Location']
+    max_age = int(first.headers['Cache-Control'].split('max-age=')[1])
+    assert 0 < max_age <= (services.SAS_LIFETIME - services.SAS_REFRESH_MARGIN).total_seconds()
+    assert client.get(first.headers['Location']).data == data
+    # inside the refresh margin a new url is signed, good for the full lifetime
+    for key, (url, expiry) in list(services._sas_cache.items()):
+        services._sas_cache[key] = (url, expiry - services.SAS_LIFETIME + services.SAS_REFRESH_MARGIN / 2)
+    refreshed = client.get(location).headers['Cache-Control']
+    assert int(refreshed.split('max-age=')[1]) >= max_age - 5
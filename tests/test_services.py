@@ -0,0 +1,43 @@
+import os
+import sys
+import subprocess
+from datetime import datetime, timedelta, timezone
+
+import services
+from services import BlobService, RenditionService
+
+
+def test_sas_cache_is_bounded_and_drops_expired_urls(monkeypatch):
+    monkeypatch.setattr(services, 'SAS_CACHE_ITEMS', 3)
+    monkeypatch.setattr(services, '_sas_cache', services.OrderedDict())
+    services._sas_cache[('orgs', 'expired')] = ('url', datetime.now(timezone.utc) - timedelta(minutes=1))
+    for n in range(5):
+        BlobService().get_image_url(f'blob{n}')
+    assert list(services._sas_cache) == [('orgs', 'blob2'), ('orgs', 'blob3'), ('orgs', 'blob4')]
+    # still fresh, handed out again
+    assert BlobService().get_image_url('blob4') == services._sas_cache[('orgs', 'blob4')][0]
+
+
+def test_known_renditions_are_bounded(monkeypatch):
+    monkeypatch.setattr(services, 'RENDITION_CACHE_ITEMS', 2)
+    monkeypatch.setattr(services, '_known_renditions', services.OrderedDict())
+    services._remember_rendition('a', 'thumb')
+    services._remember_rendition('b', 'thumb')
+    assert RenditionService.has_known_rendition('a', 'thumb')
+    services._remember_rendition('c', 'thumb')
+    # a was used more recently than b
+    assert RenditionService.has_known_rendition('a', 'thumb')
+    assert not RenditionService.has_known_rendition('b', 'thumb')
+
+
+def test_local_block_uploads_leave_the_blob_sdk_alone(tmp_path):
+    # block ids are plain strings, so the local store never loads azure.storage.blob
+    code = ("import io, sys, services\n"
+            "services.BlobService()._upload_stream_to_blob(io.BytesIO(b'x' * 5000), 'orgs', 'big', chunk_size=1000)\n"
+            "assert services.BlobService().get_image('big') == b'x' * 5000\n"
+            "print('azure.storage.blob' in sys.modules)\n")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True,
+                            env=dict(os.environ, STORAGE_BACKEND='local', LOCAL_STORAGE_DIR=str(tmp_path)))
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().splitlines()[-1] == 'False'
@@ -0,0 +1,34 @@
+import shortuuid
+
+from datalayers import WallDataLayer
+
+
+def test_image_is_counted_once():
+    wdl = WallDataLayer()
+    wall_id = shortuuid.uuid()
+    assert wdl.add_image_to_stats(wall_id, 'img1', 100, 1.0) is not None
+    # a retried upload job
+    assert wdl.add_image_to_stats(wall_id, 'img1', 100, 1.0) is None
+    assert wdl.add_image_to_stats(wall_id, 'img2', 50, 2.0) is not None
+    stats = wdl.get_stats_for_walls([wall_id])[wall_id]
+    assert (stats.num_images, stats.bytes_stored) == (2, 150)
+
+
+def test_only_counted_images_are_removed():
+    wdl = WallDataLayer()
+    wall_id = shortuuid.uuid()
+    wdl.add_image_to_stats(wall_id, 'img1', 100, 1.0)
+    assert wdl.remove_image_from_stats(wall_id, 'never-counted', 40) is None
+    assert wdl.remove_image_from_stats(wall_id, 'img1', 100) is not None
+    assert wdl.remove_image_from_stats(wall_id, 'img1', 100) is None
+    stats = wdl.get_stats_for_walls([wall_id])[wall_id]
+    assert (stats.num_images, stats.bytes_stored) == (0, 0)
+
+
+def test_delete_stats_removes_the_markers():
+    wdl = WallDataLayer()
+    wall_id = shortuuid.uuid()
+    wdl.add_image_to_stats(wall_id, 'img1', 100, 1.0)
+    wdl.delete_stats(wall_id)
+    assert not wdl.is_counted(wall_id, 'img1')
+    assert wdl.add_image_to_stats(wall_id, 'img1', 100, 1.0) is not None
@@ -0,0 +1,270 @@
+import io
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.data.tables import TableTransactionError
+
+import datalayers
+import services
+from fakes import FakeTableServiceClient, FakeBlobServiceClient
+from localblobs import FileBlobServiceClient
+from localtables import SqliteTableServiceClient, FilterError, compile_filter
+from services import BlobService
+
+# The same behaviour is expected from the local stores and from azure,
+# stood in for here by the fakes
+
+
+@pytest.fixture(params=['local', 'azure'])
+def table(request, tmp_path):
+    if request.param == 'local':
+        return SqliteTableServiceClient(str(tmp_path / 'tables.db')).get_table_client('things')
+    return FakeTableServiceClient().get_table_client('things')
+
+
+@pytest.fixture(params=['local', 'azure'])
+def blob_service(request, tmp_path, monkeypatch):
+    if request.param == 'local':
+        client = FileBlobServiceClient(str(tmp_path / 'blobs'))
+    else:
+        client = FakeBlobServiceClient()
+        monkeypatch.setattr(services, 'STORAGE_BACKEND', 'azure')
+    monkeypatch.setattr(services, '_sas_cache', services.OrderedDict())
+    service = BlobService()
+    service.blob_service_client = client
+    return service
+
+
+def keys(entities):
+    return [(entity['PartitionKey'], entity['RowKey']) for entity in entities]
+
+
+def fill(table):
+    table.create_entity({'PartitionKey': 'a', 'RowKey': '1', 'size': 10, 'hidden': False, 'name': "o'neil"})
+    table.create_entity({'PartitionKey': 'a', 'RowKey': '2', 'size': 20, 'hidden': True, 'ts': 1.5})
+    table.create_entity({'PartitionKey': 'a', 'RowKey': '~n~1', 'id': '1'})
+    table.create_entity({'PartitionKey': 'b', 'RowKey': '1', 'size': 30,
+                         'created': datetime(2024, 1, 2, tzinfo=timezone.utc)})
+
+
+@pytest.mark.parametrize('query, parameters, expected', [
+    ("PartitionKey eq 'a'", None, [('a', '1'), ('a', '2'), ('a', '~n~1')]),
+    ("PartitionKey eq 'a' and RowKey lt '~'", None, [('a', '1'), ('a', '2')]),
+    ("PartitionKey eq @p and RowKey gt @after and RowKey lt @before", {'p': 'a', 'after': '~n~', 'before': '~n~~'}, [('a', '~n~1')]),
+    ("size ge 20", None, [('a', '2'), ('b', '1')]),
+    ("size gt 15 and size le 20", None, [('a', '2')]),
+    ("hidden eq true", None, [('a', '2')]),
+    ("hidden eq @hidden", {'hidden': False}, [('a', '1')]),
+    # a missing property is unknown, not false
+    ("not (hidden eq true) and PartitionKey eq 'a'", None, [('a', '1')]),
+    ("RowKey eq '1' and (PartitionKey eq 'b' or size eq 10)", None, [('a', '1'), ('b', '1')]),
+    ("name eq 'o''neil'", None, [('a', '1')]),
+    ("ts lt 2.0", None, [('a', '2')]),
+    ("created ge datetime'2024-01-01T00:00:00Z'", None, [('b', '1')]),
+    ("size ne 10", None, [('a', '2'), ('b', '1')]),
+])
+def test_filters(table, query, parameters, expected):
+    fill(table)
+    assert keys(table.query_entities(query, parameters=parameters)) == expected
+
+
+def test_select(table):
+    fill(table)
+    entity = next(iter(table.query_entities("PartitionKey eq 'b'", select=['RowKey', 'size'])))
+    assert dict(entity) == {'RowKey': '1', 'size': 30}
+
+
+@pytest.mark.parametrize('query', ["PartitionKey eq", "PartitionKey is 'a'", "(PartitionKey eq 'a'",
+                                   "PartitionKey eq @missing", "PartitionKey eq 'a' RowKey"])
+def test_bad_filters_are_refused(query):
+    # the local store's compiler, the service answers these with a 400
+    with pytest.raises(FilterError):
+        compile_filter(query)
+
+
+def test_continuation_tokens(table):
+    for n in range(7):
+        table.create_entity({'PartitionKey': 'p', 'RowKey': f'{n:02d}'})
+    pages = table.query_entities("PartitionKey eq 'p'", results_per_page=3).by_page()
+    first = list(next(pages))
+    assert [e['RowKey'] for e in first] == ['00', '01', '02']
+    # resume from the token, like an admin page link does
+    resumed = table.query_entities("PartitionKey eq 'p'", results_per_page=3).by_page(continuation_token=pages.continuation_token)
+    assert [e['RowKey'] for e in next(resumed)] == ['03', '04', '05']
+    assert [e['RowKey'] for e in next(resumed)] == ['06']
+    assert resumed.continuation_token is None
+    with pytest.raises(StopIteration):
+        next(resumed)
+
+
+def test_opaque_continuation_tokens(table):
+    for n in range(5):
+        table.create_entity({'PartitionKey': 'p', 'RowKey': f'{n:02d}'})
+    seen = []
+    token = None
+    while True:
+        entities, token = datalayers._query_page(table, "PartitionKey eq 'p'", 2, token)
+        seen += [e['RowKey'] for e in entities]
+        if token is None:
+            break
+        assert isinstance(token, str)
+    assert seen == ['00', '01', '02', '03', '04']
+    with pytest.raises(ValueError):
+        datalayers._query_page(table, "PartitionKey eq 'p'", 2, 'not a token')
+
+
+def test_transactions_are_atomic(table):
+    table.create_entity({'PartitionKey': 'p', 'RowKey': 'taken'})
+    with pytest.raises(TableTransactionError) as error:
+        table.submit_transaction([('upsert', {'PartitionKey': 'p', 'RowKey': 'new'}),
+                                  ('create', {'PartitionKey': 'p', 'RowKey': 'taken'})])
+    assert error.value.status_code == 409
+    assert keys(table.query_entities("PartitionKey eq 'p'")) == [('p', 'taken')]
+    table.submit_transaction([('upsert', {'PartitionKey': 'p', 'RowKey': 'new'}),
+                              ('delete', {'PartitionKey': 'p', 'RowKey': 'taken'})])
+    assert keys(table.query_entities("PartitionKey eq 'p'")) == [('p', 'new')]
+
+
+def test_transactions_stay_in_one_partition(table):
+    with pytest.raises(TableTransactionError):
+        table.submit_transaction([('upsert', {'PartitionKey': 'p', 'RowKey': '1'}),
+                                  ('upsert', {'PartitionKey': 'q', 'RowKey': '1'})])
+    with pytest.raises(TableTransactionError):
+        table.submit_transaction([('upsert', {'PartitionKey': 'p', 'RowKey': str(n)}) for n in range(101)])
+    # a missing row fails a batch delete, unlike a single delete
+    table.delete_entity(partition_key='p', row_key='missing')
+    with pytest.raises(TableTransactionError) as error:
+        table.submit_transaction([('delete', {'PartitionKey': 'p', 'RowKey': 'missing'})])
+    assert error.value.status_code == 404
+
+
+def test_etag_conditions(table):
+    table.create_entity({'PartitionKey': 'p', 'RowKey': '1', 'count': 1})
+    entity = table.get_entity('p', '1')
+    etag = entity.metadata['etag']
+    table.update_entity({'PartitionKey': 'p', 'RowKey': '1', 'count': 2}, mode='replace',
+                        etag=etag, match_condition=MatchConditions.IfNotModified)
+    with pytest.raises(ResourceModifiedError):
+        table.update_entity({'PartitionKey': 'p', 'RowKey': '1', 'count': 3}, mode='replace',
+                            etag=etag, match_condition=MatchConditions.IfNotModified)
+    with pytest.raises(ResourceModifiedError):
+        table.delete_entity(partition_key='p', row_key='1', etag=etag, match_condition=MatchConditions.IfNotModified)
+    # in a batch the failed condition fails everything
+    with pytest.raises(TableTransactionError) as error:
+        table.submit_transaction([('upsert', {'PartitionKey': 'p', 'RowKey': '2'}),
+                                  ('update', {'PartitionKey': 'p', 'RowKey': '1', 'count': 4},
+                                   {'mode': 'replace', 'etag': etag, 'match_condition': MatchConditions.IfNotModified})])
+    assert error.value.status_code == 412
+    assert table.get_entity('p', '1')['count'] == 2
+    with pytest.raises(ResourceNotFoundError):
+        table.get_entity('p', '2')
+    with pytest.raises(ResourceExistsError):
+        table.create_entity({'PartitionKey': 'p', 'RowKey': '1'})
+
+
+def test_merge_and_replace(table):
+    table.create_entity({'PartitionKey': 'p', 'RowKey': '1', 'a': 1, 'b': 2})
+    table.upsert_entity({'PartitionKey': 'p', 'RowKey': '1', 'b': 3})
+    assert table.get_entity('p', '1')['a'] == 1
+    table.upsert_entity({'PartitionKey': 'p', 'RowKey': '1', 'b': 4}, mode='replace')
+    assert 'a' not in table.get_entity('p', '1')
+
+
+def test_blob_round_trip(blob_service):
+    blob_service._upload_bytes_to_blob(b'small', 'orgs', 'one', content_type='image/jpeg')
+    assert blob_service.get_image('one') == b'small'
+    with pytest.raises(ResourceExistsError):
+        blob_service._upload_bytes_to_blob(b'again', 'orgs', 'one')
+    # bigger bodies go up in blocks
+    data = bytes(range(256)) * 40
+    blob_service._upload_stream_to_blob(io.BytesIO(data), 'orgs', 'two', chunk_size=1000, content_type='image/png')
+    assert blob_service.get_image('two') == data
+    assert blob_service.delete_image('two') is True
+    with pytest.raises(ResourceNotFoundError):
+        blob_service.get_image('two')
+
+
+def test_blob_conditional_delete(blob_service):
+    blob_service._upload_bytes_to_blob(b'first', 'orgs', 'blob')
+    etag = blob_service._blob_etag('orgs', 'blob')
+    blob_service._upload_bytes_to_blob(b'second', 'orgs', 'blob', overwrite=True)
+    assert blob_service._blob_etag('orgs', 'blob') != etag
+    with pytest.raises(ResourceModifiedError):
+        blob_service._delete_blob('orgs', 'blob', etag)
+    assert blob_service._delete_blob('orgs', 'blob', blob_service._blob_etag('orgs', 'blob'))
+    assert blob_service._blob_etag('orgs', 'blob') is None
+
+
+def verify(service, url, now = None):
+    client = service.blob_service_client
+    if isinstance(client, FakeBlobServiceClient):
+        return client.verify_sas(url, now)
+    parts = urlsplit(url)
+    container, blob = parts.path[len(client.url_prefix) + 1:].split('/', 1)
+    query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+    if now is not None and int(query['se']) < now.timestamp():
+        return False
+    return client.verify(container, blob, query.get('se'), query.get('sig'))
+
+
+def test_signed_urls(blob_service):
+    blob_service._upload_bytes_to_blob(b'data', 'orgs', 'signed')
+    url, expiry = blob_service.get_image_url_with_expiry('signed')
+    assert verify(blob_service, url)
+    # the url is reused until it is about to expire
+    assert blob_service.get_image_url('signed') == url
+    assert not verify(blob_service, url, now=expiry + timedelta(seconds=1))
+
+
+def tamper(url, name, change):
+    parts = urlsplit(url)
+    query = [pair.split('=', 1) for pair in parts.query.split('&')]
+    query = '&'.join(f'{k}={change(v) if k == name else v}' for k, v in query)
+    return parts._replace(query=query).geturl()
+
+
+def test_tampered_signed_urls(blob_service):
+    url = blob_service.get_image_url('signed')
+    assert verify(blob_service, url)
+    # another blob with the same signature
+    assert not verify(blob_service, url.replace('/signed?', '/other?'))
+    # a later expiry with the same signature, the year is the first digit in either format
+    assert not verify(blob_service, tamper(url, 'se', lambda se: str(int(se[0]) + 1) + se[1:]))
+    # a changed signature
+    assert not verify(blob_service, tamper(url, 'sig', lambda sig: ('A' if sig[0] != 'A' else 'B') + sig[1:]))
+
+
+@pytest.fixture(params=['local', 'azure'])
+def table_service(request, tmp_path, monkeypatch):
+    # the data layers on a fresh store
+    if request.param == 'local':
+        service = SqliteTableServiceClient(str(tmp_path / 'tables.db'))
+    else:
+        service = FakeTableServiceClient()
+    monkeypatch.setattr(datalayers, 'get_table_client', lambda table_name, connection_string = None: service.get_table_client(table_name))
+    return service
+
+
+def test_data_layers(table_service):
+    from models import Image
+    idl = datalayers.ImageDataLayer()
+    wdl = datalayers.WallDataLayer()
+    images = []
+    for n in range(5):
+        image = Image(f'img{n}', 'wall', b'x' * n, 'image/jpeg')
+        image.blob_url = f'/blobs/{image.id}'
+        image.timestamp = 1000 + n
+        idl.create(image)
+        assert wdl.add_image_to_stats('wall', image.id, image.size, image.timestamp) is not None
+        images.append(image)
+    assert wdl.add_image_to_stats('wall', 'img0', 0, 1000) is None
+    page, cursor = idl.list_images_page('wall', limit=3)
+    assert [image['id'] for image in page] == ['img4', 'img3', 'img2']
+    page, cursor = idl.list_images_page('wall', limit=3, cursor=cursor)
+    assert [image['id'] for image in page] == ['img1', 'img0'] and cursor is None
+    assert idl.get_by_id('img3').size == 3
+    stats = wdl.get_stats_for_walls(['wall'])['wall']
+    assert (stats.num_images, stats.bytes_stored, stats.first_upload, stats.last_upload) == (5, 10, 1000, 1004)
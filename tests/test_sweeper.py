@@ -0,0 +1,63 @@
+from datetime import datetime, timezone, timedelta
+
+from datalayers import WallDataLayer, ImageDataLayer, delete_entities_batched
+from events import RedisEventBus
+from fakes import FakeRedis, FakeTableClient
+from models import Image, Wall
+from sweeper import ExpirySweeper
+from test_events import wait_for
+
+
+def test_purged_walls_are_invalidated_everywhere():
+    now = datetime.now(tz=timezone.utc)
+    wall = Wall()
+    wall.created = now - timedelta(days=2)
+    WallDataLayer().create(wall)
+    image = Image('sweep' + wall.id, wall.id, None, 'image/jpeg')
+    ImageDataLayer().create(image)
+    fresh = Wall()
+    WallDataLayer().create(fresh)
+
+    # a running server listening on the same redis
+    redis = FakeRedis()
+    server = RedisEventBus(client=redis, poll_interval=0.01)
+    invalidations = []
+    server.on_invalidation(lambda kind, key: invalidations.append((kind, key)))
+    wait_for(lambda: server._pubsub.subscribed)
+    sweeper = ExpirySweeper(event_bus=RedisEventBus(client=redis))
+    sweeper.sweep(now)
+    sweeper.event_bus.close()
+
+    assert sweeper.walls_deleted == 1
+    assert WallDataLayer().get_by_id(wall.id) is None
+    assert WallDataLayer().get_by_id(fresh.id) is not None
+    wait_for(lambda: len(invalidations) == 2)
+    assert sorted(invalidations) == [('image', image.id), ('wall', wall.id)]
+    server.close()
+
+
+def test_purge_deletes_in_batches_per_partition():
+    table = FakeTableClient('images')
+    rows = [{'PartitionKey': 'big', 'RowKey': f'{n:04d}'} for n in range(250)]
+    rows += [{'PartitionKey': 'small', 'RowKey': f'{n}'} for n in range(3)]
+    for row in rows:
+        table.upsert_entity(row)
+    batches = []
+    submit_transaction = table.submit_transaction
+    table.submit_transaction = lambda operations: batches.append(operations) or submit_transaction(operations)
+    # one of them went meanwhile, its batch is retried row by row
+    table.delete_entity(partition_key='big', row_key='0200')
+    assert delete_entities_batched(table, rows) == len(rows)
+    assert list(table.list_entities()) == []
+    assert sorted(len(batch) for batch in batches) == [3, 50, 100, 100]
+    assert all(len({row['PartitionKey'] for _, row in batch}) == 1 for batch in batches)
+
+
+def test_purged_wall_leaves_no_rows_behind():
+    wall_id = 'purge' + Wall().id
+    images = [Image(f'{wall_id}{n}', wall_id, None, 'image/jpeg') for n in range(3)]
+    for image in images:
+        ImageDataLayer().create(image)
+    assert sorted(ImageDataLayer().purge_wall(wall_id)) == sorted((image.id, image.blob_name) for image in images)
+    assert ImageDataLayer().list_images_page(wall_id) == ([], None)
+    assert all(ImageDataLayer().get_by_id(image.id) is None for image in images)
@@ -0,0 +1,65 @@
+import time
+
+import datalayers
+from datalayers import EntityCache, WallDataLayer
+from models import Wall, WallStatus
+
+
+def count_reads(monkeypatch):
+    reads = []
+    table_client = WallDataLayer().table_client._table_client
+    get_entity = table_client.get_entity
+    monkeypatch.setattr(table_client, 'get_entity', lambda *args, **kwargs: reads.append(args) or get_entity(*args, **kwargs))
+    return reads
+
+
+def test_walls_are_read_once_and_dropped_on_write(monkeypatch):
+    published = []
+    monkeypatch.setattr(datalayers, '_invalidation_publisher', lambda kind, key: published.append((kind, key)))
+    wall = Wall()
+    WallDataLayer().create(wall)
+    reads = count_reads(monkeypatch)
+    assert WallDataLayer().get_by_id(wall.id).id == wall.id
+    assert WallDataLayer().get_by_id(wall.id).id == wall.id
+    assert len(reads) == 1
+    wall.status = WallStatus.OWNED
+    wall.owner_email = 'owner@example.com'
+    WallDataLayer().update(wall)
+    assert WallDataLayer().get_by_id(wall.id).status == WallStatus.OWNED
+    assert len(reads) == 2
+    # other processes hear about both writes
+    assert published == [('wall', wall.id), ('wall', wall.id)]
+
+
+def test_callers_get_their_own_copy():
+    wall = Wall()
+    WallDataLayer().create(wall)
+    WallDataLayer().get_by_id(wall.id).owner_email = 'someone@example.com'
+    assert WallDataLayer().get_by_id(wall.id).owner_email != 'someone@example.com'
+
+
+def test_entries_expire():
+    cache = EntityCache(ttl=0.01)
+    cache.put('wall', {'id': 'wall'})
+    assert cache.get('wall') == {'id': 'wall'}
+    time.sleep(0.02)
+    assert cache.get('wall') is None
+
+
+def test_read_that_raced_a_write_is_not_stored():
+    cache = EntityCache()
+    token = cache.token()
+    # the wall is written while the old copy is on its way back
+    cache.invalidate('wall')
+    cache.put('wall', {'version': 'old'}, token)
+    assert cache.get('wall') is None
+    cache.put('wall', {'version': 'new'}, cache.token())
+    assert cache.get('wall') == {'version': 'new'}
+
+
+def test_cache_is_bounded():
+    cache = EntityCache(max_items=2)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, {'id': key})
+    assert cache.get('a') is None
+    assert cache.get('c') == {'id': 'c'}